@@ -2,24 +2,128 @@ import os
 import time
 import uuid
 import logging
+import logging.handlers
 import shutil
 import torch
+import numpy as np
 import subprocess
 from pathlib import Path
 from tempfile import NamedTemporaryFile
-from fastapi import FastAPI, File, Form, UploadFile, HTTPException
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Header
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 import stable_whisper
 from stable_whisper import WhisperResult
 from typing import Optional
 import tempfile
 import re
+import json
+import asyncio
+import threading
+import sys
+from collections import deque
+import random
+import io
+import hashlib
+import socket
+import fcntl
+import sqlite3
+import contextlib
+import queue
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from fastapi.concurrency import run_in_threadpool
 
-# Thiết lập logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+try:
+    import orjson
+except ImportError:  # orjson là tùy chọn, dùng encoder JSON mặc định nếu chưa cài
+    orjson = None
+
+# Thiết lập logging: request chỉ đẩy record vào hàng đợi, một thread riêng định dạng và ghi ra stderr
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")  # "text" hoặc "json" (mỗi record một dòng JSON)
+LOG_QUEUE_SIZE = 10000  # Khi hàng đợi đầy, record bị bỏ thay vì làm chậm request
+# Tỉ lệ request được ghi nội dung mẫu của file ASS (trước/sau bo góc) để chẩn đoán
+ASS_DEBUG_SAMPLE_RATE = float(os.environ.get("ASS_DEBUG_SAMPLE_RATE", "0"))
+# Các thuộc tính sẵn có của LogRecord, phần còn lại (truyền qua extra=) là trường có cấu trúc
+_LOG_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Định dạng record thành một dòng JSON gồm các trường chuẩn và các trường truyền qua extra=.
+    """
+    
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _LOG_RECORD_ATTRS})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler không bao giờ chặn: bỏ record khi hàng đợi đầy và đếm số record đã bỏ.
+    """
+    
+    dropped = 0
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging():
+    """
+    Thêm QueueHandler vào root logger và khởi động QueueListener ghi ra stderr.
+    Gọi khi server khởi động (không phải lúc import) để không đụng đến handler của chương trình import
+    module này; các handler sẵn có của root logger được giữ nguyên. Gọi lại nhiều lần không gắn thêm handler.
+    
+    Returns:
+        tuple: (DroppingQueueHandler, QueueListener)
+    """
+    global _log_handler, _log_listener
+    if _log_handler is not None:
+        return _log_handler, _log_listener
+    
+    stream_handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        stream_handler.setFormatter(StructuredFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    
+    handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    listener = logging.handlers.QueueListener(handler.queue, stream_handler, respect_handler_level=True)
+    
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    listener.start()
+    # Ghi nốt các record còn trong hàng đợi khi tiến trình thoát
+    atexit.register(stop_logging)
+    _log_handler, _log_listener = handler, listener
+    return handler, listener
+
+def stop_logging():
+    """
+    Gỡ QueueHandler khỏi root logger và dừng QueueListener sau khi ghi nốt hàng đợi (gọi nhiều lần được).
+    """
+    global _log_handler, _log_listener
+    if _log_handler is None:
+        return
+    logging.getLogger().removeHandler(_log_handler)
+    _log_listener.stop()
+    _log_handler = _log_listener = None
+
+_log_handler = None
+_log_listener = None
 logger = logging.getLogger("autoreel-api")
 
 # Khởi tạo FastAPI
@@ -33,9 +137,858 @@ OUTPUTS_DIR = Path("./outputs")
 TEMP_DIR.mkdir(exist_ok=True)
 OUTPUTS_DIR.mkdir(exist_ok=True)
 
+# Tham số cắt khoảng lặng trước khi đưa audio vào mô hình
+SAMPLE_RATE = 16000             # Whisper yêu cầu audio 16kHz mono
+SILENCE_FRAME_MS = 20           # Độ dài mỗi frame khi tính năng lượng
+SILENCE_FLOOR_DB = -50.0        # Ngưỡng tuyệt đối (dBFS) để coi là khoảng lặng
+SILENCE_RELATIVE_DB = 35.0      # Ngưỡng tương đối so với mức năng lượng cao của giọng nói
+SILENCE_MIN_DURATION = 0.6      # Chỉ cắt các khoảng lặng dài hơn giá trị này (giây)
+SILENCE_PAD = 0.2               # Giữ lại một khoảng đệm ở mỗi phía của giọng nói (giây)
+
+# Căn chỉnh theo kịch bản (mode=align): bỏ cuộc khi quá nhiều từ không căn được
+ALIGN_FAILURE_THRESHOLD = 0.2   # Tỉ lệ từ có độ dài bằng 0 tối đa trước khi stable-ts dừng căn chỉnh
+
+# Cấu hình mặc định cho việc nhóm từ thành phụ đề 1 dòng, có thể ghi đè theo từng request
+DEFAULT_REGROUP_SPEC = {
+    "sentence_punctuation": [('.', ' '), '。', '?', '？', '!', '！'],  # Luôn ngắt sau dấu kết câu
+    "max_gap": 0.5,                 # Ngắt khi khoảng lặng giữa 2 từ lớn hơn giá trị này (giây)
+    "clause_punctuation": [(',', ' '), '，', ';', '；'],  # Ngắt sau dấu phẩy, chấm phẩy...
+    "clause_min_chars": 20,         # ...chỉ với các đoạn có từ 20 ký tự trở lên
+    "max_chars": 20,                # Chia đều các đoạn dài hơn 20 ký tự
+    "clamp_medium_factor": 2.5,     # Giới hạn độ dài từ đầu/cuối theo trung vị của đoạn
+    "ignore_special_periods": True, # Không ngắt tại dấu chấm của viết tắt/số (VD: "TP.", "1.")
+}
+
+# Style mặc định của ASS (giống stable-ts), các tham số từ request sẽ ghi đè lên
+ASS_DEFAULT_STYLE = {
+    'Name': 'Default', 'Fontname': 'Arial', 'Fontsize': '48', 'PrimaryColour': '&Hffffff',
+    'SecondaryColour': '&Hffffff', 'OutlineColour': '&H0', 'BackColour': '&H0', 'Bold': '0',
+    'Italic': '0', 'Underline': '0', 'StrikeOut': '0', 'ScaleX': '100', 'ScaleY': '100',
+    'Spacing': '0', 'Angle': '0', 'BorderStyle': '1', 'Outline': '1', 'Shadow': '0',
+    'Alignment': '2', 'MarginL': '10', 'MarginR': '10', 'MarginV': '10', 'Encoding': '0'
+}
+ASS_MIN_DUR = 0.02  # Từ/segment ngắn hơn giá trị này được gộp với từ/segment kề bên
+
+# Các trường có thể chọn trong response của /transcribe (tham số fields)
+RESPONSE_FIELDS = ("success", "message", "processing_time", "device", "model", "mode",
+                   "download_url", "job_id", "duration", "text", "segments", "words")
+FULL_RESPONSE_FIELDS = ["success", "message", "processing_time", "device", "model", "mode",
+                        "download_url", "job_id", "text", "segments"]
+SIMPLE_RESPONSE_FIELDS = ["success", "message", "download_url", "duration"]
+SEGMENT_FIELDS = ("id", "start", "end", "text", "duration")
+WORD_FIELDS = ("word", "start", "end", "probability", "segment")  # segment: dòng phụ đề (event ASS) chứa từ
+
+# Ước lượng bộ nhớ cho kiểm soát tiếp nhận request (MB)
+# weights_mb: bộ nhớ cố định khi mô hình đã tải, working_mb: bộ nhớ làm việc của mỗi lần chạy
+MODEL_MEMORY_PROFILES = {
+    "large-v3": {"weights_mb": 6200, "working_mb": 1500},
+    "turbo": {"weights_mb": 3300, "working_mb": 1000},
+}
+DEVICE_MEMORY_FACTOR = {"cuda": 1.0, "cpu": 1.3}  # CPU chạy fp32 nên tốn bộ nhớ làm việc hơn
+AUDIO_MB_PER_SECOND = 0.5       # Audio đã giải mã, mel và kết quả trên mỗi giây audio
+CHUNK_SECONDS = 600             # Độ dài mỗi đoạn khi phải phiên âm chia đoạn
+PROBE_FALLBACK_SECONDS = 600    # Thời lượng giả định khi không đọc được thời lượng file
+OOM_RETRY_AFTER_SECONDS = 30    # Retry-After trả về khi vẫn hết bộ nhớ sau khi được tiếp nhận
+
+# Tiếp nhận file video: chỉ tách luồng âm thanh trước khi phiên âm
+VIDEO_FORMATS = ("mp4", "avi", "mkv")
+MAX_AUDIO_SECONDS = float(os.environ.get("MAX_AUDIO_SECONDS", "14400"))  # Từ chối audio dài hơn 4 giờ
+# Container để chép nguyên luồng âm thanh (không giải mã lại) theo codec
+AUDIO_COPY_CONTAINERS = {
+    "aac": "m4a", "alac": "m4a", "mp3": "mp3", "opus": "ogg", "vorbis": "ogg",
+    "flac": "flac", "pcm_s16le": "wav", "pcm_s24le": "wav", "pcm_f32le": "wav",
+}
+
+# Profiling theo yêu cầu (header X-Profile) hoặc lấy mẫu ngẫu nhiên, tắt thì không tốn gì
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))  # Tỉ lệ request được profile tự động
+PROFILE_TORCH_OPS = os.environ.get("PROFILE_TORCH_OPS", "0") == "1"      # Bật torch profiler cho request lấy mẫu
+PROFILE_INTERVAL = 0.005    # Chu kỳ lấy mẫu stack (giây)
+PROFILE_TOP_FUNCTIONS = 50  # Số hàm giữ lại trong bảng tổng hợp
+PROFILE_TOP_STACKS = 200    # Số stack (dạng folded cho flamegraph) giữ lại
+PROFILE_TOP_OPS = 40        # Số op torch giữ lại
+
+# Chế độ nháp rồi tinh chỉnh: trả kết quả nhanh bằng mô hình nhỏ, chạy lại mô hình chính ở nền
+DRAFT_MODEL_NAME = os.environ.get("DRAFT_MODEL", "turbo")
+
+# Kho trạng thái bền vững (SQLite WAL) dùng chung giữa các lần khởi động và các replica trên cùng máy
+DATA_DIR = Path(os.environ.get("DATA_DIR", "./data"))
+STATE_DB_PATH = DATA_DIR / "state.db"
+JOB_AUDIO_DIR = DATA_DIR / "audio"  # Audio của job đang chạy, giữ lại để chạy lại sau khi khởi động lại
+REPLICA_ID = os.environ.get("REPLICA_ID")  # Nếu không đặt, được xác định khi khởi động bằng load_replica_id
+JOB_HEARTBEAT_SECONDS = 30          # Chu kỳ cập nhật heartbeat của job đang chạy
+JOB_STALE_SECONDS = 120             # Job không có heartbeat lâu hơn được coi là bị gián đoạn
+JOB_EVENTS_POLL_SECONDS = 2.0       # Chu kỳ đọc lại job khi theo dõi qua /jobs/{id}/events
+TRANSCRIPT_CACHE_MAX_AGE = 7 * 24 * 3600  # Transcript cache cũ hơn 7 ngày bị xóa
+JOB_KEEP_VERSIONS = max(int(os.environ.get("JOB_KEEP_VERSIONS", "5")), 1)  # Số phiên bản mới nhất giữ lại mỗi job
+JOB_MAX_AGE = float(os.environ.get("JOB_MAX_AGE_SECONDS", str(7 * 24 * 3600)))  # Job đã kết thúc lâu hơn bị xóa
+STORE_PRUNE_SECONDS = 3600          # Chu kỳ áp dụng chính sách lưu giữ của kho
+DATA_DIR.mkdir(exist_ok=True)
+JOB_AUDIO_DIR.mkdir(exist_ok=True)
+
+# Tăng tốc suy luận: inference_mode, torch.compile (tùy chọn) với cache trên đĩa và warm-up khi tải mô hình
+TORCH_INFERENCE_MODE = os.environ.get("TORCH_INFERENCE_MODE", "1") == "1"
+TORCH_COMPILE = os.environ.get("TORCH_COMPILE", "0") == "1"
+TORCH_COMPILE_MODE = os.environ.get("TORCH_COMPILE_MODE", "default")
+# Decoder chạy với số token thay đổi từng bước và hook kv-cache nên mặc định chỉ compile encoder
+TORCH_COMPILE_TARGETS = tuple(
+    target.strip() for target in os.environ.get("TORCH_COMPILE_TARGETS", "encoder").split(",") if target.strip()
+)
+COMPILE_CACHE_DIR = DATA_DIR / "compile_cache"  # Artifact của inductor/triton, giữ qua các lần khởi động
+MODEL_WARMUP = os.environ.get("MODEL_WARMUP", "1" if TORCH_COMPILE else "0") == "1"
+WARMUP_DURATIONS = tuple(float(seconds) for seconds in os.environ.get("WARMUP_DURATIONS", "5,30").split(","))
+
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")  # Nếu đặt, các endpoint /admin yêu cầu header X-Admin-Token
+
+# Lập lịch request: việc ngắn trước, cộng điểm theo thời gian chờ và độ ưu tiên
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", "1"))  # Mỗi mô hình chỉ chạy 1 request một lúc
+DEFAULT_REALTIME_FACTOR = {"cuda": 0.1, "cpu": 1.0}  # Thời gian xử lý / thời lượng audio ban đầu
+SCHEDULER_AGING_RATE = 1.0          # Mỗi giây chờ bù cho 1 giây xử lý ước lượng
+SCHEDULER_PRIORITY_SECONDS = 60.0   # Mỗi mức ưu tiên tương đương 60 giây xử lý
+MIN_PRIORITY, MAX_PRIORITY = -2, 2  # Khoảng priority client được gửi, để aging vẫn bảo đảm mọi việc đến lượt
+MEMORY_BUDGET_MB = os.environ.get("MEMORY_BUDGET_MB")  # Ghi đè ngân sách bộ nhớ (VD: mô phỏng trên CPU)
+PRIMARY_MODEL_NAME = "large-v3"
+FALLBACK_MODEL_NAME = "turbo"
+
+# Pipeline xử lý theo giai đoạn: mỗi giai đoạn có executor riêng với hàng đợi giới hạn,
+# nên request sau có thể suy luận trong khi request trước còn đang tạo ASS
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "2"))    # Lưu upload, đọc/tách/giải mã audio
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", "2"))    # Nhóm từ, tạo ASS, ghi kho, dựng response
+STAGE_QUEUE_SIZE = int(os.environ.get("STAGE_QUEUE_SIZE", "8"))  # Số việc chờ tối đa của mỗi giai đoạn
+STAGE_UTILIZATION_WINDOW = 60.0  # Cửa sổ (giây) tính độ bận của giai đoạn
+
+MAX_TRANSCRIPT_EDITS = 500  # Số chỉnh sửa tối đa trong một request /jobs/{id}/edits
+
 # Biến toàn cục để lưu trữ mô hình
 _model = None
+_model_name = None
 _device = "cpu"
+_extra_models = {}      # Mô hình phụ được tải khi hạ cấp: tên -> model
+_model_locks = {}       # Khóa để mỗi mô hình chỉ chạy một request tại một thời điểm
+_model_users = {}       # Số request đang dùng từng mô hình: id(model) -> số request
+_swap_events = deque(maxlen=20)  # Lịch sử thay mô hình gần đây
+_swap_task = None
+_job_subscribers = {}   # Các hàng đợi của client đang theo dõi job: id -> [asyncio.Queue]
+_db_local = threading.local()
+_heartbeat_task = None
+_retention_task = None
+_replica_id_file = None  # File id replica trong DATA_DIR, giữ khóa suốt thời gian chạy
+_resume_tasks = set()   # Các job đang chạy ở nền (resume_job), giữ tham chiếu để task không bị thu gom
+_accel_stats = {
+    "inference_mode": TORCH_INFERENCE_MODE,
+    "compile": {"enabled": TORCH_COMPILE, "mode": TORCH_COMPILE_MODE, "targets": [], "error": None},
+    "warmup": [],
+    "tokens_per_second": None,
+    "last_tokens_per_second": None,
+}
+_memory_scale = {}      # Hệ số hiệu chỉnh ước lượng bộ nhớ sau khi gặp OOM: tên mô hình -> hệ số
+_admission = None
+_stages = {}            # Các giai đoạn của pipeline: tên -> PipelineStage
+_single_flight = None
+
+class MemoryAdmission:
+    """
+    Kiểm soát tiếp nhận và lập lịch request theo ngân sách bộ nhớ (MB), không phụ thuộc thiết bị.
+    
+    Bộ nhớ được chia thành phần cố định (trọng số các mô hình đã tải) và phần cấp cho
+    từng request đang chạy. Request chỉ bắt đầu khi ngân sách và số slot còn đủ, nếu không
+    sẽ xếp hàng. Hàng đợi ưu tiên việc ngắn trước (shortest-job-first) theo thời gian xử lý
+    ước lượng, trừ đi thời gian đã chờ (aging) và điểm ưu tiên, để việc dài vẫn đến lượt.
+    Request được chọn chưa đủ chỗ thì các request sau cũng chờ, tránh việc lớn bị bỏ đói.
+    """
+    
+    def __init__(self, budget_mb, max_in_flight=1, realtime_factor=1.0):
+        self.budget_mb = float(budget_mb)
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.realtime_factor = float(realtime_factor)
+        self.resident = {}
+        self.reserved_mb = 0.0
+        self.running = {}
+        self._waiters = []
+    
+    @property
+    def resident_mb(self):
+        return sum(self.resident.values())
+    
+    @property
+    def available_mb(self):
+        return self.budget_mb - self.resident_mb - self.reserved_mb
+    
+    @property
+    def in_flight(self):
+        return len(self.running)
+    
+    @property
+    def queue_depth(self):
+        return sum(1 for job in self._waiters if not job["future"].done())
+    
+    def can_ever_fit(self, amount_mb):
+        """
+        Kiểm tra request có thể chạy được khi không có request nào khác hay không.
+        """
+        return amount_mb <= self.budget_mb - self.resident_mb
+    
+    def estimate_service_seconds(self, duration_s):
+        return duration_s * self.realtime_factor
+    
+    def record_service_time(self, duration_s, seconds):
+        """
+        Cập nhật hệ số thời gian xử lý / thời lượng audio (trung bình trượt) sau mỗi request.
+        """
+        if duration_s > 0:
+            self.realtime_factor = 0.8 * self.realtime_factor + 0.2 * (seconds / duration_s)
+    
+    def set_resident(self, name, amount_mb):
+        self.resident[name] = float(amount_mb)
+        self._wake()
+    
+    def drop_resident(self, name):
+        self.resident.pop(name, None)
+        self._wake()
+    
+    def _score(self, job, now):
+        return (job["service_s"]
+                - SCHEDULER_AGING_RATE * (now - job["enqueued_at"])
+                - SCHEDULER_PRIORITY_SECONDS * job["priority"])
+    
+    def _fits(self, job):
+        return self.in_flight < self.max_in_flight and job["memory_mb"] <= self.available_mb
+    
+    async def acquire(self, amount_mb, duration_s=0.0, priority=0, ticket=None):
+        """
+        Chờ đến lượt và đến khi ngân sách cho phép rồi cấp amount_mb cho request.
+        
+        Args:
+            amount_mb (float): Bộ nhớ cần cấp
+            duration_s (float): Thời lượng audio (giây), dùng để ước lượng thời gian xử lý
+            priority (int): Điểm ưu tiên, càng cao càng được chạy sớm
+            ticket (dict): Nếu có, dùng làm vé của request để bên gọi nâng ưu tiên khi đang chờ (raise_priority)
+            
+        Returns:
+            dict: Vé của request, truyền lại cho shrink/release
+        """
+        job = ticket if ticket is not None else {}
+        job.update({
+            "id": uuid.uuid4().hex,
+            "memory_mb": float(amount_mb),
+            "duration_s": float(duration_s),
+            "service_s": self.estimate_service_seconds(duration_s),
+            "priority": int(priority),
+            "enqueued_at": time.time(),
+            "started_at": None,
+        })
+        if not self._waiters and self._fits(job):
+            self._grant(job)
+            return job
+        
+        job["future"] = asyncio.get_running_loop().create_future()
+        self._waiters.append(job)
+        try:
+            await job["future"]
+        except asyncio.CancelledError:
+            if job["future"].done() and not job["future"].cancelled():
+                # Đã được cấp nhưng request bị hủy ngay sau đó
+                self.release(job)
+            else:
+                self._wake()
+            raise
+        return job
+    
+    def raise_priority(self, job, priority):
+        """
+        Nâng điểm ưu tiên của request còn đang xếp hàng (VD: request ưu tiên cao hơn chờ chung kết quả).
+        """
+        if "future" in job and not job["future"].done() and priority > job["priority"]:
+            job["priority"] = int(priority)
+            self._wake()
+    
+    def release(self, job):
+        if self.running.pop(job["id"], None) is not None:
+            self.reserved_mb -= job["memory_mb"]
+        self._wake()
+    
+    def shrink(self, job, amount_mb):
+        """
+        Trả lại một phần bộ nhớ đã cấp (VD: trọng số mô hình vừa tải đã chuyển thành phần cố định).
+        """
+        job["memory_mb"] -= amount_mb
+        self.reserved_mb -= amount_mb
+        self._wake()
+    
+    def _grant(self, job):
+        job["started_at"] = time.time()
+        self.reserved_mb += job["memory_mb"]
+        self.running[job["id"]] = job
+    
+    def _wake(self):
+        self._waiters = [job for job in self._waiters if not job["future"].done()]
+        while self._waiters:
+            now = time.time()
+            job = min(self._waiters, key=lambda waiter: self._score(waiter, now))
+            if not self._fits(job):
+                break
+            self._waiters.remove(job)
+            self._grant(job)
+            job["future"].set_result(None)
+    
+    def snapshot(self):
+        """
+        Trạng thái hiện tại cho /capacity: việc đang chạy, hàng đợi theo thứ tự sẽ chạy và thời gian chờ ước lượng.
+        """
+        now = time.time()
+        running = [
+            {
+                "duration": round(job["duration_s"], 2),
+                "elapsed": round(now - job["started_at"], 2),
+                "estimated_remaining": round(max(job["service_s"] - (now - job["started_at"]), 0.0), 2),
+                "memory_mb": round(job["memory_mb"]),
+            }
+            for job in self.running.values()
+        ]
+        queued = sorted(
+            (job for job in self._waiters if not job["future"].done()),
+            key=lambda job: self._score(job, now)
+        )
+        
+        # Mô phỏng các slot để ước lượng thời gian chờ cho từng việc trong hàng và cho một việc mới
+        slots = sorted(item["estimated_remaining"] for item in running)
+        slots += [0.0] * (self.max_in_flight - len(slots))
+        queued_info = []
+        for job in queued:
+            slots.sort()
+            wait = slots[0]
+            slots[0] = wait + job["service_s"]
+            queued_info.append({
+                "duration": round(job["duration_s"], 2),
+                "priority": job["priority"],
+                "waited": round(now - job["enqueued_at"], 2),
+                "estimated_start": round(wait, 2),
+                "memory_mb": round(job["memory_mb"]),
+            })
+        
+        return {
+            "budget_mb": round(self.budget_mb),
+            "resident_mb": round(self.resident_mb),
+            "available_mb": round(self.available_mb),
+            "max_in_flight": self.max_in_flight,
+            "in_flight": len(running),
+            "queue_depth": len(queued_info),
+            "in_flight_seconds": round(sum(item["estimated_remaining"] for item in running), 2),
+            "queued_seconds": round(sum(job["service_s"] for job in queued), 2),
+            "estimated_wait": round(min(slots), 2),
+            "realtime_factor": round(self.realtime_factor, 3),
+            "running": running,
+            "queued": queued_info,
+        }
+
+class PipelineStage:
+    """
+    Một giai đoạn của pipeline xử lý: executor riêng với số worker cố định và hàng đợi giới hạn.
+    Khi hàng đợi đầy, request gửi thêm việc phải chờ (áp lực ngược) thay vì dồn việc vào bộ nhớ.
+    """
+    
+    def __init__(self, name, workers, max_queue):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"stage-{name}")
+        self._slots = asyncio.Semaphore(workers + max_queue)
+        self._lock = threading.Lock()
+        self._created_at = time.time()
+        self._spans = deque(maxlen=1000)  # (bắt đầu, kết thúc) của các việc đã xong gần đây
+        self._running_since = {}          # Việc đang chạy: id -> thời điểm bắt đầu
+        self._next_id = 0
+        self.blocked = 0                  # Việc đang chờ vì hàng đợi đầy
+        self.queued = 0                   # Việc đã vào hàng đợi, chưa có worker
+        self.completed = 0
+        self.failed = 0
+        self.wait_seconds = 0.0
+        self.busy_seconds = 0.0
+    
+    @property
+    def running(self):
+        return len(self._running_since)
+    
+    async def run(self, fn, *args, **kwargs):
+        """
+        Chạy fn(*args, **kwargs) trên một worker của giai đoạn và chờ kết quả.
+        """
+        self.blocked += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.blocked -= 1
+        
+        loop = asyncio.get_running_loop()
+        enqueued_at = time.time()
+        with self._lock:
+            self.queued += 1
+            task_id = self._next_id
+            self._next_id += 1
+        
+        def work():
+            started_at = time.time()
+            with self._lock:
+                self.queued -= 1
+                self.wait_seconds += started_at - enqueued_at
+                self._running_since[task_id] = started_at
+            failed = True
+            try:
+                result = fn(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                finished_at = time.time()
+                with self._lock:
+                    del self._running_since[task_id]
+                    self._spans.append((started_at, finished_at))
+                    self.busy_seconds += finished_at - started_at
+                    if failed:
+                        self.failed += 1
+                    else:
+                        self.completed += 1
+        
+        def done(future):
+            # Việc bị hủy trước khi có worker thì không bao giờ chạy work()
+            if future.cancelled():
+                with self._lock:
+                    self.queued -= 1
+            loop.call_soon_threadsafe(self._slots.release)
+        
+        future = self.executor.submit(work)
+        future.add_done_callback(done)
+        return await asyncio.wrap_future(future)
+    
+    def snapshot(self):
+        """
+        Tóm tắt trạng thái giai đoạn cho /capacity: độ sâu hàng đợi và độ bận trong cửa sổ gần nhất.
+        """
+        now = time.time()
+        window_start = max(now - STAGE_UTILIZATION_WINDOW, self._created_at)
+        with self._lock:
+            spans = list(self._spans) + [(start, now) for start in self._running_since.values()]
+            running = len(self._running_since)
+            finished = self.completed + self.failed
+            started = finished + running
+            wait_seconds = self.wait_seconds
+            busy_seconds = self.busy_seconds
+        
+        busy = sum(end - max(start, window_start) for start, end in spans if end > window_start)
+        elapsed = max(now - window_start, 1e-6)
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "queue_depth": self.queued + self.blocked,
+            "blocked": self.blocked,
+            "running": running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "utilization": round(min(busy / (self.workers * elapsed), 1.0), 3),
+            "avg_wait_seconds": round(wait_seconds / started, 3) if started else 0.0,
+            "avg_service_seconds": round(busy_seconds / finished, 3) if finished else 0.0,
+        }
+
+class SingleFlight:
+    """
+    Gộp các phiên âm giống hệt nhau đang chạy: request đầu tiên với một khóa chạy việc,
+    các request cùng khóa đến sau trong lúc đó chỉ chờ và nhận chung kết quả (hoặc lỗi).
+    Việc chung xếp hàng với ưu tiên cao nhất trong các request đang chờ nó.
+    """
+    
+    def __init__(self):
+        self._flights = {}  # Việc đang chạy: khóa -> {"task", "waiters": số request đang chờ, "state"}
+        self.leaders = 0    # Số việc đã thực sự chạy
+        self.coalesced = 0  # Số request đã dùng chung kết quả của request khác
+        self.failed = 0
+    
+    async def run(self, key, fn, priority=0):
+        """
+        Chạy coroutine fn(state) nếu chưa có việc nào cùng khóa đang chạy, nếu có thì chờ việc đó.
+        
+        Args:
+            key (str): Khóa của việc
+            fn (callable): Hàm nhận state trả về coroutine. state["priority"] là ưu tiên xếp hàng,
+                state["ticket"] là vé truyền cho MemoryAdmission.acquire để request đến sau nâng được ưu tiên
+            priority (int): Điểm ưu tiên của request
+            
+        Returns:
+            Kết quả của fn
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            state = {"priority": priority, "ticket": {}}
+            flight = self._flights[key] = {"task": asyncio.create_task(fn(state)), "waiters": 0, "state": state}
+            flight["task"].add_done_callback(lambda task: self._finish(key, flight, task))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+            state = flight["state"]
+            if priority > state["priority"]:
+                state["priority"] = priority
+                get_admission().raise_priority(state["ticket"], priority)
+        
+        flight["waiters"] += 1
+        try:
+            # shield: một request bị hủy không được hủy việc mà các request khác đang chờ
+            return await asyncio.shield(flight["task"])
+        finally:
+            flight["waiters"] -= 1
+    
+    def __contains__(self, key):
+        return key in self._flights
+    
+    def _finish(self, key, flight, task):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if task.cancelled() or task.exception() is not None:
+            self.failed += 1
+    
+    def snapshot(self):
+        """
+        Tóm tắt cho /capacity: số việc đang chạy, số request đang chờ chung và tổng số request được gộp.
+        """
+        waiting = sum(max(flight["waiters"] - 1, 0) for flight in self._flights.values())
+        return {
+            "in_flight": len(self._flights),
+            "coalesced_waiting": waiting,
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "failed": self.failed,
+        }
+
+def detect_memory_budget_mb(device):
+    """
+    Xác định ngân sách bộ nhớ: MEMORY_BUDGET_MB nếu được cấu hình,
+    nếu không thì 90% bộ nhớ GPU hoặc 80% RAM.
+    """
+    if MEMORY_BUDGET_MB:
+        return float(MEMORY_BUDGET_MB)
+    if device == "cuda":
+        return torch.cuda.get_device_properties(0).total_memory / 2**20 * 0.9
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2**20 * 0.8
+
+def get_admission():
+    """
+    Trả về bộ kiểm soát tiếp nhận, khởi tạo theo thiết bị hiện tại nếu chưa có.
+    """
+    global _admission
+    if _admission is None:
+        _admission = MemoryAdmission(
+            detect_memory_budget_mb(_device),
+            max_in_flight=MAX_CONCURRENT_JOBS,
+            realtime_factor=DEFAULT_REALTIME_FACTOR.get(_device, 1.0)
+        )
+        logger.info(f"Ngân sách bộ nhớ cho phiên âm: {_admission.budget_mb:.0f} MB trên {_device}")
+    return _admission
+
+def get_stage(name):
+    """
+    Trả về giai đoạn pipeline theo tên ("ingest", "inference", "render"), khởi tạo nếu chưa có.
+    """
+    stage = _stages.get(name)
+    if stage is None:
+        # Suy luận đã được giới hạn bởi bộ kiểm soát tiếp nhận; thêm 1 worker để tải mô hình phụ
+        workers = {
+            "ingest": INGEST_WORKERS,
+            "inference": MAX_CONCURRENT_JOBS + 1,
+            "render": RENDER_WORKERS,
+        }[name]
+        stage = _stages[name] = PipelineStage(name, workers, STAGE_QUEUE_SIZE)
+    return stage
+
+def get_single_flight():
+    """
+    Trả về bộ gộp các phiên âm giống hệt nhau đang chạy, khởi tạo nếu chưa có.
+    """
+    global _single_flight
+    if _single_flight is None:
+        _single_flight = SingleFlight()
+    return _single_flight
+
+def model_weights_mb(model_name):
+    return MODEL_MEMORY_PROFILES.get(model_name, MODEL_MEMORY_PROFILES[PRIMARY_MODEL_NAME])["weights_mb"]
+
+def estimate_request_memory(duration_s, model_name, device, chunked=False):
+    """
+    Ước lượng bộ nhớ làm việc (MB) cho một request, không tính trọng số mô hình.
+    
+    Args:
+        duration_s (float): Thời lượng audio (giây)
+        model_name (str): Tên mô hình
+        device (str): "cuda" hoặc "cpu"
+        chunked (bool): Phiên âm chia đoạn, bộ nhớ suy luận chỉ tính cho 1 đoạn cộng PCM của cả file
+        
+    Returns:
+        float: Bộ nhớ ước lượng (MB)
+    """
+    profile = MODEL_MEMORY_PROFILES.get(model_name, MODEL_MEMORY_PROFILES[PRIMARY_MODEL_NAME])
+    seconds = min(duration_s, CHUNK_SECONDS) if chunked else duration_s
+    working = profile["working_mb"] * DEVICE_MEMORY_FACTOR.get(device, 1.0) + AUDIO_MB_PER_SECOND * seconds
+    working *= _memory_scale.get(model_name, 1.0)
+    if chunked:
+        # transcribe_in_chunks giải mã cả file thành PCM float32 rồi mới cắt thành từng đoạn
+        working += duration_s * SAMPLE_RATE * 4 / 2**20
+    return working
+
+def record_memory_underestimate(model_name):
+    """
+    Tăng hệ số ước lượng bộ nhớ của mô hình sau khi gặp lỗi hết bộ nhớ dù đã được tiếp nhận.
+    """
+    scale = min(_memory_scale.get(model_name, 1.0) * 1.25, 4.0)
+    _memory_scale[model_name] = scale
+    logger.warning(f"Tăng hệ số ước lượng bộ nhớ của {model_name} lên {scale:.2f}")
+
+def plan_transcription(duration_s, mode="transcribe", model_name=None):
+    """
+    Chọn cách chạy request trong ngân sách bộ nhớ: ưu tiên mô hình chính, sau đó mới
+    hạ cấp sang mô hình nhỏ hơn rồi đến phiên âm chia đoạn.
+    
+    Args:
+        duration_s (float): Thời lượng audio (giây)
+        mode (str): "transcribe" hoặc "align"
+        model_name (str): Mô hình muốn dùng thay cho mô hình chính (VD: mô hình nháp)
+        
+    Returns:
+        dict hoặc None: {"model": tên mô hình, "chunked": có chia đoạn không,
+                         "memory_mb": bộ nhớ làm việc, "load_mb": bộ nhớ để tải mô hình nếu chưa tải,
+                         "degraded": có phải hạ cấp không}; None nếu không cách nào vừa ngân sách
+    """
+    admission = get_admission()
+    primary = model_name or _model_name or PRIMARY_MODEL_NAME
+    candidates = [(primary, False), (FALLBACK_MODEL_NAME, False), (primary, True), (FALLBACK_MODEL_NAME, True)]
+    
+    seen = set()
+    for candidate, chunked in candidates:
+        if (candidate, chunked) in seen:
+            continue
+        seen.add((candidate, chunked))
+        
+        memory_mb = estimate_request_memory(duration_s, candidate, _device, chunked)
+        loaded = candidate in (_model_name or PRIMARY_MODEL_NAME, *_extra_models)
+        load_mb = 0 if loaded else model_weights_mb(candidate)
+        if admission.can_ever_fit(memory_mb + load_mb):
+            return {
+                "model": candidate,
+                "chunked": chunked,
+                "memory_mb": memory_mb,
+                "load_mb": load_mb,
+                "degraded": (candidate, chunked) != (primary, False),
+            }
+    return None
+
+def probe_audio_duration(audio_path):
+    """
+    Đọc thời lượng file audio/video bằng ffprobe (không giải mã).
+    
+    Returns:
+        float: Thời lượng (giây), PROBE_FALLBACK_SECONDS nếu không đọc được
+    """
+    cmd = [
+        "ffprobe", "-v", "error",
+        "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1",
+        str(audio_path)
+    ]
+    try:
+        proc = subprocess.run(cmd, capture_output=True, check=True, text=True, timeout=30)
+        return float(proc.stdout.strip())
+    except Exception as e:
+        logger.warning(f"Không thể đọc thời lượng {audio_path}, giả định {PROBE_FALLBACK_SECONDS}s: {str(e)}")
+        return float(PROBE_FALLBACK_SECONDS)
+
+def probe_media(media_path):
+    """
+    Đọc thông tin các luồng của file audio/video bằng ffprobe (không giải mã).
+    
+    Args:
+        media_path: Đường dẫn file
+        
+    Returns:
+        dict: {"duration": thời lượng luồng âm thanh đầu tiên hoặc của file (giây, None nếu không rõ),
+               "audio": danh sách luồng âm thanh {"index", "codec_name"},
+               "has_video": có luồng hình hay không}
+        
+    Raises:
+        subprocess.CalledProcessError: Nếu ffprobe không đọc được file
+    """
+    cmd = [
+        "ffprobe", "-v", "error",
+        "-show_entries", "format=duration:stream=index,codec_type,codec_name,duration",
+        "-of", "json",
+        str(media_path)
+    ]
+    proc = subprocess.run(cmd, capture_output=True, check=True, text=True, timeout=60)
+    info = json.loads(proc.stdout or "{}")
+    streams = info.get("streams", [])
+    audio = [stream for stream in streams if stream.get("codec_type") == "audio"]
+    
+    duration = None
+    for value in ([audio[0].get("duration")] if audio else []) + [info.get("format", {}).get("duration")]:
+        try:
+            duration = float(value)
+            break
+        except (TypeError, ValueError):
+            continue
+    
+    return {
+        "duration": duration,
+        "audio": [{"index": stream["index"], "codec_name": stream.get("codec_name")} for stream in audio],
+        "has_video": any(stream.get("codec_type") == "video" for stream in streams),
+    }
+
+def upload_source_path(upload):
+    """
+    Trả về đường dẫn đọc trực tiếp file upload đã được Starlette spool ra đĩa,
+    để ffmpeg tách âm thanh mà không phải chép cả video vào TEMP_DIR.
+    
+    Returns:
+        str hoặc None: Đường dẫn /proc/<pid>/fd/<fd>, None nếu không dùng được
+    """
+    try:
+        upload.file.flush()
+        source = f"/proc/{os.getpid()}/fd/{upload.file.fileno()}"
+    except Exception:
+        return None
+    return source if os.path.exists(source) else None
+
+def extract_audio_track(source_path, media, max_duration=None):
+    """
+    Tách luồng âm thanh đầu tiên ra file riêng: chép nguyên luồng nếu codec cho phép,
+    nếu không thì chỉ giải mã luồng âm thanh thành WAV mono 16kHz.
+    
+    Args:
+        source_path: Đường dẫn file nguồn (audio hoặc video)
+        media (dict): Kết quả của probe_media
+        max_duration (float): Nếu có, chỉ lấy max_duration giây đầu
+        
+    Returns:
+        tuple: (đường dẫn file âm thanh trong TEMP_DIR, thời lượng giây)
+    """
+    stream = media["audio"][0]
+    container = AUDIO_COPY_CONTAINERS.get(stream["codec_name"])
+    base_cmd = [
+        "ffmpeg", "-nostdin", "-v", "error", "-y",
+        "-i", str(source_path),
+        "-map", f"0:{stream['index']}", "-vn", "-sn", "-dn"
+    ]
+    if max_duration:
+        base_cmd += ["-t", f"{max_duration:.3f}"]
+    
+    start_time = time.time()
+    output_path = None
+    if container:
+        output_path = TEMP_DIR / f"{uuid.uuid4()}.{container}"
+        try:
+            subprocess.run(base_cmd + ["-c:a", "copy", str(output_path)], capture_output=True, check=True)
+        except subprocess.CalledProcessError as e:
+            logger.warning(f"Không thể chép nguyên luồng {stream['codec_name']}, chuyển sang giải mã: {e.stderr.decode(errors='ignore').strip()}")
+            output_path.unlink(missing_ok=True)
+            output_path = None
+    
+    if output_path is None:
+        output_path = TEMP_DIR / f"{uuid.uuid4()}.wav"
+        subprocess.run(
+            base_cmd + ["-ac", "1", "-ar", str(SAMPLE_RATE), "-c:a", "pcm_s16le", str(output_path)],
+            capture_output=True, check=True
+        )
+    
+    duration = media["duration"]
+    if duration is None:
+        duration = probe_audio_duration(output_path)
+    if max_duration:
+        duration = min(duration, max_duration)
+    
+    logger.info(
+        f"Đã tách luồng âm thanh {stream['codec_name']} -> {output_path.name} "
+        f"({output_path.stat().st_size / 2**20:.1f} MB, {duration:.0f}s) trong {time.time() - start_time:.2f}s"
+    )
+    return output_path, duration
+
+class IngestError(ValueError):
+    """
+    File upload không dùng được, kèm mã HTTP trả về cho client.
+    """
+    
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+def ingest_upload(upload, file_ext, job_id, max_duration=None):
+    """
+    Giai đoạn tiếp nhận: lưu file upload, đọc các luồng, tách luồng âm thanh (cắt theo max_duration)
+    rồi chuyển audio vào thư mục dữ liệu của job. Chạy trên executor tiếp nhận.
+    
+    Args:
+        upload (UploadFile): File được upload
+        file_ext (str): Phần mở rộng của file (đã kiểm tra)
+        job_id (str): Id job, dùng làm tên file audio
+        max_duration (float): Nếu có, chỉ xử lý max_duration giây đầu
+        
+    Returns:
+        tuple: (đường dẫn audio của job, thời lượng (giây), sha256 của audio)
+        
+    Raises:
+        IngestError: File không đọc được, không có âm thanh hoặc quá dài
+    """
+    # Với video: đọc thẳng file upload đã spool, không chép cả video vào TEMP_DIR
+    temp_file = None
+    audio_sha256 = None
+    source_path = upload_source_path(upload) if file_ext in VIDEO_FORMATS else None
+    if source_path is None:
+        # Lưu file tạm thời, băm nội dung ngay khi nhận
+        suffix = f".{file_ext}"
+        with NamedTemporaryFile(delete=False, suffix=suffix, dir=TEMP_DIR) as temp:
+            temp_file = Path(temp.name)
+            audio_sha256 = copy_file_sha256(upload.file, temp)
+        source_path = temp_file
+    
+    try:
+        # Đọc các luồng và thời lượng trước khi làm gì nặng
+        try:
+            media = probe_media(source_path)
+        except Exception as e:
+            if file_ext in VIDEO_FORMATS:
+                raise IngestError(f"Không thể đọc file video {upload.filename}: {str(e)}")
+            logger.warning(f"Không thể đọc thông tin file {upload.filename}: {str(e)}")
+            media = None
+        
+        if media is not None and not media["audio"]:
+            raise IngestError(f"File {upload.filename} không có luồng âm thanh")
+        
+        audio_duration = media["duration"] if media and media["duration"] else probe_audio_duration(source_path)
+        if audio_duration > MAX_AUDIO_SECONDS and not (max_duration and max_duration <= MAX_AUDIO_SECONDS):
+            raise IngestError(
+                f"File dài {audio_duration:.0f}s, vượt giới hạn {MAX_AUDIO_SECONDS:.0f}s. "
+                f"Dùng max_duration để chỉ xử lý phần đầu",
+                status_code=413
+            )
+        
+        # Chỉ giữ lại luồng âm thanh (và cắt theo max_duration) để thời gian và dung lượng chỉ phụ thuộc vào audio
+        trim_needed = bool(max_duration) and audio_duration > max_duration
+        if media is not None and (media["has_video"] or trim_needed):
+            audio_file, audio_duration = extract_audio_track(
+                source_path, media, max_duration if trim_needed else None
+            )
+            if temp_file is not None:
+                temp_file.unlink(missing_ok=True)
+            temp_file = audio_file
+            audio_sha256 = None
+        elif temp_file is None:
+            # Video chỉ có luồng âm thanh (VD: TTS trong mp4) và không cần cắt: chép nguyên file như audio thường
+            with NamedTemporaryFile(delete=False, suffix=f".{file_ext}", dir=TEMP_DIR) as temp:
+                temp_file = Path(temp.name)
+                with open(source_path, "rb") as source:
+                    audio_sha256 = copy_file_sha256(source, temp)
+    except Exception:
+        if temp_file is not None:
+            temp_file.unlink(missing_ok=True)
+        raise
+    
+    # Giữ audio trong thư mục dữ liệu bền vững để job chạy lại được nếu server khởi động lại
+    if audio_sha256 is None:
+        audio_sha256 = file_sha256(temp_file)
+    job_audio = JOB_AUDIO_DIR / f"{job_id}{temp_file.suffix}"
+    shutil.move(str(temp_file), job_audio)
+    return job_audio, audio_duration, audio_sha256
 
 def get_model(force_cpu=False):
     """
@@ -47,7 +1000,7 @@ def get_model(force_cpu=False):
     Returns:
         model: Mô hình đã tải
     """
-    global _model, _device
+    global _model, _model_name, _device
     
     # Kiểm tra nếu mô hình đã được tải
     if _model is not None:
@@ -63,47 +1016,306 @@ def get_model(force_cpu=False):
     
     # Tải mô hình đơn giản
     try:
-        _model = stable_whisper.load_model("large-v3", device=_device)
-        logger.info(f"Đã tải mô hình large-v3 trên {_device}")
+        _model = prepare_model(stable_whisper.load_model(PRIMARY_MODEL_NAME, device=_device), PRIMARY_MODEL_NAME)
+        _model_name = PRIMARY_MODEL_NAME
+        logger.info(f"Đã tải mô hình {PRIMARY_MODEL_NAME} trên {_device}")
     except Exception as e:
-        logger.warning(f"Không thể tải mô hình large-v3: {str(e)}")
-        logger.info("Thử tải mô hình turbo...")
-        _model = stable_whisper.load_model("turbo", device=_device)
-        logger.info("Đã tải mô hình turbo")
+        logger.warning(f"Không thể tải mô hình {PRIMARY_MODEL_NAME}: {str(e)}")
+        logger.info(f"Thử tải mô hình {FALLBACK_MODEL_NAME}...")
+        _model = prepare_model(stable_whisper.load_model(FALLBACK_MODEL_NAME, device=_device), FALLBACK_MODEL_NAME)
+        _model_name = FALLBACK_MODEL_NAME
+        logger.info(f"Đã tải mô hình {FALLBACK_MODEL_NAME}")
+    
+    get_admission().set_resident("primary", model_weights_mb(_model_name))
     
     return _model
 
-@app.on_event("startup")
-async def startup_event():
+def get_model_by_name(model_name):
     """
-    Khởi tạo tài nguyên khi server bắt đầu.
+    Trả về mô hình theo tên: mô hình chính nếu trùng tên, nếu không thì tải (một lần)
+    mô hình phụ trên cùng thiết bị. Gọi từ thread, không phải event loop.
     """
-    # Tạo thư mục nếu chưa tồn tại
-    TEMP_DIR.mkdir(exist_ok=True)
-    OUTPUTS_DIR.mkdir(exist_ok=True)
+    if _model is not None and model_name == _model_name:
+        return _model
+    if model_name not in _extra_models:
+        logger.info(f"Tải mô hình phụ {model_name} trên {_device}...")
+        _extra_models[model_name] = prepare_model(
+            stable_whisper.load_model(model_name, device=_device), model_name, warmup=False
+        )
+        logger.info(f"Đã tải mô hình phụ {model_name}")
+    return _extra_models[model_name]
+
+def hold_model(model):
+    """
+    Đánh dấu một request đang dùng mô hình, để việc thay mô hình chờ request đó xong mới giải phóng.
+    """
+    _model_users[id(model)] = _model_users.get(id(model), 0) + 1
+    return model
+
+def release_model(model):
+    count = _model_users.get(id(model), 0) - 1
+    if count > 0:
+        _model_users[id(model)] = count
+    else:
+        _model_users.pop(id(model), None)
+
+async def swap_primary_model(event, model_name):
+    """
+    Tải mô hình mới ở nền trong khi mô hình cũ vẫn phục vụ, thay mô hình chính một lần
+    (request mới dùng ngay mô hình mới), chờ các request đang dùng mô hình cũ xong rồi giải phóng nó.
     
-    # Khởi tạo mô hình trước để giảm thời gian chờ cho request đầu tiên
+    Args:
+        event (dict): Bản ghi sự kiện trong _swap_events, được cập nhật trạng thái và thời gian
+        model_name (str): Tên mô hình hoặc đường dẫn checkpoint
+    """
+    global _model, _model_name
+    admission = get_admission()
+    weights_mb = model_weights_mb(model_name)
     try:
-        get_model()
-        logger.info("Đã khởi tạo mô hình sẵn sàng")
+        # Trọng số mô hình mới được tính vào ngân sách ngay khi bắt đầu tải
+        admission.set_resident("swap", weights_mb)
+        load_start = time.time()
+        if model_name in _extra_models:
+            new_model = _extra_models.pop(model_name)
+            admission.drop_resident(model_name)
+            logger.info(f"Dùng mô hình phụ {model_name} đã tải làm mô hình chính")
+        else:
+            logger.info(f"Tải mô hình {model_name} trên {_device} ở nền, mô hình {_model_name} vẫn phục vụ...")
+            new_model = await run_in_threadpool(
+                lambda: prepare_model(stable_whisper.load_model(model_name, device=_device), model_name)
+            )
+        event["load_seconds"] = round(time.time() - load_start, 2)
+        
+        # Thay mô hình chính: các request sau đó dùng mô hình mới
+        old_model, old_name = _model, _model_name
+        _model, _model_name = new_model, model_name
+        event["status"] = "draining"
+        event["swapped_at"] = time.time()
+        logger.info(f"Đã thay mô hình chính {old_name} -> {model_name} (tải {event['load_seconds']}s)")
+        
+        # Chờ các request đang dùng mô hình cũ hoàn tất
+        drain_start = time.time()
+        while old_model is not None and _model_users.get(id(old_model), 0) > 0:
+            await asyncio.sleep(0.5)
+        event["drain_seconds"] = round(time.time() - drain_start, 2)
+        
+        # Giải phóng mô hình cũ, chuyển phần bộ nhớ của mô hình mới sang "primary"
+        if old_model is not None:
+            _model_locks.pop(id(old_model), None)
+            del old_model
+        import gc
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        admission.set_resident("primary", weights_mb)
+        admission.drop_resident("swap")
+        
+        event["status"] = "done"
+        event["released_at"] = time.time()
+        logger.info(f"Đã giải phóng mô hình {old_name} sau {event['drain_seconds']}s chờ request đang chạy")
     except Exception as e:
-        logger.error(f"Không thể khởi tạo mô hình: {str(e)}")
+        admission.drop_resident("swap")
+        event["status"] = "failed"
+        event["error"] = str(e)
+        logger.error(f"Không thể thay mô hình sang {model_name}: {str(e)}")
 
-@app.on_event("shutdown")
-async def shutdown_event():
+def run_with_model_lock(model, fn, *args, **kwargs):
     """
-    Dọn dẹp tài nguyên khi server tắt.
+    Chạy fn với khóa riêng của mô hình: whisper gắn hook kv-cache lên chính mô hình
+    nên hai request không được chạy đồng thời trên cùng một mô hình.
     """
-    # Xóa các file tạm
-    for file in TEMP_DIR.glob("*"):
-        try:
-            file.unlink()
-        except Exception as e:
-            logger.error(f"Không thể xóa file tạm {file}: {str(e)}")
+    lock = _model_locks.setdefault(id(model), threading.Lock())
+    with lock, inference_context():
+        return fn(*args, **kwargs)
+
+def inference_context():
+    """
+    Ngữ cảnh chạy mô hình: torch.inference_mode (không theo dõi autograd, không đếm version tensor) nếu bật.
+    """
+    return torch.inference_mode() if TORCH_INFERENCE_MODE else contextlib.nullcontext()
+
+def enable_compile_cache():
+    """
+    Lưu artifact đã compile (FX graph của inductor, kernel triton) vào COMPILE_CACHE_DIR
+    để lần khởi động sau không phải compile lại từ đầu.
+    """
+    COMPILE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", str(COMPILE_CACHE_DIR / "inductor"))
+    os.environ.setdefault("TRITON_CACHE_DIR", str(COMPILE_CACHE_DIR / "triton"))
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except Exception as e:
+        logger.warning(f"Không thể bật cache FX graph của inductor: {str(e)}")
+
+def compile_model(model):
+    """
+    Bọc các module trong TORCH_COMPILE_TARGETS của mô hình bằng torch.compile (compile khi chạy lần đầu).
+    
+    Returns:
+        dict: Tên module -> module gốc, để khôi phục nếu compile thất bại
+    """
+    if not hasattr(torch, "compile"):
+        logger.warning("Phiên bản torch không hỗ trợ torch.compile, chạy chế độ eager")
+        return {}
+    
+    enable_compile_cache()
+    originals = {}
+    for target in TORCH_COMPILE_TARGETS:
+        module = getattr(model, target, None)
+        if not isinstance(module, torch.nn.Module):
+            logger.warning(f"Mô hình không có module {target} để compile")
+            continue
+        originals[target] = module
+        setattr(model, target, torch.compile(module, mode=TORCH_COMPILE_MODE, dynamic=True))
+    return originals
+
+def count_result_tokens(result):
+    return sum(len(segment.tokens or []) for segment in result.segments)
+
+def record_tokens_per_second(tokens, seconds):
+    """
+    Cập nhật tốc độ suy luận (tokens/giây, tính cả giải mã audio và nhóm từ).
+    """
+    if tokens <= 0 or seconds <= 0:
+        return None
+    speed = tokens / seconds
+    previous = _accel_stats["tokens_per_second"]
+    _accel_stats["tokens_per_second"] = round(speed if previous is None else 0.8 * previous + 0.2 * speed, 2)
+    _accel_stats["last_tokens_per_second"] = round(speed, 2)
+    return speed
+
+def warm_up_model(model, model_name, durations):
+    """
+    Chạy mô hình trên audio giả ở các độ dài thường gặp để compile/khởi tạo kernel trước khi nhận request.
+    Khi compile được bật, mỗi độ dài chạy 2 lần: lần đầu gồm cả thời gian compile, lần sau là tốc độ ổn định.
+    """
+    rng = np.random.default_rng(0)
+    runs = 2 if _accel_stats["compile"]["targets"] else 1
+    for seconds in durations:
+        audio = (rng.standard_normal(int(seconds * SAMPLE_RATE)) * 0.01).astype(np.float32)
+        timings = []
+        tokens = 0
+        for _ in range(runs):
+            start_time = time.time()
+            with inference_context():
+                result = model.transcribe(audio, language="vi", word_timestamps=True, vad=False, verbose=None)
+            timings.append(time.time() - start_time)
+            tokens = count_result_tokens(result)
+        entry = {
+            "model": model_name,
+            "seconds": seconds,
+            "first_run": round(timings[0], 2),
+            "steady_run": round(timings[-1], 2),
+            "compile_overhead": round(max(timings[0] - timings[-1], 0.0), 2) if runs > 1 else None,
+            "tokens_per_second": round(tokens / timings[-1], 2) if tokens and timings[-1] > 0 else None,
+        }
+        _accel_stats["warmup"].append(entry)
+        logger.info(
+            f"Warm-up {model_name} với {seconds:.0f}s audio: lần đầu {entry['first_run']}s, "
+            f"ổn định {entry['steady_run']}s"
+            + (f", compile {entry['compile_overhead']}s" if entry["compile_overhead"] is not None else "")
+        )
+
+def prepare_model(model, model_name, warmup=True):
+    """
+    Áp dụng đường chạy tăng tốc cho mô hình vừa tải: compile (nếu bật) và warm-up.
+    Nếu compile lỗi (VD: thiếu trình biên dịch C++ trên CPU), khôi phục module gốc và chạy eager.
+    
+    Args:
+        model: Mô hình vừa tải
+        model_name (str): Tên mô hình
+        warmup (bool): Chạy warm-up đầy đủ theo WARMUP_DURATIONS (nếu MODEL_WARMUP bật)
+        
+    Returns:
+        model: Chính mô hình đó
+    """
+    originals = compile_model(model) if TORCH_COMPILE else {}
+    _accel_stats["compile"]["targets"] = list(originals)
+    
+    # Khi compile, luôn chạy ít nhất một lần ngắn để phát hiện lỗi compile trước khi nhận request
+    durations = WARMUP_DURATIONS if warmup and MODEL_WARMUP else (WARMUP_DURATIONS[:1] if originals else ())
+    if not durations:
+        return model
+    
+    start_time = time.time()
+    try:
+        warm_up_model(model, model_name, durations)
+        if originals:
+            _accel_stats["compile"]["compile_seconds"] = round(sum(
+                entry["compile_overhead"] or 0.0 for entry in _accel_stats["warmup"] if entry["model"] == model_name
+            ), 2)
+        logger.info(f"Đã chuẩn bị mô hình {model_name} trong {time.time() - start_time:.2f}s")
+    except Exception as e:
+        if not originals:
+            logger.warning(f"Warm-up mô hình {model_name} thất bại: {str(e)}")
+            return model
+        logger.error(f"torch.compile thất bại, chạy chế độ eager: {str(e)}")
+        for target, module in originals.items():
+            setattr(model, target, module)
+        _accel_stats["compile"]["targets"] = []
+        _accel_stats["compile"]["error"] = str(e)
+    return model
+
+@app.on_event("startup")
+async def startup_event():
+    """
+    Khởi tạo tài nguyên khi server bắt đầu.
+    """
+    setup_logging()
+    
+    # Tạo thư mục nếu chưa tồn tại
+    TEMP_DIR.mkdir(exist_ok=True)
+    OUTPUTS_DIR.mkdir(exist_ok=True)
+    
+    # Khởi tạo mô hình trước để giảm thời gian chờ cho request đầu tiên
+    try:
+        get_model()
+        logger.info("Đã khởi tạo mô hình sẵn sàng")
+    except Exception as e:
+        logger.error(f"Không thể khởi tạo mô hình: {str(e)}")
+    
+    # Mở kho trạng thái và chạy lại các job bị gián đoạn
+    global _heartbeat_task, _retention_task, REPLICA_ID, _replica_id_file
+    if not REPLICA_ID:
+        REPLICA_ID, _replica_id_file = load_replica_id()
+    init_store()
+    for job_id in claim_interrupted_jobs():
+        logger.info(f"Khôi phục job bị gián đoạn {job_id}")
+        start_resume_job(job_id)
+    _heartbeat_task = asyncio.create_task(job_heartbeat_loop())
+    _retention_task = asyncio.create_task(store_retention_loop())
+    logger.info(f"Kho trạng thái: {STATE_DB_PATH} (replica {REPLICA_ID})")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """
+    Dọn dẹp tài nguyên khi server tắt.
+    """
+    # Xóa các file tạm
+    for file in TEMP_DIR.glob("*"):
+        try:
+            file.unlink()
+        except Exception as e:
+            logger.error(f"Không thể xóa file tạm {file}: {str(e)}")
+    
+    if _heartbeat_task is not None:
+        _heartbeat_task.cancel()
+    if _retention_task is not None:
+        _retention_task.cancel()
     
     # Giải phóng mô hình để giải phóng bộ nhớ
-    global _model
+    global _model, _model_name, _admission
     _model = None
+    _model_name = None
+    _extra_models.clear()
+    _model_locks.clear()
+    _model_users.clear()
+    _admission = None
+    for stage in _stages.values():
+        stage.executor.shutdown(wait=False, cancel_futures=True)
+    _stages.clear()
     
     # Gọi garbage collector
     import gc
@@ -113,6 +1325,7 @@ async def shutdown_event():
         torch.cuda.empty_cache()
     
     logger.info("Đã dọn dẹp tài nguyên")
+    stop_logging()
 
 @app.get("/")
 async def root():
@@ -124,441 +1337,2432 @@ async def root():
         "description": "API phiên âm âm thanh sử dụng stable-ts",
         "endpoints": {
             "/transcribe": "POST - Phiên âm file âm thanh sang ASS subtitle",
-            "/download/{filename}": "GET - Tải file kết quả"
+            "/download/{filename}": "GET - Tải file kết quả",
+            "/capacity": "GET - Độ dài hàng đợi, thời gian chờ ước lượng và việc đang chạy",
+            "/profiles/{id}": "GET - Profile của request đã bật profiling (header X-Profile)",
+            "/jobs/{job_id}": "GET - Trạng thái và phiên bản mới nhất của job nháp/tinh chỉnh",
+            "/jobs/{job_id}/events": "GET - Server-Sent Events mỗi khi job có phiên bản mới",
+            "/admin/model": "POST - Thay mô hình không gián đoạn (model_name), GET - Trạng thái và lịch sử thay mô hình"
         },
         "features": {
             "rounded_corners": "Bo góc cho phụ đề ASS",
             "word_level": "Highlight từng từ khi phát âm",
+            "trim_silence": "Cắt khoảng lặng dài trước khi phiên âm, timestamp được đưa về dòng thời gian gốc",
+            "regroup_spec": "Ghi đè cấu hình nhóm từ (dấu câu, khoảng lặng, độ dài) theo từng request dạng JSON",
+            "response_fields": "Chọn trường trả về (fields), dạng cột (response_format=columnar) và timestamp từng từ (include_words)",
+            "align_mode": "mode=align: căn chỉnh thời gian theo kịch bản có sẵn (script_text) thay vì phiên âm",
+            "memory_admission": "Ước lượng bộ nhớ theo thời lượng audio, xếp hàng khi vượt ngân sách, hạ cấp mô hình/chia đoạn có ghi log",
+            "scheduling": "Việc ngắn chạy trước, có aging để việc dài vẫn đến lượt và tham số priority",
+            "acceleration": "torch.inference_mode, torch.compile tùy chọn (TORCH_COMPILE=1) với cache trên đĩa, warm-up và báo cáo tokens/giây",
+            "job_store": "Job, transcript và file kết quả lưu trong SQLite (WAL): khôi phục job khi khởi động lại, dùng chung giữa các replica",
+            "draft_refine": "draft=true: trả ngay bản nháp bằng mô hình nhỏ, tinh chỉnh bằng mô hình chính ở nền (phiên bản mới cùng job id)",
+            "profiling": "Header X-Profile: 1 (hoặc torch) hoặc PROFILE_SAMPLE_RATE để lấy profile của request",
+            "video_ingest": "Video chỉ được tách luồng âm thanh (chép nguyên luồng nếu được), giới hạn/cắt theo max_duration",
+            "transcript_edits": "POST /jobs/{id}/edits: sửa từ/dòng phụ đề và tạo lại chỉ các event ASS thay đổi",
+            "single_flight": "Upload giống hệt nhau đang xử lý (n8n thử lại, nhánh song song) chỉ chạy mô hình một lần, mỗi request vẫn có file ASS theo style riêng",
+            "pipeline": "Tiếp nhận, suy luận và render chạy trên các executor riêng, xem độ bận từng giai đoạn ở /capacity",
             "max_lines": "Giới hạn 1 dòng subtitle",
             "supported_audio": ["mp3", "wav", "m4a", "ogg", "flac", "mp4", "avi", "mkv"]
         },
         "version": "1.1.0"
     }
 
-@app.post("/transcribe")
-async def transcribe_audio(
-    file: UploadFile = File(...),
-    use_cpu: bool = Form(False),
-    simple_response: bool = Form(False),
-    
-    # Tham số cho ASS
-    font: str = Form("Montserrat"),
-    font_size: int = Form(124),  # Tăng font size từ 80 lên 124
-    highlight_color: str = Form('EDA005'),
-    border_radius: int = Form(24),
-    
-    # Các tham số định dạng ASS
-    background_color: str = Form('80000000'),
-    primary_color: str = Form('EDA005'),
-    outline_color: str = Form('000000'),
-    outline: int = Form(3),
-    shadow: int = Form(3),
-    alignment: int = Form(2),
-    margin_l: int = Form(20),
-    margin_r: int = Form(20),
-    margin_v: int = Form(120),  # Tăng margin_v để đưa subtitle xuống thấp hơn
-    encoding: int = Form(163)
-):
+@app.get("/capacity")
+async def capacity():
     """
-    API endpoint để phiên âm file audio thành ASS subtitle.
+    Trả về tình trạng tải hiện tại để client (VD: n8n) có thể phân tải hoặc hoãn việc.
+    """
+    return {
+        "device": _device,
+        "model": _model_name,
+        **get_admission().snapshot(),
+        "stages": {name: get_stage(name).snapshot() for name in ("ingest", "inference", "render")},
+        "single_flight": get_single_flight().snapshot(),
+    }
+
+async def run_planned_transcription(plan, audio_path, audio_duration, mode, script_text=None, trim_silence=False,
+                                    priority=0, profiler=None, label="", ticket=None):
+    """
+    Giai đoạn suy luận theo kế hoạch của plan_transcription: chờ lượt trong bộ kiểm soát tiếp nhận,
+    giải mã audio trên executor tiếp nhận, lấy mô hình rồi chạy trên executor suy luận với khóa của mô hình.
+    Audio chỉ được giải mã sau khi được tiếp nhận để các request đang xếp hàng không giữ PCM ngoài ngân sách.
+    Lượt được trả ngay khi mô hình chạy xong để request sau suy luận trong khi request này còn ở giai đoạn render.
     
     Args:
-        file (UploadFile): File audio cần phiên âm
-        use_cpu (bool): Sử dụng CPU thay vì GPU
-        simple_response (bool): Tùy chọn phản hồi đơn giản hơn
-        
-        # Tham số cho ASS
-        font (str): Tên font chữ
-        font_size (int): Kích thước font
-        highlight_color (str): Màu highlight cho từng từ, định dạng BGR
-        border_radius (int): Bán kính bo góc
-        
-        # Các tham số định dạng ASS
-        background_color (str): Màu nền dạng AABBGGRR
-        primary_color (str): Màu chữ chính
-        outline_color (str): Màu viền
-        outline (int): Độ dày viền
-        shadow (int): Độ đậm bóng
-        alignment (int): Vị trí căn chỉnh phụ đề
-        margin_l (int): Lề trái
-        margin_r (int): Lề phải
-        margin_v (int): Lề dọc
-        encoding (int): Mã hóa ký tự
+        plan (dict): Kết quả của plan_transcription
+        audio_path: Đường dẫn file audio của job
+        audio_duration (float): Thời lượng audio (giây)
+        mode (str): "transcribe" hoặc "align"
+        script_text (str): Kịch bản khi mode="align"
+        trim_silence (bool): Cắt khoảng lặng trước khi phiên âm (prepare_audio_input)
+        priority (int): Độ ưu tiên khi xếp hàng
+        profiler (RequestProfiler): Profiler của request nếu có
+        label (str): Tên file dùng trong log
+        ticket (dict): Vé xếp hàng truyền cho MemoryAdmission.acquire
         
     Returns:
-        Kết quả phiên âm dưới dạng ASS subtitle với giới hạn 1 dòng
+        tuple: (WhisperResult thô - cần finalize_result, timeline cắt khoảng lặng hoặc None,
+                thời gian xử lý (giây), chế độ thực tế đã chạy)
     """
+    if plan["chunked"] and mode == "align":
+        logger.warning("Không đủ bộ nhớ để căn chỉnh toàn bộ audio một lần, chuyển sang phiên âm chia đoạn")
+        mode = "transcribe"
     
-    # Ghi log request
-    logger.info(f"Nhận yêu cầu phiên âm file: {file.filename}, use_cpu: {use_cpu}")
-    
-    # Kiểm tra định dạng file
-    supported_formats = ["mp3", "wav", "m4a", "ogg", "flac", "mp4", "avi", "mkv"]
-    file_ext = file.filename.split(".")[-1].lower()
-    
-    if file_ext not in supported_formats:
-        return JSONResponse(
-            status_code=400,
-            content={
-                "error": f"Định dạng file không được hỗ trợ. Các định dạng hỗ trợ: {', '.join(supported_formats)}"
-            }
+    # Chờ đến lượt (việc ngắn trước, có aging và ưu tiên) và đến khi ngân sách bộ nhớ cho phép
+    admission = get_admission()
+    reserved_mb = plan["memory_mb"] + plan["load_mb"]
+    if admission.available_mb < reserved_mb or admission.queue_depth or admission.in_flight >= admission.max_in_flight:
+        logger.info(
+            f"Xếp hàng: file {audio_duration:.0f}s, ưu tiên {priority}, cần {reserved_mb:.0f} MB, "
+            f"còn trống {admission.available_mb:.0f} MB, {admission.in_flight} đang chạy, "
+            f"{admission.queue_depth} request đang chờ"
         )
+    job = await admission.acquire(reserved_mb, duration_s=audio_duration, priority=priority, ticket=ticket)
+    logger.info(f"Bắt đầu xử lý sau {job['started_at'] - job['enqueued_at']:.2f}s chờ")
     
+    inference = get_stage("inference")
+    model = None
     try:
-        # Lưu file tạm thời
-        suffix = f".{file_ext}"
-        with NamedTemporaryFile(delete=False, suffix=suffix, dir=TEMP_DIR) as temp:
-            temp_file = Path(temp.name)
-            shutil.copyfileobj(file.file, temp)
-        
-        # Lấy model (với CPU nếu yêu cầu)
-        model = get_model(force_cpu=use_cpu)
-        
+        # Giải mã và cắt khoảng lặng trên executor tiếp nhận, bộ nhớ của PCM đã nằm trong phần được cấp
+        audio_input, timeline = await get_stage("ingest").run(
+            prepare_audio_input if profiler is None else profiler.wrap(prepare_audio_input),
+            audio_path, trim_silence
+        )
+    
+        if plan["load_mb"]:
+            # Trọng số mô hình phụ chuyển từ phần cấp cho request sang phần cố định
+            model = hold_model(await inference.run(get_model_by_name, plan["model"]))
+            admission.set_resident(plan["model"], plan["load_mb"])
+            admission.shrink(job, plan["load_mb"])
+        else:
+            if plan["model"] != _model_name and plan["model"] not in _extra_models:
+                # Mô hình chính đã được thay trong lúc chờ
+                logger.info(f"Mô hình {plan['model']} đã được thay, dùng mô hình chính {_model_name}")
+                plan["model"] = _model_name
+            model = hold_model(get_model_by_name(plan["model"]))
+    
         # Thực hiện phiên âm
-        logger.info(f"Bắt đầu phiên âm file {file.filename}...")
+        logger.info(f"Bắt đầu phiên âm file {label} với mô hình {plan['model']}...")
         start_time = time.time()
-        
+    
         # Sử dụng phương pháp đơn giản theo hướng dẫn từ stable-ts
+        align_fn, transcribe_fn = align_audio_input, transcribe_audio_input
+        if profiler is not None:
+            align_fn = profiler.wrap(align_fn, torch_ops=True)
+            transcribe_fn = profiler.wrap(transcribe_fn, torch_ops=True)
         try:
-            result = process_audio_with_attention_mask(model, temp_file, language="vi")
+            if mode == "align":
+                result = await inference.run(
+                    run_with_model_lock, model, align_fn,
+                    model, audio_input, script_text, language="vi"
+                )
+            else:
+                result = await inference.run(
+                    run_with_model_lock, model, transcribe_fn,
+                    model, audio_input,
+                    chunk_seconds=CHUNK_SECONDS if plan["chunked"] else None
+                )
         except Exception as e:
             logger.error(f"Không thể phiên âm: {str(e)}")
             raise
+        del audio_input
+    finally:
+        admission.release(job)
+        if model is not None:
+            release_model(model)
+    
+    process_time = time.time() - start_time
+    admission.record_service_time(audio_duration, process_time)
+    logger.info(f"Thời gian xử lý: {process_time:.2f} giây, với thiết bị: {_device}")
+    
+    tokens_per_second = record_tokens_per_second(count_result_tokens(result), process_time)
+    if tokens_per_second is not None:
+        logger.info(f"Tốc độ suy luận: {tokens_per_second:.1f} tokens/giây")
+    
+    return result, timeline, process_time, mode
+
+def get_db():
+    """
+    Trả về kết nối SQLite của thread hiện tại (mỗi thread một kết nối, chế độ WAL để
+    nhiều replica trên cùng máy đọc/ghi song song).
+    """
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(STATE_DB_PATH, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        _db_local.conn = conn
+    return conn
+
+def init_store():
+    """
+    Tạo các bảng của kho trạng thái nếu chưa có và áp dụng chính sách lưu giữ (prune_store).
+    """
+    db = get_db()
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            filename TEXT,
+            version INTEGER NOT NULL DEFAULT 0,
+            owner TEXT,
+            heartbeat_at REAL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            audio_path TEXT,
+            audio_sha256 TEXT,
+            request TEXT,
+            error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status);
+        CREATE TABLE IF NOT EXISTS results (
+            job_id TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            model TEXT,
+            output_filename TEXT,
+            processing_time REAL,
+            created_at REAL,
+            columns BLOB,
+            PRIMARY KEY (job_id, version)
+        );
+        CREATE TABLE IF NOT EXISTS outputs (
+            filename TEXT PRIMARY KEY,
+            job_id TEXT,
+            replica TEXT,
+            size INTEGER,
+            created_at REAL,
+            content BLOB
+        );
+        CREATE TABLE IF NOT EXISTS transcripts (
+            cache_key TEXT PRIMARY KEY,
+            audio_sha256 TEXT,
+            model TEXT,
+            created_at REAL,
+            columns BLOB
+        );
+    """)
+    prune_store()
+
+def prune_store():
+    """
+    Áp dụng chính sách lưu giữ của kho: mỗi job chỉ giữ JOB_KEEP_VERSIONS phiên bản mới nhất,
+    job đã kết thúc (final/failed) quá JOB_MAX_AGE bị xóa cùng mọi phiên bản, transcript cache
+    quá TRANSCRIPT_CACHE_MAX_AGE bị xóa. File ASS của các phiên bản bị xóa cũng được xóa khỏi OUTPUTS_DIR,
+    cùng các file ASS cục bộ quá JOB_MAX_AGE không còn trong kho (do replica khác xóa phiên bản)
+    và các file profile (*.profile.json) quá JOB_MAX_AGE.
+    
+    Returns:
+        dict: Số job, phiên bản, transcript và file profile đã xóa
+    """
+    db = get_db()
+    now = time.time()
+    expired_before = now - JOB_MAX_AGE
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        old_results = db.execute(
+            "SELECT r.job_id, r.version, r.output_filename FROM results r JOIN jobs j ON j.id = r.job_id "
+            "WHERE r.version <= j.version - ? OR (j.status IN ('final', 'failed') AND j.updated_at < ?)",
+            (JOB_KEEP_VERSIONS, expired_before)
+        ).fetchall()
+        db.executemany(
+            "DELETE FROM results WHERE job_id = ? AND version = ?",
+            [(row["job_id"], row["version"]) for row in old_results]
+        )
+        db.executemany("DELETE FROM outputs WHERE filename = ?", [(row["output_filename"],) for row in old_results])
+        jobs = db.execute(
+            "DELETE FROM jobs WHERE status IN ('final', 'failed') AND updated_at < ?", (expired_before,)
+        ).rowcount
+        transcripts = db.execute(
+            "DELETE FROM transcripts WHERE created_at < ?", (now - TRANSCRIPT_CACHE_MAX_AGE,)
+        ).rowcount
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+    
+    for row in old_results:
+        (OUTPUTS_DIR / row["output_filename"]).unlink(missing_ok=True)
+    stale_files = [path for path in OUTPUTS_DIR.glob("*.ass") if path.stat().st_mtime < expired_before]
+    if stale_files:
+        known = {row["filename"] for row in db.execute("SELECT filename FROM outputs WHERE replica = ?", (REPLICA_ID,))}
+        for path in stale_files:
+            if path.name not in known:
+                path.unlink(missing_ok=True)
+    profiles = 0
+    for path in OUTPUTS_DIR.glob("*.profile.json"):
+        if path.stat().st_mtime < expired_before:
+            path.unlink(missing_ok=True)
+            profiles += 1
+    
+    return {"jobs": jobs, "versions": len(old_results), "transcripts": transcripts, "profiles": profiles}
+
+def encode_columns(columns):
+    """
+    Mã hóa dạng cột của kết quả (build_result_columns) thành bytes để lưu vào SQLite.
+    """
+    buffer = io.BytesIO()
+    np.savez_compressed(
+        buffer,
+        text=np.array(columns["text"]),
+        has_words=np.array(columns["has_words"]),
+        **{key: columns[key] for key in ("word_offsets", "word_start", "word_end", "word_probability", "segment_offsets")}
+    )
+    return buffer.getvalue()
+
+def decode_columns(data):
+    with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+        columns = {key: arrays[key] for key in arrays.files}
+    columns["text"] = str(columns["text"])
+    columns["has_words"] = bool(columns["has_words"])
+    return columns
+
+def copy_file_sha256(src, dst):
+    """
+    Chép luồng src sang dst và tính sha256 ngay trong lúc chép, không phải đọc lại file.
+    """
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: src.read(1 << 20), b""):
+        digest.update(chunk)
+        dst.write(chunk)
+    return digest.hexdigest()
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def transcript_cache_key(audio_sha256, plan, request):
+    """
+    Khóa cache transcript: cùng audio, cùng mô hình và cùng tham số ảnh hưởng đến kết quả.
+    """
+    parts = [
+        audio_sha256, plan["model"], str(plan["chunked"]), request["mode"],
+        request.get("script_text") or "", request.get("regroup_spec") or "", str(request["trim_silence"]),
+    ]
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+def load_cached_transcript(cache_key):
+    row = get_db().execute("SELECT columns FROM transcripts WHERE cache_key = ?", (cache_key,)).fetchone()
+    return decode_columns(row["columns"]) if row else None
+
+def store_transcript(cache_key, audio_sha256, model_name, columns):
+    get_db().execute(
+        "INSERT OR REPLACE INTO transcripts (cache_key, audio_sha256, model, created_at, columns) VALUES (?, ?, ?, ?, ?)",
+        (cache_key, audio_sha256, model_name, time.time(), encode_columns(columns))
+    )
+
+def create_job(job_id, filename):
+    """
+    Giữ id cho job mới (đang chạy, thuộc replica hiện tại) trước khi tiếp nhận file. Thao tác nguyên tử:
+    trong các request gửi cùng job_id chỉ một request giữ được id, audio và tham số được ghi sau bằng
+    set_job_input. Các phiên bản kết quả được thêm dần bằng publish_job_version.
+    
+    Args:
+        job_id (str): Id job
+        filename (str): Tên file gốc
         
-        process_time = time.time() - start_time
-        logger.info(f"Thời gian xử lý: {process_time:.2f} giây, với thiết bị: {_device}")
-        
-        # Tạo tên file đầu ra
-        output_filename = f"{uuid.uuid4()}.ass"
-        output_path = OUTPUTS_DIR / output_filename
-        
-        logger.info(f"Tạo file ASS: {output_path}")
-        
-        # Tạo file tạm để xử lý bo góc
-        temp_ass = TEMP_DIR / f"{uuid.uuid4()}.ass"
-        
-        # Tạo từ điển kwargs cho các tham số định dạng ASS
-        ass_style_kwargs = {
-            'Name': 'Default',
-            'Fontname': font,
-            'Fontsize': font_size,
-            'PrimaryColour': f"&H00{primary_color}",
-            'OutlineColour': f"&H00{outline_color}",
-            'BackColour': f"&H{background_color}",
-            'Bold': 0,
-            'Italic': 0,
-            'Underline': 0,
-            'StrikeOut': 0,
-            'ScaleX': 100,
-            'ScaleY': 100,
-            'Spacing': 0,
-            'Angle': 0,
-            'BorderStyle': 1,
-            'Outline': outline,
-            'Shadow': shadow,
-            'Alignment': alignment,
-            'MarginL': margin_l,
-            'MarginR': margin_r,
-            'MarginV': 0,
-            'Encoding': encoding
+    Returns:
+        bool: True nếu giữ được id, False nếu job đã tồn tại
+    """
+    now = time.time()
+    cursor = get_db().execute(
+        "INSERT INTO jobs (id, status, filename, version, owner, heartbeat_at, created_at, updated_at) "
+        "VALUES (?, 'running', ?, 0, ?, ?, ?, ?) ON CONFLICT(id) DO NOTHING",
+        (job_id, filename, REPLICA_ID, now, now, now)
+    )
+    return cursor.rowcount == 1
+
+def set_job_input(job_id, request, audio_path, audio_sha256):
+    """
+    Ghi audio và tham số của job đã giữ bằng create_job, đủ để chạy lại job.
+    
+    Args:
+        job_id (str): Id job
+        request (dict): Tham số cần để chạy lại job (mode, script_text, regroup_spec, ass_options...)
+        audio_path (Path): File audio lưu trong JOB_AUDIO_DIR
+        audio_sha256 (str): Mã băm nội dung audio
+    """
+    get_db().execute(
+        "UPDATE jobs SET audio_path = ?, audio_sha256 = ?, request = ?, updated_at = ? WHERE id = ?",
+        (str(audio_path), audio_sha256, json.dumps(request, ensure_ascii=False), time.time(), job_id)
+    )
+
+def load_job(job_id):
+    """
+    Đọc job cùng danh sách phiên bản (không kèm dữ liệu kết quả).
+    
+    Returns:
+        dict hoặc None nếu job không tồn tại
+    """
+    db = get_db()
+    row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    job["request"] = json.loads(job["request"] or "{}")
+    job["versions"] = [
+        {
+            "version": version["version"],
+            "model": version["model"],
+            "download_url": f"/download/{version['output_filename']}",
+            "processing_time": version["processing_time"],
+            "created_at": version["created_at"],
         }
-        
-        # Tạo ASS subtitle với word-level timing
-        logger.info(f"Tạo file ASS với highlight_color: {highlight_color}, font_size: {font_size}")
-        
-        # Chuyển đổi highlight_color từ định dạng RGB sang BGR (ASS sử dụng BGR)
-        highlight_color_bgr = highlight_color
-        if len(highlight_color) == 6:
-            # Nếu highlight_color là RGB, chuyển sang BGR
-            r, g, b = highlight_color[:2], highlight_color[2:4], highlight_color[4:]
-            highlight_color_bgr = b + g + r
-            logger.info(f"Đã chuyển đổi highlight_color từ RGB {highlight_color} sang BGR {highlight_color_bgr}")
-        
-        result.to_ass(
-            str(temp_ass),
-            highlight_color=highlight_color_bgr,
-            **ass_style_kwargs
+        for version in db.execute(
+            "SELECT version, model, output_filename, processing_time, created_at FROM results "
+            "WHERE job_id = ? ORDER BY version", (job_id,)
         )
+    ]
+    return job
+
+def public_job(job):
+    """
+    Các trường của job trả cho client (bỏ đường dẫn audio và tham số nội bộ).
+    """
+    return {key: job[key] for key in ("id", "filename", "status", "version", "created_at", "updated_at", "versions", "error")}
+
+def load_job_columns(job_id):
+    row = get_db().execute(
+        "SELECT columns FROM results WHERE job_id = ? ORDER BY version DESC LIMIT 1", (job_id,)
+    ).fetchone()
+    return decode_columns(row["columns"]) if row else None
+
+def store_output(filename, job_id):
+    """
+    Lưu nội dung file ASS vào kho chung để replica khác cũng phục vụ được /download.
+    """
+    content = (OUTPUTS_DIR / filename).read_bytes()
+    get_db().execute(
+        "INSERT OR REPLACE INTO outputs (filename, job_id, replica, size, created_at, content) VALUES (?, ?, ?, ?, ?, ?)",
+        (filename, job_id, REPLICA_ID, len(content), time.time(), content)
+    )
+
+async def notify_job(job_id):
+    """
+    Gửi trạng thái mới của job tới các client đang theo dõi qua /jobs/{id}/events.
+    """
+    subscribers = _job_subscribers.get(job_id)
+    if not subscribers:
+        return
+    job = public_job(await run_in_threadpool(load_job, job_id))
+    for queue in subscribers:
+        queue.put_nowait(job)
+
+class JobVersionConflict(Exception):
+    """
+    Job đã có phiên bản mới hơn phiên bản mà thay đổi dựa trên.
+    """
+
+def publish_job_version(job_id, model_name, output_filename, process_time, columns, status, base_version=None):
+    """
+    Thêm một phiên bản kết quả mới cho job (kết quả, file ASS) và tăng bộ đếm phiên bản.
+    Gọi từ threadpool; thông báo cho client bằng notify_job trên event loop.
+    
+    Args:
+        job_id (str): Id job
+        model_name (str): Mô hình đã tạo phiên bản này
+        output_filename (str): File ASS trong OUTPUTS_DIR
+        process_time (float): Thời gian xử lý (giây)
+        columns (dict): Dạng cột của kết quả (build_result_columns)
+        status (str): Trạng thái job sau phiên bản này ("refining" hoặc "final")
+        base_version (int): Nếu có, chỉ công bố khi phiên bản hiện tại của job đúng bằng giá trị này
         
-        # Sửa lại file ASS để đảm bảo font size và highlight color được áp dụng đúng
-        try:
-            with open(temp_ass, 'r', encoding='utf-8') as f:
-                ass_content = f.readlines()
-            
-            # Tìm và sửa style Default
-            for i, line in enumerate(ass_content):
-                if line.startswith("Style: Default,"):
-                    parts = line.split(',')
-                    if len(parts) > 2:
-                        # Đảm bảo font size đúng
-                        original_font_size = parts[2]
-                        parts[2] = str(font_size)
-                        logger.info(f"Đã thay đổi font size từ {original_font_size} thành {font_size} trong style Default")
-                    ass_content[i] = ','.join(parts)
-            
-            # Kiểm tra và thêm highlight color vào các dòng Dialogue
-            highlight_found = False
-            for i, line in enumerate(ass_content):
-                if line.startswith("Dialogue:") and "\\1c&H" in line:
-                    highlight_found = True
-                    logger.info(f"Đã tìm thấy highlight color trong dòng: {line.strip()}")
-                    break
-            
-            if not highlight_found:
-                logger.warning(f"Không tìm thấy highlight color trong file ASS. Highlight color đã cài đặt: {highlight_color}")
-                
-                # Thêm highlight color vào các dòng Dialogue
-                for i, line in enumerate(ass_content):
-                    if line.startswith("Dialogue:") and "Default" in line and "{\\k" in line:
-                        # Tìm vị trí của tag karaoke đầu tiên
-                        parts = line.split(',', 9)
-                        if len(parts) >= 10:
-                            text = parts[9]
-                            # Thêm tag highlight color vào mỗi tag karaoke
-                            modified_text = text.replace("{\\k", "{\\1c&H" + highlight_color_bgr + "&\\k")
-                            # Cập nhật dòng với highlight color
-                            parts[9] = modified_text
-                            ass_content[i] = ','.join(parts)
-                            logger.info(f"Đã thêm highlight color vào dòng: {i+1}")
-            
-            # Ghi lại file
-            with open(temp_ass, 'w', encoding='utf-8') as f:
-                f.writelines(ass_content)
-            
-            logger.info(f"Đã sửa lại file ASS để đảm bảo font size: {font_size} và highlight color: {highlight_color}")
-        except Exception as e:
-            logger.error(f"Lỗi khi sửa lại file ASS: {str(e)}")
+    Returns:
+        int: Số phiên bản mới
         
-        # Log 15 dòng đầu của file ASS trước khi áp dụng bo góc
-        logger.info("=== 15 dòng đầu của file ASS TRƯỚC KHI áp dụng bo góc ===")
-        try:
-            with open(temp_ass, 'r', encoding='utf-8') as f:
-                first_15_lines = [next(f) for _ in range(15)]
-                for i, line in enumerate(first_15_lines):
-                    logger.info(f"Dòng {i+1}: {line.strip()}")
-                
-                # Tìm và log một số dòng Dialogue
-                logger.info("=== Một số dòng Dialogue TRƯỚC KHI áp dụng bo góc ===")
-                dialogue_count = 0
-                # Đặt lại con trỏ file về đầu
-                f.seek(0)
-                for line in f:
-                    if line.startswith("Dialogue:"):
-                        logger.info(f"Dialogue: {line.strip()}")
-                        dialogue_count += 1
-                        if dialogue_count >= 5:  # Chỉ log 5 dòng Dialogue đầu tiên
-                            break
-        except Exception as e:
-            logger.error(f"Lỗi khi đọc file ASS ban đầu: {str(e)}")
+    Raises:
+        JobVersionConflict: Nếu phiên bản hiện tại khác base_version
+    """
+    store_output(output_filename, job_id)
+    db = get_db()
+    now = time.time()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        version = db.execute("SELECT version FROM jobs WHERE id = ?", (job_id,)).fetchone()["version"]
+        if base_version is not None and version != base_version:
+            raise JobVersionConflict(f"Job {job_id} đã có phiên bản {version}, khác phiên bản {base_version}")
+        version += 1
+        db.execute(
+            "INSERT INTO results (job_id, version, model, output_filename, processing_time, created_at, columns) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, version, model_name, output_filename, round(process_time, 2), now, encode_columns(columns))
+        )
+        db.execute(
+            "UPDATE jobs SET version = ?, status = ?, updated_at = ?, heartbeat_at = ? WHERE id = ?",
+            (version, status, now, now, job_id)
+        )
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        if base_version is not None:
+            db.execute("DELETE FROM outputs WHERE filename = ?", (output_filename,))
+        raise
+    logger.info(
+        f"Job {job_id}: phiên bản {version} ({model_name}), trạng thái {status}",
+        extra={"job_id": job_id, "version": version, "model": model_name, "status": status}
+    )
+    return version
+
+def finalize_transcript(result, timeline, spec, cache_key, audio_sha256, model_name):
+    """
+    Giai đoạn render: hậu xử lý kết quả thô của mô hình, dựng dạng cột và lưu vào transcript cache.
+    
+    Returns:
+        dict: Dạng cột của kết quả (build_result_columns)
+    """
+    columns = build_result_columns(finalize_result(result, timeline, spec))
+    store_transcript(cache_key, audio_sha256, model_name, columns)
+    return columns
+
+def render_job_version(job_id, model_name, columns, process_time, status, ass_options):
+    """
+    Giai đoạn render: tạo file ASS từ dạng cột rồi công bố phiên bản mới của job.
+    
+    Returns:
+        tuple: (tên file ASS trong OUTPUTS_DIR, số phiên bản mới)
+    """
+    output_filename = f"{uuid.uuid4()}.ass"
+    output_path = OUTPUTS_DIR / output_filename
+    logger.info(f"Tạo file ASS: {output_path}")
+    render_ass_output(columns, output_path, **ass_options)
+    version = publish_job_version(job_id, model_name, output_filename, process_time, columns, status)
+    return output_filename, version
+
+def load_output_lines(filename):
+    """
+    Đọc các dòng của file ASS đầu ra, từ OUTPUTS_DIR hoặc từ kho chung nếu do replica khác tạo.
+    
+    Returns:
+        list hoặc None nếu không còn file
+    """
+    file_path = OUTPUTS_DIR / filename
+    if file_path.exists():
+        content = file_path.read_text(encoding='utf-8')
+    else:
+        row = get_db().execute("SELECT content FROM outputs WHERE filename = ?", (filename,)).fetchone()
+        if row is None or not row["content"]:
+            return None
+        content = row["content"].decode('utf-8')
+    return content.splitlines(keepends=True)
+
+def edit_job_transcript(job_id, edits, base_version=None):
+    """
+    Giai đoạn render của /jobs/{id}/edits: áp dụng chỉnh sửa lên phiên bản mới nhất của job,
+    tạo lại file ASS (chỉ các event thay đổi nếu được) và công bố phiên bản mới.
+    
+    Args:
+        job_id (str): Id job
+        edits (list): Kết quả của parse_transcript_edits
+        base_version (int): Phiên bản mà chỉ số trong edits dựa trên, mặc định là phiên bản mới nhất
         
-        # Áp dụng bo góc
-        logger.info(f"Áp dụng bo góc với bán kính {border_radius}")
-        try:
-            apply_rounded_borders(temp_ass, output_path, border_radius)
-            
-            # Log 15 dòng đầu của file ASS sau khi áp dụng bo góc
-            logger.info("=== 15 dòng đầu của file ASS SAU KHI áp dụng bo góc ===")
-            try:
-                with open(output_path, 'r', encoding='utf-8') as f:
-                    first_15_lines = [next(f) for _ in range(15)]
-                    for i, line in enumerate(first_15_lines):
-                        logger.info(f"Dòng {i+1}: {line.strip()}")
-                    
-                    # Tìm và log một số dòng Dialogue
-                    logger.info("=== Một số dòng Dialogue SAU KHI áp dụng bo góc ===")
-                    dialogue_count = 0
-                    # Đặt lại con trỏ file về đầu
-                    f.seek(0)
-                    for line in f:
-                        if line.startswith("Dialogue:"):
-                            logger.info(f"Dialogue: {line.strip()}")
-                            dialogue_count += 1
-                            if dialogue_count >= 10:  # Log 10 dòng Dialogue đầu tiên (bao gồm cả background)
-                                break
-            except Exception as e:
-                logger.error(f"Lỗi khi đọc file ASS sau khi áp dụng bo góc: {str(e)}")
-            
-            # Xóa file tạm sau khi xử lý
-            temp_ass.unlink(missing_ok=True)
-        except Exception as e:
-            logger.error(f"Lỗi khi áp dụng bo góc: {str(e)}")
-            # Nếu có lỗi, sử dụng file gốc
-            shutil.copy(temp_ass, output_path)
-            # Xóa file tạm
-            temp_ass.unlink(missing_ok=True)
+    Returns:
+        dict: {"version", "output_filename", "columns", "processing_time",
+               "regenerated_events", "reused_events", "incremental"}
         
-        # Xóa file tạm
+    Raises:
+        ValueError: Nếu chỉnh sửa không áp dụng được lên phiên bản hiện tại
+        JobVersionConflict: Nếu job có phiên bản mới hơn base_version (kể cả do chỉnh sửa song song)
+    """
+    start_time = time.time()
+    job = load_job(job_id)
+    request = job["request"]
+    latest = get_db().execute(
+        "SELECT version, model, output_filename, columns FROM results WHERE job_id = ? ORDER BY version DESC LIMIT 1",
+        (job_id,)
+    ).fetchone()
+    if base_version is not None and latest["version"] != base_version:
+        raise JobVersionConflict(f"Job {job_id} đã có phiên bản {latest['version']}, khác base_version {base_version}")
+    old_columns = decode_columns(latest["columns"])
+    columns, segment_map = apply_transcript_edits(old_columns, edits, parse_regroup_spec(request.get("regroup_spec")))
+    
+    output_filename = f"{uuid.uuid4()}.ass"
+    output_path = OUTPUTS_DIR / output_filename
+    stats = None
+    old_lines = load_output_lines(latest["output_filename"])
+    if old_lines is not None:
         try:
-            temp_file.unlink()
+            stats = render_ass_incremental(
+                columns, old_columns, old_lines, segment_map, output_path, **request["ass_options"]
+            )
         except Exception as e:
-            logger.warning(f"Không thể xóa file tạm {temp_file}: {str(e)}")
-        
-        # Trả về URL để tải file kết quả
-        download_url = f"/download/{output_filename}"
-        
-        logger.info(f"Hoàn thành phiên âm. URL tải xuống: {download_url}")
+            logger.warning(f"Không thể tạo lại file ASS theo từng event, tạo lại toàn bộ: {str(e)}")
+    incremental = stats is not None
+    if not incremental:
+        render_ass_output(columns, output_path, **request["ass_options"])
+        stats = (len(ass_event_groups(columns)), 0)
+    
+    process_time = time.time() - start_time
+    try:
+        version = publish_job_version(
+            job_id, latest["model"], output_filename, process_time, columns, "final", base_version=latest["version"]
+        )
+    except JobVersionConflict:
+        output_path.unlink(missing_ok=True)
+        raise
+    logger.info(
+        f"Job {job_id}: áp dụng {len(edits)} chỉnh sửa trên phiên bản {latest['version']}, "
+        f"tạo lại {stats[0]} event, dùng lại {stats[1]} event trong {process_time * 1000:.1f} ms",
+        extra={"job_id": job_id, "version": version, "edits": len(edits), "incremental": incremental}
+    )
+    return {
+        "version": version,
+        "output_filename": output_filename,
+        "columns": columns,
+        "processing_time": process_time,
+        "regenerated_events": stats[0],
+        "reused_events": stats[1],
+        "incremental": incremental,
+    }
+
+def fail_job(job_id, error):
+    """
+    Đánh dấu job thất bại và xóa audio của job. Gọi từ threadpool, sau đó thông báo bằng notify_job.
+    """
+    db = get_db()
+    db.execute(
+        "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ?",
+        (error, time.time(), job_id)
+    )
+    row = db.execute("SELECT audio_path FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if row and row["audio_path"]:
+        Path(row["audio_path"]).unlink(missing_ok=True)
+    logger.error(f"Job {job_id} thất bại: {error}")
+
+def job_response_content(job, columns, selection, response_format="records"):
+    """
+    Tạo response của /transcribe từ kết quả đã lưu của job (khi client gửi lại cùng job_id).
+    """
+    latest = job["versions"][-1]
+    info = {
+        "success": True,
+        "message": f"Kết quả đã có của job {job['id']} ({job['filename']})",
+        "processing_time": f"{latest['processing_time']:.2f} giây",
+        "device": _device,
+        "model": latest["model"],
+        "mode": job["request"].get("mode"),
+        "download_url": latest["download_url"],
+        "job_id": job["id"],
+    }
+    return build_response_content(columns, info, selection, response_format)
+
+async def resume_job(job_id):
+    """
+    Chạy job bằng mô hình chính ở nền: tinh chỉnh sau bản nháp hoặc chạy lại job bị gián đoạn
+    khi khởi động lại. Kết quả được công bố như phiên bản mới, file audio của job được xóa khi xong.
+    Job không chạy lại được (VD: bị gián đoạn trước khi lưu xong audio) được đánh dấu thất bại.
+    """
+    audio_path = None
+    try:
+        job = await run_in_threadpool(load_job, job_id)
+        if job is None:
+            raise RuntimeError("Job không còn trong kho")
+        if not job["audio_path"]:
+            raise RuntimeError("Job bị gián đoạn trước khi lưu xong audio")
+        request = job["request"]
+        audio_path = Path(job["audio_path"])
+        if not audio_path.exists():
+            raise RuntimeError(f"Không còn file audio {audio_path}")
         
-        # Trích xuất segments để trả về trong response
-        sentence_segments = extract_sentence_segments(result)
+        plan = plan_transcription(request["audio_duration"], request["mode"])
+        if plan is None:
+            raise RuntimeError("Không đủ bộ nhớ để chạy với mô hình chính")
         
-        # Tạo response dựa trên giá trị của simple_response
-        if simple_response:
-            return JSONResponse(
-                content={
-                    "success": True,
-                    "message": f"Đã phiên âm thành công file {file.filename}",
-                    "download_url": download_url,
-                    "duration": result.segments[-1].end if result.segments else 0
-                }
+        cache_key = transcript_cache_key(job["audio_sha256"], plan, request)
+        columns = await run_in_threadpool(load_cached_transcript, cache_key)
+        process_time = 0.0
+        if columns is None:
+            # Tinh chỉnh có ưu tiên thấp hơn request gốc để bản nháp của request khác không phải chờ
+            priority = request["priority"] - 1 if job["version"] else request["priority"]
+            result, timeline, process_time, _ = await run_planned_transcription(
+                plan, audio_path, request["audio_duration"], request["mode"], request.get("script_text"),
+                trim_silence=request["trim_silence"], priority=priority, label=job["filename"]
             )
-        else:
-            return JSONResponse(
-                content={
-                    "success": True,
-                    "message": f"Đã phiên âm thành công file {file.filename}",
-                    "processing_time": f"{process_time:.2f} giây",
-                    "device": _device,
-                    "download_url": download_url,
-                    "text": result.text,
-                    "segments": sentence_segments
-                }
+            columns = await get_stage("render").run(
+                finalize_transcript, result, timeline, parse_regroup_spec(request.get("regroup_spec")),
+                cache_key, job["audio_sha256"], plan["model"]
             )
+        
+        await get_stage("render").run(
+            render_job_version, job_id, plan["model"], columns, process_time, "final", request["ass_options"]
+        )
+        await notify_job(job_id)
+    except Exception as e:
+        await run_in_threadpool(fail_job, job_id, f"Lỗi khi chạy lại job: {str(e)}")
+        await notify_job(job_id)
+    finally:
+        if audio_path is not None:
+            audio_path.unlink(missing_ok=True)
+
+def start_resume_job(job_id):
+    """
+    Chạy resume_job ở nền. Event loop chỉ giữ tham chiếu yếu tới task nên task được giữ trong
+    _resume_tasks cho đến khi xong, lỗi không được resume_job xử lý sẽ được ghi log.
+    """
+    task = asyncio.create_task(resume_job(job_id))
+    _resume_tasks.add(task)
     
-    except RuntimeError as e:
-        if "CUDA out of memory" in str(e):
-            # Thử lại với model nhỏ hơn nếu gặp lỗi CUDA OOM
-            logger.warning("CUDA out of memory, thử lại với model nhỏ hơn...")
-            
-            # Giải phóng bộ nhớ GPU
-            global _model
-            _model = None
-            torch.cuda.empty_cache()
-            
-            # Chỉ sử dụng 2 model lớn nhất
-            models = ["large-v3", "turbo"]
-            
-            # Tìm model hiện tại và chuyển sang model nhỏ hơn tiếp theo
-            current_model = None
-            for line in str(e).split('\n'):
-                if "model_size=" in line:
-                    current_model = line.split("model_size=")[1].split()[0].strip("'\"")
-                    break
-            
-            next_model = None
-            if current_model in models:
-                current_idx = models.index(current_model)
-                if current_idx < len(models) - 1:
-                    next_model = models[current_idx + 1]
-            else:
-                next_model = models[-1]  # Sử dụng turbo nếu không xác định được model hiện tại
-            
-            if next_model:
-                logger.info(f"Thử lại với model {next_model}...")
-                _model = stable_whisper.load_model(next_model, device="cuda")
-                return await transcribe_audio(file, use_cpu=False, simple_response=simple_response)
-            else:
-                logger.error("Đã thử tất cả các model nhưng vẫn gặp lỗi CUDA OOM")
-                return JSONResponse(
-                    status_code=500,
-                    content={
-                        "error": "Không đủ bộ nhớ GPU để xử lý file này với model large-v3 và turbo"
-                    }
+    def done(task):
+        _resume_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Job nền {job_id} dừng vì lỗi: {task.exception()!r}", extra={"job_id": job_id})
+    
+    task.add_done_callback(done)
+    return task
+
+def load_replica_id():
+    """
+    Id của replica khi không đặt REPLICA_ID: id sinh một lần và lưu trong DATA_DIR, để sau khi khởi động lại
+    (hostname container đổi mỗi lần) replica vẫn nhận ra và chạy lại ngay job của chính nó. File id được khóa
+    suốt thời gian chạy; các tiến trình khác dùng chung DATA_DIR (nhiều worker, nhiều container cùng volume)
+    nhận id riêng theo hostname và pid, job bị gián đoạn của chúng được nhận lại sau JOB_STALE_SECONDS.
+    
+    Returns:
+        tuple: (id replica, file id đang giữ khóa hoặc None)
+    """
+    id_file = open(DATA_DIR / "replica_id", "a+")
+    try:
+        fcntl.flock(id_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        id_file.close()
+        replica_id = f"{socket.gethostname()}-{os.getpid()}"
+        logger.warning(
+            f"{DATA_DIR} đang được tiến trình khác dùng, replica này dùng id {replica_id}. "
+            f"Đặt REPLICA_ID riêng cho mỗi replica để job được chạy lại ngay sau khi khởi động lại"
+        )
+        return replica_id, None
+    id_file.seek(0)
+    replica_id = id_file.read().strip()
+    if not replica_id:
+        replica_id = f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+        id_file.write(replica_id)
+        id_file.flush()
+    return replica_id, id_file
+
+def claim_interrupted_jobs():
+    """
+    Nhận các job bị gián đoạn: job của chính replica này (khởi động lại) hoặc job
+    có heartbeat quá hạn (replica khác đã dừng). Mỗi job chỉ một replica nhận được.
+    
+    Returns:
+        list: Id các job đã nhận
+    """
+    db = get_db()
+    now = time.time()
+    claimed = []
+    rows = db.execute("SELECT id, owner, heartbeat_at FROM jobs WHERE status IN ('running', 'refining')").fetchall()
+    for row in rows:
+        cursor = db.execute(
+            "UPDATE jobs SET owner = ?, heartbeat_at = ?, updated_at = ? "
+            "WHERE id = ? AND status IN ('running', 'refining') AND (owner = ? OR heartbeat_at < ?)",
+            (REPLICA_ID, now, now, row["id"], REPLICA_ID, now - JOB_STALE_SECONDS)
+        )
+        if cursor.rowcount:
+            claimed.append(row["id"])
+    return claimed
+
+async def job_heartbeat_loop():
+    """
+    Định kỳ cập nhật heartbeat cho các job đang chạy của replica này, để replica khác
+    không nhận nhầm job còn sống.
+    """
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+        try:
+            await run_in_threadpool(
+                lambda: get_db().execute(
+                    "UPDATE jobs SET heartbeat_at = ? WHERE owner = ? AND status IN ('running', 'refining')",
+                    (time.time(), REPLICA_ID)
                 )
-        else:
-            # Lỗi khác
-            logger.error(f"Lỗi khi phiên âm: {str(e)}")
-            return JSONResponse(
-                status_code=500,
-                content={
-                    "error": f"Lỗi khi phiên âm: {str(e)}"
-                }
             )
-    except Exception as e:
-        # Xử lý các lỗi khác
-        logger.error(f"Lỗi khi xử lý: {str(e)}")
+        except Exception as e:
+            logger.warning(f"Không thể cập nhật heartbeat job: {str(e)}")
+
+async def store_retention_loop():
+    """
+    Định kỳ áp dụng chính sách lưu giữ để kho không lớn dần theo số phiên bản và số job.
+    """
+    while True:
+        await asyncio.sleep(STORE_PRUNE_SECONDS)
+        try:
+            pruned = await run_in_threadpool(prune_store)
+            if any(pruned.values()):
+                logger.info(
+                    f"Dọn kho: {pruned['jobs']} job, {pruned['versions']} phiên bản, {pruned['transcripts']} transcript, "
+                    f"{pruned['profiles']} profile",
+                    extra=pruned
+                )
+        except Exception as e:
+            logger.warning(f"Không thể dọn kho trạng thái: {str(e)}")
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, include_segments: bool = True, include_words: bool = False):
+    """
+    Trả về trạng thái job, các phiên bản và segments của phiên bản mới nhất.
+    
+    Args:
+        job_id (str): Id job trả về từ /transcribe
+        include_segments (bool): Trả kèm segments của phiên bản mới nhất
+        include_words (bool): Trả kèm từng từ (chỉ số dùng cho /jobs/{id}/edits)
+    """
+    job = await run_in_threadpool(load_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job không tồn tại")
+    
+    content = public_job(job)
+    if (include_segments or include_words) and job["version"]:
+        columns = await run_in_threadpool(load_job_columns, job_id)
+        if include_segments:
+            content["segments"] = columns_to_records(extract_sentence_columns(columns))
+        if include_words:
+            content["words"] = columns_to_records(extract_word_columns(columns))
+    return fast_json_response(content)
+
+@app.post("/jobs/{job_id}/edits")
+async def edit_job(
+    job_id: str,
+    edits: str = Form(...),
+    base_version: Optional[int] = Form(None),
+    fields: Optional[str] = Form(None),
+    response_format: str = Form("records")
+):
+    """
+    Sửa text/thời gian của từng từ hoặc từng dòng phụ đề trong transcript đã lưu và tạo file ASS mới
+    mà không phải phiên âm lại. Chỉ vùng quanh chỗ sửa được nhóm lại và chỉ các event thay đổi được tạo lại.
+    
+    Args:
+        job_id (str): Id job trả về từ /transcribe
+        edits (str): Danh sách chỉnh sửa dạng JSON, xem parse_transcript_edits. Chỉ số từ/dòng lấy từ
+            GET /jobs/{id}?include_words=true (trường segment của mỗi từ là chỉ số dòng)
+        base_version (int): Phiên bản mà chỉ số trong edits dựa trên; trả 409 nếu job đã có phiên bản mới hơn
+        fields (str): Các trường trả về, giống /transcribe
+        response_format (str): "records" hoặc "columnar"
+        
+    Returns:
+        Phiên bản mới của job kèm số event được tạo lại/dùng lại
+    """
+    if response_format not in ("records", "columnar"):
         return JSONResponse(
-            status_code=500,
+            status_code=400,
             content={
-                "error": f"Lỗi khi xử lý: {str(e)}"
+                "error": f"response_format không hợp lệ: {response_format}. Hỗ trợ: records, columnar"
+            }
+        )
+    
+    try:
+        response_fields = parse_response_fields(fields)
+    except ValueError as e:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "error": f"fields không hợp lệ: {str(e)}"
+            }
+        )
+    
+    try:
+        edit_list = parse_transcript_edits(edits)
+    except ValueError as e:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "error": f"edits không hợp lệ: {str(e)}"
+            }
+        )
+    
+    job = await run_in_threadpool(load_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job không tồn tại")
+    if job["status"] != "final" or not job["version"]:
+        # Bản nháp đang được tinh chỉnh sẽ ghi đè chỉnh sửa
+        return JSONResponse(
+            status_code=409,
+            content={
+                "error": f"Job đang ở trạng thái {job['status']}, chỉ sửa được job đã hoàn tất"
+            }
+        )
+    
+    try:
+        edited = await get_stage("render").run(edit_job_transcript, job_id, edit_list, base_version)
+    except ValueError as e:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "error": f"edits không hợp lệ: {str(e)}"
+            }
+        )
+    except JobVersionConflict as e:
+        return JSONResponse(
+            status_code=409,
+            content={
+                "error": f"{str(e)}, hãy lấy lại chỉ số từ phiên bản mới nhất"
+            }
+        )
+    await notify_job(job_id)
+    
+    info = {
+        "success": True,
+        "message": f"Đã áp dụng {len(edit_list)} chỉnh sửa cho job {job_id}",
+        "processing_time": f"{edited['processing_time']:.3f} giây",
+        "device": _device,
+        "model": job["versions"][-1]["model"],
+        "mode": job["request"].get("mode"),
+        "download_url": f"/download/{edited['output_filename']}",
+        "job_id": job_id,
+    }
+    content = build_response_content(edited["columns"], info, response_fields, response_format)
+    content["version"] = edited["version"]
+    content["regenerated_events"] = edited["regenerated_events"]
+    content["reused_events"] = edited["reused_events"]
+    content["incremental"] = edited["incremental"]
+    return fast_json_response(content)
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """
+    Luồng Server-Sent Events: gửi trạng thái hiện tại rồi mỗi khi job có phiên bản mới,
+    kết thúc khi job hoàn tất hoặc thất bại. Job do replica khác xử lý được theo dõi bằng
+    cách đọc lại kho trạng thái định kỳ.
+    """
+    job = await run_in_threadpool(load_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job không tồn tại")
+    
+    queue = asyncio.Queue()
+    _job_subscribers.setdefault(job_id, []).append(queue)
+    queue.put_nowait(public_job(job))
+    
+    async def stream():
+        last = None
+        try:
+            while True:
+                try:
+                    job = await asyncio.wait_for(queue.get(), timeout=JOB_EVENTS_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    job = public_job(await run_in_threadpool(load_job, job_id))
+                if last is not None and (job["version"], job["status"]) == last:
+                    continue
+                last = (job["version"], job["status"])
+                yield f"event: version\ndata: {json.dumps(job, ensure_ascii=False)}\n\n"
+                if job["status"] in ("final", "failed"):
+                    break
+        finally:
+            subscribers = _job_subscribers.get(job_id, [])
+            if queue in subscribers:
+                subscribers.remove(queue)
+            if not subscribers:
+                _job_subscribers.pop(job_id, None)
+    
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+def check_admin_token(x_admin_token):
+    """
+    Kiểm tra token quản trị nếu ADMIN_TOKEN được cấu hình.
+    """
+    if ADMIN_TOKEN and x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Sai hoặc thiếu X-Admin-Token")
+
+@app.post("/admin/model")
+async def admin_swap_model(
+    model_name: str = Form(...),
+    x_admin_token: Optional[str] = Header(None)
+):
+    """
+    Thay mô hình chính không gián đoạn: tải mô hình mới ở nền, thay khi tải xong,
+    chờ request đang chạy trên mô hình cũ rồi giải phóng nó.
+    
+    Args:
+        model_name (str): Tên mô hình (VD: "large-v3", "turbo") hoặc đường dẫn checkpoint
+        
+    Returns:
+        Sự kiện thay mô hình (theo dõi tiếp qua GET /admin/model)
+    """
+    global _swap_task
+    check_admin_token(x_admin_token)
+    
+    if _swap_task is not None and not _swap_task.done():
+        return JSONResponse(
+            status_code=409,
+            content={
+                "error": "Đang có một lần thay mô hình chưa hoàn tất"
+            }
+        )
+    
+    admission = get_admission()
+    weights_mb = model_weights_mb(model_name)
+    if model_name not in _extra_models and not admission.can_ever_fit(weights_mb):
+        return JSONResponse(
+            status_code=409,
+            content={
+                "error": f"Không đủ bộ nhớ để tải {model_name} ({weights_mb} MB) song song với mô hình hiện tại"
+            }
+        )
+    
+    event = {
+        "id": uuid.uuid4().hex,
+        "from": _model_name,
+        "to": model_name,
+        "device": _device,
+        "status": "loading",
+        "requested_at": time.time(),
+    }
+    _swap_events.append(event)
+    _swap_task = asyncio.create_task(swap_primary_model(event, model_name))
+    logger.info(f"Yêu cầu thay mô hình {_model_name} -> {model_name}")
+    return JSONResponse(status_code=202, content=event)
+
+@app.get("/admin/model")
+async def admin_model_status(x_admin_token: Optional[str] = Header(None)):
+    """
+    Trả về mô hình đang phục vụ, các mô hình phụ và lịch sử thay mô hình.
+    """
+    check_admin_token(x_admin_token)
+    return {
+        "model": _model_name,
+        "device": _device,
+        "extra_models": list(_extra_models),
+        "requests_on_models": sum(_model_users.values()),
+        "acceleration": _accel_stats,
+        "swaps": list(_swap_events),
+    }
+
+async def existing_job_response(job, response_fields, response_format):
+    """
+    Response khi client gửi lại job_id đã có: kết quả mới nhất nếu job đã có phiên bản,
+    nếu chưa thì 202 kèm URL để theo dõi job.
+    """
+    if job["version"]:
+        logger.info(f"Job {job['id']} đã có kết quả, trả lại phiên bản {job['version']}")
+        columns = await run_in_threadpool(load_job_columns, job["id"])
+        return fast_json_response(job_response_content(job, columns, response_fields, response_format))
+    return JSONResponse(
+        status_code=202,
+        content={
+            "job_id": job["id"],
+            "job_status": job["status"],
+            "job_url": f"/jobs/{job['id']}",
+            "events_url": f"/jobs/{job['id']}/events"
+        }
+    )
+
+@app.post("/transcribe")
+async def transcribe_audio(
+    file: UploadFile = File(...),
+    use_cpu: bool = Form(False),
+    simple_response: bool = Form(False),
+    trim_silence: bool = Form(True),
+    
+    # Chế độ xử lý: "transcribe" (phiên âm) hoặc "align" (căn chỉnh theo kịch bản có sẵn)
+    mode: str = Form("transcribe"),
+    script_text: Optional[str] = Form(None),
+    regroup_spec: Optional[str] = Form(None),
+    priority: int = Form(0),
+    max_duration: Optional[float] = Form(None),
+    draft: bool = Form(False),
+    job_id: Optional[str] = Form(None),
+    
+    # Tùy chọn response
+    fields: Optional[str] = Form(None),
+    response_format: str = Form("records"),
+    include_words: bool = Form(False),
+    
+    # Tham số cho ASS
+    font: str = Form("Montserrat"),
+    font_size: int = Form(124),  # Tăng font size từ 80 lên 124
+    highlight_color: str = Form('EDA005'),
+    border_radius: int = Form(24),
+    
+    # Các tham số định dạng ASS
+    background_color: str = Form('80000000'),
+    primary_color: str = Form('EDA005'),
+    outline_color: str = Form('000000'),
+    outline: int = Form(3),
+    shadow: int = Form(3),
+    alignment: int = Form(2),
+    margin_l: int = Form(20),
+    margin_r: int = Form(20),
+    margin_v: int = Form(120),  # Tăng margin_v để đưa subtitle xuống thấp hơn
+    encoding: int = Form(163),
+    
+    # Profiling theo yêu cầu: "1" để lấy mẫu stack, "torch" để thêm thời gian từng op của mô hình
+    x_profile: Optional[str] = Header(None)
+):
+    """
+    API endpoint để phiên âm file audio thành ASS subtitle.
+    
+    Args:
+        file (UploadFile): File audio cần phiên âm
+        use_cpu (bool): Giữ để tương thích, thiết bị của mô hình được chọn một lần khi server khởi động
+        simple_response (bool): Tùy chọn phản hồi đơn giản hơn
+        trim_silence (bool): Cắt bớt khoảng lặng dài trước khi đưa vào mô hình
+        mode (str): "transcribe" để phiên âm bằng Whisper, "align" để căn chỉnh thời gian theo script_text
+        script_text (str): Kịch bản lời thoại đã biết trước, bắt buộc khi mode="align"
+        regroup_spec (str): JSON ghi đè một phần DEFAULT_REGROUP_SPEC cho việc nhóm từ
+        priority (int): Độ ưu tiên khi xếp hàng, càng cao càng được chạy sớm (từ -2 đến 2, mặc định 0)
+        max_duration (float): Chỉ xử lý max_duration giây đầu của audio
+        draft (bool): Trả ngay bản nháp bằng mô hình nhỏ (DRAFT_MODEL_NAME), sau đó tinh chỉnh bằng
+            mô hình chính ở nền và công bố thành phiên bản mới của job (xem /jobs/{job_id})
+        job_id (str): Id job do client chọn để gửi lại an toàn: nếu job đã có kết quả thì trả
+            kết quả đó, nếu đang chạy thì trả 202 thay vì xử lý lại
+        
+        # Tùy chọn response
+        fields (str): Danh sách trường cần trả về, phân tách bằng dấu phẩy, có thể chọn
+            trường con của segments/words (VD: "download_url,segments.duration")
+        response_format (str): "records" (danh sách object) hoặc "columnar" (các mảng song song)
+        include_words (bool): Trả thêm mảng timestamp từng từ
+        
+        # Tham số cho ASS
+        font (str): Tên font chữ
+        font_size (int): Kích thước font
+        highlight_color (str): Màu highlight cho từng từ, định dạng BGR
+        border_radius (int): Bán kính bo góc
+        
+        # Các tham số định dạng ASS
+        background_color (str): Màu nền dạng AABBGGRR
+        primary_color (str): Màu chữ chính
+        outline_color (str): Màu viền
+        outline (int): Độ dày viền
+        shadow (int): Độ đậm bóng
+        alignment (int): Vị trí căn chỉnh phụ đề
+        margin_l (int): Lề trái
+        margin_r (int): Lề phải
+        margin_v (int): Lề dọc
+        encoding (int): Mã hóa ký tự
+        
+        x_profile (str): Header X-Profile bật profiling cho request này
+        
+    Returns:
+        Kết quả phiên âm dưới dạng ASS subtitle với giới hạn 1 dòng
+    """
+    
+    # Ghi log request
+    logger.info(f"Nhận yêu cầu phiên âm file: {file.filename}, use_cpu: {use_cpu}, mode: {mode}")
+    
+    # Kiểm tra chế độ xử lý
+    mode = mode.lower().strip()
+    if mode not in ("transcribe", "align"):
+        return JSONResponse(
+            status_code=400,
+            content={
+                "error": f"Chế độ không hợp lệ: {mode}. Các chế độ hỗ trợ: transcribe, align"
+            }
+        )
+    
+    if mode == "align" and not (script_text and script_text.strip()):
+        return JSONResponse(
+            status_code=400,
+            content={
+                "error": "Chế độ align yêu cầu tham số script_text"
+            }
+        )
+    
+    try:
+        spec = parse_regroup_spec(regroup_spec)
+    except ValueError as e:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "error": f"regroup_spec không hợp lệ: {str(e)}"
+            }
+        )
+    
+    if response_format not in ("records", "columnar"):
+        return JSONResponse(
+            status_code=400,
+            content={
+                "error": f"response_format không hợp lệ: {response_format}. Hỗ trợ: records, columnar"
             }
         )
+    
+    try:
+        response_fields = parse_response_fields(fields, simple_response, include_words)
+    except ValueError as e:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "error": f"fields không hợp lệ: {str(e)}"
+            }
+        )
+    
+    # Kiểm tra định dạng file
+    supported_formats = ["mp3", "wav", "m4a", "ogg", "flac", "mp4", "avi", "mkv"]
+    file_ext = file.filename.split(".")[-1].lower()
+    
+    if file_ext not in supported_formats:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "error": f"Định dạng file không được hỗ trợ. Các định dạng hỗ trợ: {', '.join(supported_formats)}"
+            }
+        )
+    
+    if not MIN_PRIORITY <= priority <= MAX_PRIORITY:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "error": f"priority phải nằm trong khoảng {MIN_PRIORITY} đến {MAX_PRIORITY}"
+            }
+        )
+    
+    if max_duration is not None and max_duration <= 0:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "error": "max_duration phải lớn hơn 0"
+            }
+        )
+    
+    if job_id is not None:
+        if not re.fullmatch(r"[A-Za-z0-9_-]{1,64}", job_id):
+            return JSONResponse(
+                status_code=400,
+                content={
+                    "error": "job_id chỉ gồm chữ, số, '-' hoặc '_' (tối đa 64 ký tự)"
+                }
+            )
+        
+        existing = await run_in_threadpool(load_job, job_id)
+        if existing is not None and (existing["version"] or existing["status"] != "failed"):
+            return await existing_job_response(existing, response_fields, response_format)
+        if existing is not None:
+            await run_in_threadpool(
+                lambda: get_db().execute("DELETE FROM jobs WHERE id = ? AND status = 'failed'", (job_id,))
+            )
+    job_id = job_id or uuid.uuid4().hex
+    
+    # Giữ id job trước khi nhận file: request cùng job_id gửi đồng thời chỉ một request được chạy
+    if not await run_in_threadpool(create_job, job_id, file.filename):
+        existing = await run_in_threadpool(load_job, job_id)
+        return await existing_job_response(existing or {"id": job_id, "version": 0, "status": "running"},
+                                           response_fields, response_format)
+    
+    plan = None
+    job = {"id": job_id}
+    coalesced = False
+    profiler = create_request_profiler(x_profile)
+    try:
+        if profiler is not None:
+            profiler.start(sys._getframe())
+            logger.info(f"Bật profiling cho request, profile id: {profiler.profile_id}")
+        
+        # Giai đoạn tiếp nhận: lưu, đọc và tách audio trên executor riêng, không chặn event loop
+        ingest = get_stage("ingest")
+        try:
+            temp_file, audio_duration, audio_sha256 = await ingest.run(
+                ingest_upload if profiler is None else profiler.wrap(ingest_upload),
+                file, file_ext, job_id, max_duration
+            )
+        except IngestError as e:
+            await run_in_threadpool(fail_job, job_id, str(e))
+            await notify_job(job_id)
+            return JSONResponse(
+                status_code=e.status_code,
+                content={
+                    "error": str(e)
+                }
+            )
+        
+        # Ước lượng bộ nhớ theo thời lượng audio và chọn cách chạy vừa ngân sách
+        plan = plan_transcription(audio_duration, mode, model_name=DRAFT_MODEL_NAME if draft else None)
+        if plan is None:
+            temp_file.unlink(missing_ok=True)
+            logger.error(f"Không đủ bộ nhớ cho file {file.filename} ({audio_duration:.0f}s) với bất kỳ mô hình nào")
+            await run_in_threadpool(fail_job, job_id, "Không đủ bộ nhớ với bất kỳ mô hình nào")
+            await notify_job(job_id)
+            return JSONResponse(
+                status_code=503,
+                content={
+                    "error": f"Không đủ bộ nhớ để xử lý file này với model {PRIMARY_MODEL_NAME} và {FALLBACK_MODEL_NAME}"
+                }
+            )
+        
+        if plan["degraded"]:
+            logger.warning(
+                f"Hạ cấp xử lý do giới hạn bộ nhớ: model {plan['model']}"
+                f"{', chia đoạn ' + str(CHUNK_SECONDS) + 's' if plan['chunked'] else ''} "
+                f"cho file {audio_duration:.0f}s"
+            )
+        
+        ass_options = {
+            "font": font,
+            "font_size": font_size,
+            "highlight_color": highlight_color,
+            "border_radius": border_radius,
+            "background_color": background_color,
+            "primary_color": primary_color,
+            "outline_color": outline_color,
+            "outline": outline,
+            "shadow": shadow,
+            "alignment": alignment,
+            "margin_l": margin_l,
+            "margin_r": margin_r,
+            "margin_v": margin_v,
+            "encoding": encoding,
+        }
+        
+        # Ghi job vào kho trạng thái với đủ tham số để chạy lại
+        job_request = {
+            "mode": mode,
+            "script_text": script_text,
+            "regroup_spec": regroup_spec,
+            "trim_silence": trim_silence,
+            "priority": priority,
+            "draft": draft,
+            "audio_duration": audio_duration,
+            "ass_options": ass_options,
+        }
+        await run_in_threadpool(set_job_input, job_id, job_request, temp_file, audio_sha256)
+        
+        # Dùng lại transcript đã có (cùng audio, mô hình và tham số) nếu replica nào đó đã xử lý
+        render = get_stage("render")
+        cache_key = transcript_cache_key(audio_sha256, plan, job_request)
+        columns = await run_in_threadpool(load_cached_transcript, cache_key)
+        if columns is not None:
+            process_time = 0.0
+            logger.info(f"Dùng transcript đã lưu cho file {file.filename} (model {plan['model']})")
+        else:
+            async def transcribe_upload(state):
+                result, timeline, process_time, used_mode = await run_planned_transcription(
+                    plan, temp_file, audio_duration, mode, script_text, trim_silence=trim_silence,
+                    priority=state["priority"], profiler=profiler, label=file.filename, ticket=state["ticket"]
+                )
+                
+                # Dựng dạng cột gọn của kết quả một lần, dùng chung cho ASS, segments và response
+                columns = await render.run(
+                    finalize_transcript if profiler is None else profiler.wrap(finalize_transcript),
+                    result, timeline, spec, cache_key, audio_sha256, plan["model"]
+                )
+                return columns, process_time, used_mode
+            
+            # Upload giống hệt đang được phiên âm (client thử lại, nhánh song song): chờ chung kết quả,
+            # mỗi request vẫn tạo file ASS theo style của riêng nó
+            single_flight = get_single_flight()
+            coalesced = cache_key in single_flight
+            if coalesced:
+                logger.info(
+                    f"Gộp với request đang phiên âm cùng file {file.filename} (model {plan['model']})",
+                    extra={"job_id": job_id, "model": plan["model"]}
+                )
+                if profiler is not None:
+                    # Phần phiên âm chạy trong request khác, profile chỉ gồm phần tiếp nhận và render
+                    profiler.coalesced = True
+            wait_start = time.time()
+            columns, process_time, mode = await single_flight.run(cache_key, transcribe_upload, priority=priority)
+            if coalesced:
+                # processing_time là thời gian request này đã chờ, thời gian của request chạy phiên âm báo riêng
+                leader_process_time = process_time
+                process_time = time.time() - wait_start
+        
+        # Chế độ nháp: file audio được giữ lại cho lần tinh chỉnh bằng mô hình chính ở nền
+        refine = draft and plan["model"] != _model_name
+        job["status"] = "refining" if refine else "final"
+        output_filename, job["version"] = await render.run(
+            render_job_version if profiler is None else profiler.wrap(render_job_version),
+            job_id, plan["model"], columns, process_time, job["status"], ass_options
+        )
+        await notify_job(job_id)
+        if refine:
+            start_resume_job(job_id)
+        else:
+            # Xóa file tạm
+            try:
+                temp_file.unlink()
+            except Exception as e:
+                logger.warning(f"Không thể xóa file tạm {temp_file}: {str(e)}")
+        
+        # Trả về URL để tải file kết quả
+        download_url = f"/download/{output_filename}"
+        
+        logger.info(
+            f"Hoàn thành phiên âm. URL tải xuống: {download_url}",
+            extra={"job_id": job_id, "model": plan["model"], "processing_time": round(process_time, 2)}
+        )
+        
+        # Tạo response chỉ với các trường được yêu cầu (segments/words chỉ tính khi cần)
+        response_info = {
+            "success": True,
+            "message": f"Đã phiên âm thành công file {file.filename}",
+            "processing_time": f"{process_time:.2f} giây",
+            "device": _device,
+            "model": plan["model"],
+            "mode": mode,
+            "download_url": download_url,
+            "job_id": job_id,
+        }
+        content = await render.run(
+            build_response_content if profiler is None else profiler.wrap(build_response_content),
+            columns, response_info, response_fields, response_format
+        )
+        if coalesced:
+            content["coalesced"] = True
+            content["leader_processing_time"] = f"{leader_process_time:.2f} giây"
+        
+        if draft:
+            content["job_id"] = job["id"]
+            content["version"] = job["version"]
+            content["job_status"] = job["status"]
+            content["job_url"] = f"/jobs/{job['id']}"
+            content["events_url"] = f"/jobs/{job['id']}/events"
+        
+        if profiler is None:
+            return await render.run(fast_json_response, content)
+        
+        # Encode JSON cũng nằm trong profile: URL của profile đã biết trước khi dừng profiler
+        content["profile_url"] = f"/profiles/{profiler.profile_id}"
+        response = await render.run(profiler.wrap(fast_json_response), content)
+        profiler.stop()
+        profiler.save()
+        return response
+    
+    except (torch.cuda.OutOfMemoryError, MemoryError) as e:
+        # Ước lượng thấp hơn thực tế: hiệu chỉnh lại và để client thử lại sau, không tự gọi lại
+        logger.error(f"Hết bộ nhớ khi phiên âm dù đã được tiếp nhận: {str(e)}")
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        # Lỗi của việc dùng chung chỉ hiệu chỉnh một lần, ở request đã chạy việc đó
+        if not coalesced:
+            record_memory_underestimate(plan["model"] if plan else PRIMARY_MODEL_NAME)
+        await run_in_threadpool(fail_job, job_id, f"Hết bộ nhớ: {str(e)}")
+        await notify_job(job_id)
+        return JSONResponse(
+            status_code=503,
+            headers={"Retry-After": str(OOM_RETRY_AFTER_SECONDS)},
+            content={
+                "error": "Không đủ bộ nhớ để xử lý file này, vui lòng thử lại sau"
+            }
+        )
+    except RuntimeError as e:
+        logger.error(f"Lỗi khi phiên âm: {str(e)}")
+        await run_in_threadpool(fail_job, job_id, f"Lỗi khi phiên âm: {str(e)}")
+        await notify_job(job_id)
+        return JSONResponse(
+            status_code=500,
+            content={
+                "error": f"Lỗi khi phiên âm: {str(e)}"
+            }
+        )
+    except Exception as e:
+        # Xử lý các lỗi khác
+        logger.error(f"Lỗi khi xử lý: {str(e)}")
+        await run_in_threadpool(fail_job, job_id, f"Lỗi khi xử lý: {str(e)}")
+        await notify_job(job_id)
+        return JSONResponse(
+            status_code=500,
+            content={
+                "error": f"Lỗi khi xử lý: {str(e)}"
+            }
+        )
+    finally:
+        if profiler is not None:
+            profiler.stop()
+
+@app.get("/profiles/{profile_id}")
+async def get_profile(profile_id: str):
+    """
+    Trả về profile đã lưu của một request.
+    
+    Args:
+        profile_id (str): Id profile trong response (profile_url)
+        
+    Returns:
+        JSON gồm bảng thời gian theo hàm, stack dạng folded và op torch (nếu có)
+    """
+    if not re.fullmatch(r"[0-9a-f]{32}", profile_id):
+        raise HTTPException(status_code=400, detail="Profile id không hợp lệ")
+    
+    profile_path = OUTPUTS_DIR / f"{profile_id}.profile.json"
+    if not profile_path.exists():
+        raise HTTPException(status_code=404, detail="Profile không tồn tại")
+    
+    return FileResponse(path=profile_path, media_type="application/json")
+
+@app.get("/download/{filename}")
+async def download_file(filename: str):
+    """
+    Tải file kết quả.
+    
+    Args:
+        filename (str): Tên file cần tải
+        
+    Returns:
+        FileResponse với file kết quả
+    """
+    file_path = OUTPUTS_DIR / filename
+    
+    if not file_path.exists():
+        # File có thể do replica khác tạo: lấy từ kho trạng thái chung
+        row = await run_in_threadpool(
+            lambda: get_db().execute("SELECT content FROM outputs WHERE filename = ?", (filename,)).fetchone()
+        )
+        if row is not None and row["content"]:
+            return Response(
+                content=row["content"],
+                media_type="text/plain",
+                headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+            )
+        logger.error(f"File không tồn tại: {file_path}")
+        raise HTTPException(status_code=404, detail="File không tồn tại")
+    
+    # Kiểm tra kích thước file
+    file_size = file_path.stat().st_size
+    if file_size == 0:
+        logger.error(f"File trống: {file_path}, kích thước: {file_size}")
+        raise HTTPException(status_code=404, detail="File trống, vui lòng thử lại")
+    
+    return FileResponse(
+        path=file_path,
+        media_type="text/plain",
+        filename=filename
+    )
+
+def process_audio_with_attention_mask(model, audio_path, language="vi", trim_silence=False, regroup_spec=None,
+                                     chunk_seconds=None):
+    """
+    Xử lý audio với transcribe mặc định và tối ưu cho phụ đề 1 dòng.
+    
+    Args:
+        model: Mô hình stable-ts đã tải
+        audio_path: Đường dẫn đến file audio
+        language: Ngôn ngữ (mặc định là "vi")
+        trim_silence (bool): Cắt khoảng lặng dài trước khi phiên âm
+        regroup_spec (dict): Cấu hình nhóm từ, mặc định là DEFAULT_REGROUP_SPEC
+        chunk_seconds (float): Nếu có, phiên âm lần lượt từng đoạn dài chunk_seconds để giới hạn bộ nhớ
+        
+    Returns:
+        WhisperResult: Kết quả phiên âm đã được tối ưu cho phụ đề 1 dòng
+    """
+    audio_input, timeline = prepare_audio_input(audio_path, trim_silence)
+    result = transcribe_audio_input(model, audio_input, chunk_seconds)
+    return finalize_result(result, timeline, regroup_spec)
+
+def transcribe_audio_input(model, audio_input, chunk_seconds=None):
+    """
+    Phần chạy mô hình của phiên âm (giai đoạn suy luận): không giải mã audio, không nhóm lại từ.
+    
+    Args:
+        model: Mô hình stable-ts đã tải
+        audio_input: Đầu vào từ prepare_audio_input (đường dẫn hoặc np.ndarray 16kHz)
+        chunk_seconds (float): Nếu có, phiên âm lần lượt từng đoạn dài chunk_seconds để giới hạn bộ nhớ
+        
+    Returns:
+        WhisperResult: Kết quả phiên âm thô, timestamp theo audio đã cắt khoảng lặng
+    """
+    if chunk_seconds:
+        return transcribe_in_chunks(model, audio_input, chunk_seconds)
+    
+    # Sử dụng transcribe với các tùy chọn tối ưu cho phụ đề
+    return model.transcribe(
+        audio_input, 
+        language="vi",  # Luôn dùng tiếng Việt
+        regroup=True,
+        word_timestamps=True,
+        vad=True,
+    )
+
+def finalize_result(result, timeline=None, regroup_spec=None):
+    """
+    Phần hậu xử lý trên CPU (giai đoạn render): đưa timestamp về audio gốc rồi nhóm lại cho phụ đề 1 dòng.
+    
+    Args:
+        result: Kết quả thô từ transcribe_audio_input/align_audio_input
+        timeline (dict): Timeline cắt khoảng lặng từ prepare_audio_input, hoặc None
+        regroup_spec (dict): Cấu hình nhóm từ, mặc định là DEFAULT_REGROUP_SPEC
+        
+    Returns:
+        WhisperResult: Kết quả đã được tối ưu cho phụ đề 1 dòng
+    """
+    # Đưa timestamp về dòng thời gian gốc trước khi nhóm lại theo khoảng lặng
+    if timeline is not None:
+        remap_result_timestamps(result, timeline)
+    
+    return regroup_for_single_line(result, regroup_spec)
+
+def transcribe_in_chunks(model, audio_input, chunk_seconds):
+    """
+    Phiên âm lần lượt từng đoạn audio rồi ghép kết quả, bộ nhớ làm việc chỉ phụ thuộc độ dài một đoạn.
+    
+    Args:
+        model: Mô hình stable-ts đã tải
+        audio_input: Đường dẫn file hoặc np.ndarray PCM 16kHz
+        chunk_seconds (float): Độ dài mỗi đoạn (giây)
+        
+    Returns:
+        WhisperResult: Kết quả đã ghép với timestamp trên toàn bộ audio
+    """
+    audio = decode_audio_pcm(audio_input) if isinstance(audio_input, str) else audio_input
+    chunk_len = int(chunk_seconds * SAMPLE_RATE)
+    n_chunks = max(1, -(-len(audio) // chunk_len))
+    logger.info(f"Phiên âm chia đoạn: {n_chunks} đoạn x {chunk_seconds}s")
+    
+    merged = None
+    for start in range(0, max(len(audio), 1), chunk_len):
+        part = model.transcribe(
+            audio[start:start + chunk_len],
+            language="vi",
+            regroup=True,
+            word_timestamps=True,
+            vad=True,
+        )
+        part.offset_time(start / SAMPLE_RATE)
+        if merged is None:
+            merged = part
+        else:
+            merged.segments.extend(part.segments)
+    
+    merged.reassign_ids()
+    return merged
+
+def align_audio_with_script(model, audio_path, script_text, language="vi", trim_silence=False, regroup_spec=None):
+    """
+    Căn chỉnh thời gian từng từ của kịch bản có sẵn với audio (forced alignment).
+    Nhanh hơn nhiều so với phiên âm đầy đủ và không có lỗi nhận dạng vì text đã biết trước.
+    Nếu căn chỉnh thất bại, quay về phiên âm thông thường.
+    
+    Args:
+        model: Mô hình stable-ts đã tải
+        audio_path: Đường dẫn đến file audio
+        script_text: Kịch bản lời thoại
+        language: Ngôn ngữ của kịch bản (mặc định là "vi")
+        trim_silence (bool): Cắt khoảng lặng dài trước khi căn chỉnh
+        regroup_spec (dict): Cấu hình nhóm từ, mặc định là DEFAULT_REGROUP_SPEC
+        
+    Returns:
+        WhisperResult: Kết quả căn chỉnh đã được tối ưu cho phụ đề 1 dòng
+    """
+    audio_input, timeline = prepare_audio_input(audio_path, trim_silence)
+    result = align_audio_input(model, audio_input, script_text, language)
+    return finalize_result(result, timeline, regroup_spec)
+
+def align_audio_input(model, audio_input, script_text, language="vi"):
+    """
+    Phần chạy mô hình của căn chỉnh (giai đoạn suy luận). Nếu căn chỉnh thất bại hoặc dừng giữa chừng
+    (stable-ts trả kết quả dở dang, đã bỏ các từ chưa căn), phiên âm lại trên cùng đầu vào đã chuẩn bị.
+    
+    Args:
+        model: Mô hình stable-ts đã tải
+        audio_input: Đầu vào từ prepare_audio_input (đường dẫn hoặc np.ndarray 16kHz)
+        script_text: Kịch bản lời thoại
+        language: Ngôn ngữ của kịch bản (mặc định là "vi")
+        
+    Returns:
+        WhisperResult: Kết quả thô, timestamp theo audio đã cắt khoảng lặng
+    """
+    script_text = script_text.strip()
+    result = model.align(
+        audio_input,
+        script_text,
+        language=language,
+        regroup=True,
+        vad=True,
+        remove_instant_words=True,
+        failure_threshold=ALIGN_FAILURE_THRESHOLD,  # Bỏ cuộc nếu quá nhiều từ có độ dài bằng 0
+    )
+    
+    if result is None or not result.segments:
+        logger.warning("Căn chỉnh theo kịch bản thất bại, chuyển sang phiên âm thông thường")
+        return transcribe_audio_input(model, audio_input)
+    
+    # Khi bỏ cuộc, stable-ts vẫn trả các từ đã căn được: thiếu quá nhiều từ nghĩa là phụ đề bị cụt
+    script_words = len(script_text.split())
+    aligned_words = sum(len(segment.words) for segment in result.segments)
+    if aligned_words < script_words * (1 - ALIGN_FAILURE_THRESHOLD):
+        logger.warning(
+            f"Căn chỉnh dừng giữa chừng ({aligned_words}/{script_words} từ), chuyển sang phiên âm thông thường"
+        )
+        return transcribe_audio_input(model, audio_input)
+    
+    logger.info(f"Đã căn chỉnh kịch bản với audio: {len(result.segments)} segments")
+    return result
+
+def decode_audio_pcm(audio_path, sample_rate=SAMPLE_RATE):
+    """
+    Giải mã file audio/video thành PCM mono float32 bằng ffmpeg.
+    
+    Args:
+        audio_path: Đường dẫn đến file audio
+        sample_rate (int): Tần số lấy mẫu đầu ra
+        
+    Returns:
+        np.ndarray: Mảng float32 trong khoảng [-1, 1]
+    """
+    cmd = [
+        "ffmpeg", "-nostdin", "-v", "error",
+        "-i", str(audio_path),
+        "-vn", "-ac", "1", "-ar", str(sample_rate),
+        "-f", "s16le", "-"
+    ]
+    proc = subprocess.run(cmd, capture_output=True, check=True)
+    return np.frombuffer(proc.stdout, dtype=np.int16).astype(np.float32) / 32768.0
+
+def find_silence_trim_timeline(audio, sample_rate=SAMPLE_RATE):
+    """
+    Tìm các khoảng lặng dài bằng phân tích năng lượng theo frame (vector hóa với NumPy)
+    và xác định các đoạn audio cần giữ lại.
+    
+    Args:
+        audio (np.ndarray): PCM mono float32
+        sample_rate (int): Tần số lấy mẫu
+        
+    Returns:
+        dict hoặc None: {"keep": mảng [N, 2] mẫu bắt đầu/kết thúc cần giữ,
+                         "compact_starts": thời điểm bắt đầu từng đoạn trên audio đã cắt (giây),
+                         "original_starts": thời điểm bắt đầu từng đoạn trên audio gốc (giây),
+                         "removed": tổng thời gian đã cắt (giây)}
+                        None nếu không có khoảng lặng nào đáng cắt
+    """
+    frame_len = int(sample_rate * SILENCE_FRAME_MS / 1000)
+    n_frames = len(audio) // frame_len
+    if n_frames == 0:
+        return None
+    
+    # Năng lượng RMS của từng frame (dB)
+    frames = audio[:n_frames * frame_len].reshape(n_frames, frame_len)
+    rms = np.sqrt(np.mean(np.square(frames, dtype=np.float64), axis=1))
+    energy_db = 20.0 * np.log10(rms + 1e-10)
+    
+    threshold = max(SILENCE_FLOOR_DB, float(np.percentile(energy_db, 95)) - SILENCE_RELATIVE_DB)
+    silent = energy_db < threshold
+    
+    # Tìm các chuỗi frame im lặng liên tiếp
+    edges = np.diff(np.concatenate(([0], silent.astype(np.int8), [0])))
+    run_starts = np.flatnonzero(edges == 1)
+    run_ends = np.flatnonzero(edges == -1)
+    
+    min_frames = int(SILENCE_MIN_DURATION * 1000 / SILENCE_FRAME_MS)
+    pad_frames = int(SILENCE_PAD * 1000 / SILENCE_FRAME_MS)
+    long_runs = (run_ends - run_starts) >= min_frames
+    run_starts, run_ends = run_starts[long_runs], run_ends[long_runs]
+    if len(run_starts) == 0:
+        return None
+    
+    # Giữ lại khoảng đệm ở phía có giọng nói (không đệm ở đầu và cuối file)
+    cut_starts = np.where(run_starts == 0, 0, run_starts + pad_frames)
+    cut_ends = np.where(run_ends == n_frames, n_frames, run_ends - pad_frames)
+    valid = cut_ends > cut_starts
+    cut_starts, cut_ends = cut_starts[valid], cut_ends[valid]
+    if len(cut_starts) == 0:
+        return None
+    
+    # Phần bù của các đoạn bị cắt là các đoạn cần giữ
+    keep_starts = np.concatenate(([0], cut_ends)) * frame_len
+    keep_ends = np.concatenate((cut_starts, [n_frames])) * frame_len
+    keep_ends[-1] = len(audio)
+    non_empty = keep_ends > keep_starts
+    keep = np.stack((keep_starts[non_empty], keep_ends[non_empty]), axis=1)
+    if len(keep) == 0:
+        return None
+    
+    lengths = keep[:, 1] - keep[:, 0]
+    compact_starts = np.concatenate(([0], np.cumsum(lengths)[:-1])) / sample_rate
+    return {
+        "keep": keep,
+        "compact_starts": compact_starts,
+        "original_starts": keep[:, 0] / sample_rate,
+        "removed": (len(audio) - int(lengths.sum())) / sample_rate,
+    }
+
+def prepare_audio_input(audio_path, trim_silence=True):
+    """
+    Chuẩn bị đầu vào cho mô hình: nếu bật trim_silence, giải mã audio và cắt các khoảng lặng dài.
+    
+    Args:
+        audio_path: Đường dẫn đến file audio
+        trim_silence (bool): Có cắt khoảng lặng hay không
+        
+    Returns:
+        tuple: (đầu vào cho mô hình - đường dẫn hoặc np.ndarray 16kHz, timeline hoặc None)
+    """
+    if not trim_silence:
+        return str(audio_path), None
+    
+    try:
+        audio = decode_audio_pcm(audio_path)
+    except Exception as e:
+        logger.warning(f"Không thể giải mã audio để cắt khoảng lặng, dùng file gốc: {str(e)}")
+        return str(audio_path), None
+    
+    timeline = find_silence_trim_timeline(audio)
+    if timeline is None:
+        return audio, None
+    
+    compact = np.concatenate([audio[start:end] for start, end in timeline["keep"]])
+    logger.info(
+        f"Đã cắt {timeline['removed']:.2f}s khoảng lặng "
+        f"({len(audio) / SAMPLE_RATE:.2f}s -> {len(compact) / SAMPLE_RATE:.2f}s)"
+    )
+    return compact, timeline
+
+def remap_result_timestamps(result, timeline):
+    """
+    Đưa timestamp của các từ/segment từ audio đã cắt khoảng lặng về dòng thời gian gốc.
+    
+    Args:
+        result: Kết quả phiên âm (WhisperResult), được sửa tại chỗ
+        timeline (dict): Kết quả của find_silence_trim_timeline
+    """
+    compact_starts = timeline["compact_starts"]
+    offsets = timeline["original_starts"] - compact_starts
+    
+    def remap(times, side):
+        # Thời điểm kết thúc đúng tại ranh giới thuộc về đoạn trước (side="left")
+        idx = np.searchsorted(compact_starts, times, side=side) - 1
+        idx = np.clip(idx, 0, len(compact_starts) - 1)
+        return times + offsets[idx]
+    
+    for segment in result.segments:
+        if segment.words:
+            starts = remap(np.array([w.start for w in segment.words]), "right")
+            ends = np.maximum(remap(np.array([w.end for w in segment.words]), "left"), starts)
+            for word, start, end in zip(segment.words, starts, ends):
+                word.start = round(float(start), 3)
+                word.end = round(float(end), 3)
+        else:
+            segment.start = round(float(remap(np.array([segment.start]), "right")[0]), 3)
+            segment.end = round(float(remap(np.array([segment.end]), "left")[0]), 3)
+
+def parse_regroup_spec(spec_json):
+    """
+    Đọc cấu hình nhóm từ dạng JSON từ request và ghép với DEFAULT_REGROUP_SPEC.
+    
+    Args:
+        spec_json (str): Chuỗi JSON chứa các khóa cần ghi đè, hoặc None
+        
+    Returns:
+        dict: Cấu hình đầy đủ
+        
+    Raises:
+        ValueError: Nếu JSON hoặc giá trị không hợp lệ
+    """
+    spec = dict(DEFAULT_REGROUP_SPEC)
+    if not spec_json or not spec_json.strip():
+        return spec
+    
+    try:
+        overrides = json.loads(spec_json)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"JSON lỗi: {str(e)}")
+    if not isinstance(overrides, dict):
+        raise ValueError("phải là một object JSON")
+    
+    unknown = set(overrides) - set(DEFAULT_REGROUP_SPEC)
+    if unknown:
+        raise ValueError(f"khóa không hỗ trợ: {', '.join(sorted(unknown))}")
+    
+    for key, value in overrides.items():
+        if key.endswith("_punctuation"):
+            if not isinstance(value, list):
+                raise ValueError(f"{key} phải là danh sách")
+            punctuation = []
+            for p in value:
+                # Cặp [kết thúc, bắt đầu] được chuyển thành tuple như stable-ts
+                if isinstance(p, list) and len(p) == 2 and all(isinstance(x, str) for x in p):
+                    punctuation.append(tuple(p))
+                elif isinstance(p, str) and p:
+                    punctuation.append(p)
+                else:
+                    raise ValueError(f"{key} chứa phần tử không hợp lệ: {p!r}")
+            spec[key] = punctuation
+        elif key == "ignore_special_periods":
+            if not isinstance(value, bool):
+                raise ValueError(f"{key} phải là true/false")
+            spec[key] = value
+        else:
+            # Các tham số số học, None/0 để tắt bước tương ứng
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0):
+                raise ValueError(f"{key} phải là số không âm hoặc null")
+            if key in ("clause_min_chars", "max_chars") and value is not None:
+                value = int(value)
+            spec[key] = value
+    
+    return spec
+
+def _is_special_period(word):
+    """
+    Kiểm tra từ có dấu chấm không phải kết thúc câu (viết tắt, số thứ tự...) như stable-ts.
+    """
+    if not word.endswith('.'):
+        return False
+    word = word.strip()
+    if re.search('^[A-Z0-9]', word) is None:
+        return False
+    return len(re.sub('[.A-Z0-9]', '', word)) < 3
+
+def _punctuation_split_indices(words, start, end, punctuation):
+    """
+    Tìm các vị trí ngắt theo dấu câu trong đoạn words[start:end] (giống Segment.get_punctuation_indices).
+    """
+    indices = set()
+    for p in punctuation:
+        if isinstance(p, str):
+            for i in range(start, end - 1):
+                if words[i].word.endswith(p):
+                    indices.add(i)
+                elif i != start and words[i].word.startswith(p):
+                    indices.add(i - 1)
+        else:
+            ending, beginning = p
+            for i in range(start, end - 1):
+                if words[i].word.endswith(ending) and words[i + 1].word.startswith(beginning):
+                    indices.add(i)
+    return indices
+
+def _length_split_indices(lengths, start, end, max_chars):
+    """
+    Tìm các vị trí chia đều đoạn [start, end) theo số ký tự (giống split_by_length với even_split).
+    
+    Args:
+        lengths (list): Số ký tự của từng từ trong segment
+    """
+    char_count = sum(lengths[start:end])
+    if end - start < 2 or char_count <= max_chars:
+        return set()
+    splits = np.ceil(char_count / max_chars)
+    chars_per_split = char_count / splits
+    cum_char_count = np.cumsum(lengths[start:end - 1])
+    return {
+        start + int(np.abs(cum_char_count - (i * chars_per_split)).argmin())
+        for i in range(1, int(splits))
+    }
+
+def _clamp_word_range(words, durations, start, end, medium_factor):
+    """
+    Giới hạn độ dài từ đầu và từ cuối của đoạn [start, end) (giống WhisperResult.clamp_max).
+    
+    Args:
+        durations (list): Độ dài từng từ trong segment, được cập nhật khi từ bị giới hạn
+    """
+    if not medium_factor or end - start < 2:
+        return
+    # Trung vị tính bằng numpy như stable-ts: max_dur là np.float64 nên làm tròn timestamp giống hệt
+    max_dur = medium_factor * np.sort(durations[start:end])[(end - start) // 2]
+    if not max_dur:
+        return
+    words[start].clamp_max(max_dur, clip_start=True)
+    words[end - 1].clamp_max(max_dur, clip_start=False)
+    durations[start] = words[start].duration
+    durations[end - 1] = words[end - 1].duration
+
+def _split_range(start, end, indices):
+    """
+    Chia đoạn [start, end) thành các đoạn con, ngắt ngay sau mỗi vị trí trong indices.
+    """
+    ranges = []
+    for i in sorted(indices):
+        ranges.append((start, i + 1))
+        start = i + 1
+    ranges.append((start, end))
+    return ranges
+
+def regroup_for_single_line(result, spec=None):
+    """
+    Nhóm lại các từ trong kết quả để tối ưu cho phụ đề 1 dòng.
+    Dùng chung cho cả chế độ phiên âm và căn chỉnh.
+    
+    Thực hiện trong một lượt duyệt duy nhất qua các từ, cho kết quả giống hệt chuỗi
+    clamp_max -> split_by_punctuation -> split_by_gap -> split_by_punctuation(min_chars)
+    -> split_by_length -> clamp_max của stable-ts (xem regroup_with_chain) nhưng không
+    phải tạo lại toàn bộ segment sau mỗi bước.
+    
+    Args:
+        result: Kết quả phiên âm hoặc căn chỉnh (WhisperResult)
+        spec (dict): Cấu hình nhóm từ, mặc định là DEFAULT_REGROUP_SPEC
+        
+    Returns:
+        WhisperResult: Kết quả đã được nhóm lại (thay đổi tại chỗ)
+    """
+    spec = spec or DEFAULT_REGROUP_SPEC
+    
+    # Cần timestamp từng từ để nhóm trong một lượt, nếu không có thì dùng chuỗi của stable-ts
+    if not result.has_words:
+        return regroup_with_chain(result, spec)
+    
+    medium_factor = spec["clamp_medium_factor"]
+    max_gap = spec["max_gap"]
+    clause_min_chars = spec["clause_min_chars"]
+    max_chars = spec["max_chars"]
+    skip_special = spec["ignore_special_periods"]
+    
+    def can_split(words, i):
+        if words[i + 1].left_locked or words[i].right_locked:
+            return False
+        return not (skip_special and _is_special_period(words[i].word))
+    
+    new_segments = []
+    for segment in result.segments:
+        words = segment.words
+        n = len(words)
+        lengths = [len(word.word) for word in words]
+        durations = [word.duration for word in words]
+        _clamp_word_range(words, durations, 0, n, medium_factor)
+        
+        # Ranh giới câu: dấu kết câu hoặc khoảng lặng lớn, chỉ phụ thuộc vào cặp từ liền kề
+        sentence_breaks = _punctuation_split_indices(words, 0, n, spec["sentence_punctuation"])
+        
+        piece_start = 0
+        for i in range(n):
+            is_break = i == n - 1
+            if not is_break and can_split(words, i):
+                is_break = i in sentence_breaks or (
+                    max_gap is not None and words[i + 1].start - words[i].end > max_gap
+                )
+            if not is_break:
+                continue
+            
+            # Đoạn câu đã hoàn chỉnh: ngắt tiếp theo dấu phẩy rồi theo độ dài
+            piece_end = i + 1
+            clause_ranges = [(piece_start, piece_end)]
+            char_count = sum(lengths[piece_start:piece_end])
+            if not clause_min_chars or char_count >= clause_min_chars:
+                indices = _punctuation_split_indices(
+                    words, piece_start, piece_end, spec["clause_punctuation"]
+                )
+                indices = {j for j in indices if can_split(words, j)}
+                clause_ranges = _split_range(piece_start, piece_end, indices)
+            
+            for clause_start, clause_end in clause_ranges:
+                line_ranges = [(clause_start, clause_end)]
+                if max_chars:
+                    indices = _length_split_indices(lengths, clause_start, clause_end, max_chars)
+                    if skip_special:
+                        indices = {j for j in indices if not _is_special_period(words[j].word)}
+                    line_ranges = _split_range(clause_start, clause_end, indices)
+                
+                for line_start, line_end in line_ranges:
+                    _clamp_word_range(words, durations, line_start, line_end, medium_factor)
+                    if line_start == 0 and line_end == n:
+                        new_segments.append(segment)
+                    else:
+                        new_segments.append(segment.copy(words[line_start:line_end]))
+            
+            piece_start = piece_end
+    
+    result.segments = new_segments
+    result.reassign_ids()
+    
+    logger.info(f"Đã tối ưu kết quả phiên âm với regroup và ngắt theo dấu câu cho phụ đề 1 dòng")
+    
+    return result
+
+def regroup_with_chain(result, spec=None):
+    """
+    Nhóm lại các từ bằng chuỗi phương thức regroup của stable-ts.
+    Dùng khi kết quả không có timestamp từng từ và làm chuẩn đối chiếu cho regroup_for_single_line.
+    
+    Args:
+        result: Kết quả phiên âm hoặc căn chỉnh (WhisperResult)
+        spec (dict): Cấu hình nhóm từ, mặc định là DEFAULT_REGROUP_SPEC
+        
+    Returns:
+        WhisperResult: Kết quả đã được nhóm lại (thay đổi tại chỗ)
+    """
+    spec = spec or DEFAULT_REGROUP_SPEC
+    
+    result.ignore_special_periods(spec["ignore_special_periods"])
+    if spec["clamp_medium_factor"]:
+        result.clamp_max(medium_factor=spec["clamp_medium_factor"])
+    result.split_by_punctuation(spec["sentence_punctuation"])
+    if spec["max_gap"] is not None:
+        result.split_by_gap(spec["max_gap"])
+    result.split_by_punctuation(spec["clause_punctuation"], min_chars=spec["clause_min_chars"])
+    if spec["max_chars"]:
+        result.split_by_length(spec["max_chars"])
+    if spec["clamp_medium_factor"]:
+        result.clamp_max(medium_factor=spec["clamp_medium_factor"])
+    
+    logger.info(f"Đã tối ưu kết quả phiên âm với regroup và ngắt theo dấu câu cho phụ đề 1 dòng")
+    
+    return result
+
+def _sec2ass(seconds):
+    """
+    Chuyển số giây sang định dạng thời gian của ASS (H:MM:SS.cc).
+    """
+    mm, ss = divmod(seconds, 60)
+    hh, mm = divmod(mm, 60)
+    return f'{hh:0>1.0f}:{mm:0>2.0f}:{ss:0>2.2f}'
+
+def _merge_short_items(items, min_dur, duration):
+    """
+    Gộp các phần tử ngắn hơn min_dur với phần tử kề bên (giống apply_min_dur của stable-ts).
+    
+    Args:
+        items (list): Danh sách phần tử, mỗi phần tử là (chỉ số đầu, chỉ số cuối) trên mảng từ
+        min_dur (float): Độ dài tối thiểu
+        duration (callable): Hàm tính độ dài của một phần tử
+        
+    Returns:
+        list: Danh sách phần tử sau khi gộp (sửa tại chỗ)
+    """
+    max_i = len(items) - 1
+    if max_i == 0:
+        return items
+    for i in reversed(range(len(items))):
+        if max_i == 0:
+            break
+        if duration(items[i]) < min_dur:
+            if i == max_i:
+                i0 = i - 1
+            elif i == 0:
+                i0 = i
+            elif duration(items[i + 1]) < duration(items[i - 1]):
+                i0 = i - 1
+            else:
+                i0 = i
+            items[i0] = (items[i0][0], items[i0 + 1][1])
+            del items[i0 + 1]
+            max_i -= 1
+    return items
+
+def render_ass_from_columns(columns, style_kwargs, min_dur=ASS_MIN_DUR):
+    """
+    Tạo nội dung ASS với highlight từng từ (tag karaoke \\k) trực tiếp từ dạng cột,
+    cùng định dạng với WhisperResult.to_ass nhưng không phải sao chép toàn bộ kết quả.
+    
+    Args:
+        columns (dict): Dạng cột của kết quả phiên âm (build_result_columns)
+        style_kwargs (dict): Các tham số style Default (Fontname, Fontsize, PrimaryColour...)
+        min_dur (float): Từ/segment ngắn hơn giá trị này được gộp với từ/segment kề bên
+        
+    Returns:
+        str: Nội dung file ASS
+    """
+    groups = ass_event_groups(columns, min_dur)
+    blocks = render_ass_events(columns, groups, range(len(groups)), min_dur)
+    return render_ass_header(style_kwargs) + '\n'.join(blocks)
+
+def render_ass_header(style_kwargs):
+    """
+    Phần đầu của file ASS (Script Info, style Default, Format của Events).
+    """
+    style = dict(ASS_DEFAULT_STYLE)
+    for key, value in style_kwargs.items():
+        if key not in style:
+            continue
+        if 'colour' in key.lower() and not str(value).startswith('&H'):
+            value = f'&H{value}'
+        style[key] = value
+    
+    return (
+        f'[Script Info]\nScriptType: v4.00+\nPlayResX: 384\nPlayResY: 288\nScaledBorderAndShadow: yes\n\n'
+        f'[V4+ Styles]\nFormat: {", ".join(map(str, style.keys()))}\n'
+        f'Style: {",".join(map(str, style.values()))}\n\n'
+        f'[Events]\nFormat: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n\n'
+    )
+
+def ass_event_groups(columns, min_dur=ASS_MIN_DUR):
+    """
+    Chia các từ thành các event ASS: mỗi segment một event, segment quá ngắn được gộp với segment kề bên.
+    
+    Returns:
+        list: Các cặp (chỉ số từ đầu, chỉ số từ cuối) của từng event
+    """
+    offsets = columns["segment_offsets"].tolist()
+    segments = list(zip(offsets[:-1], offsets[1:]))
+    
+    # Gộp segment quá ngắn (hiếm gặp, chỉ chạy vòng lặp khi thực sự có)
+    if len(segments) > 1:
+        seg_starts, seg_ends = columns_segment_times(columns)
+        if np.any(seg_ends - seg_starts < min_dur):
+            starts = columns["word_start"].tolist()
+            ends = columns["word_end"].tolist()
+            segments = _merge_short_items(
+                segments, min_dur, lambda item: ends[item[1] - 1] - starts[item[0]]
+            )
+    return segments
 
-@app.get("/download/{filename}")
-async def download_file(filename: str):
+def render_ass_events(columns, groups, indices, min_dur=ASS_MIN_DUR):
     """
-    Tải file kết quả.
+    Tạo các dòng Dialogue (chưa bo góc) cho những event được chọn.
     
     Args:
-        filename (str): Tên file cần tải
+        columns (dict): Dạng cột của kết quả phiên âm
+        groups (list): Kết quả của ass_event_groups
+        indices: Chỉ số các event cần tạo (chỉ số cũng là layer của dòng Dialogue)
+        min_dur (float): Từ ngắn hơn giá trị này được gộp với từ kề bên
         
     Returns:
-        FileResponse với file kết quả
+        list: Các dòng Dialogue theo thứ tự của indices (không có ký tự xuống dòng)
     """
-    file_path = OUTPUTS_DIR / filename
+    text = columns["text"]
+    char_offsets = columns["word_offsets"].tolist()
+    word_start = columns["word_start"]
+    word_end = columns["word_end"]
+    starts = word_start.tolist()
+    ends = word_end.tolist()
     
-    if not file_path.exists():
-        logger.error(f"File không tồn tại: {file_path}")
-        raise HTTPException(status_code=404, detail="File không tồn tại")
+    # Từ đã gộp có start/end là min/max của các từ thành phần
+    def word_duration(item):
+        return round(max(ends[item[0]:item[1]]) - min(starts[item[0]:item[1]]), 3)
     
-    # Kiểm tra kích thước file
-    file_size = file_path.stat().st_size
-    if file_size == 0:
-        logger.error(f"File trống: {file_path}, kích thước: {file_size}")
-        raise HTTPException(status_code=404, detail="File trống, vui lòng thử lại")
+    # Lọc nhanh các segment có từ quá ngắn bằng vector, kiểm tra chính xác khi gộp
+    maybe_short = (word_end - word_start) < (min_dur + 0.001)
     
-    return FileResponse(
-        path=file_path,
-        media_type="text/plain",
-        filename=filename
+    blocks = []
+    for idx in indices:
+        a, b = groups[idx]
+        if not columns["has_words"]:
+            seg_start, seg_end = starts[a], ends[b - 1]
+            line = text[char_offsets[a]:char_offsets[b]]
+        else:
+            words = [(i, i + 1) for i in range(a, b)]
+            if b - a > 1 and maybe_short[a:b].any():
+                words = _merge_short_items(words, min_dur, word_duration)
+            
+            line = ''
+            for wa, wb in words:
+                word = text[char_offsets[wa]:char_offsets[wb]]
+                start, end = min(starts[wa:wb]), max(ends[wa:wb])
+                word, space = (word[1:], " ") if word.startswith(" ") else (word, "")
+                line += space + r"{\k" + f"{round((end - start) * 100)}" + r"}" + word
+            
+            seg_start = min(starts[words[0][0]:words[0][1]])
+            seg_end = max(ends[words[-1][0]:words[-1][1]])
+        
+        line = line.strip().replace('\n ', '\n')
+        blocks.append(f'Dialogue: {idx},{_sec2ass(seg_start)},{_sec2ass(seg_end)},Default,,0,0,0,,{line}')
+    
+    return blocks
+
+def build_ass_style_kwargs(font, font_size, background_color, primary_color, outline_color,
+                           outline, shadow, alignment, margin_l, margin_r, encoding):
+    """
+    Tham số style Default của file ASS từ các tham số định dạng của /transcribe.
+    """
+    return {
+        'Name': 'Default',
+        'Fontname': font,
+        'Fontsize': font_size,
+        'PrimaryColour': f"&H00{primary_color}",
+        'OutlineColour': f"&H00{outline_color}",
+        'BackColour': f"&H{background_color}",
+        'Bold': 0,
+        'Italic': 0,
+        'Underline': 0,
+        'StrikeOut': 0,
+        'ScaleX': 100,
+        'ScaleY': 100,
+        'Spacing': 0,
+        'Angle': 0,
+        'BorderStyle': 1,
+        'Outline': outline,
+        'Shadow': shadow,
+        'Alignment': alignment,
+        'MarginL': margin_l,
+        'MarginR': margin_r,
+        'MarginV': 0,
+        'Encoding': encoding
+    }
+
+def fix_ass_content(ass_content, font_size, highlight_color):
+    """
+    Sửa lại nội dung ASS (danh sách dòng, sửa tại chỗ) để đảm bảo font size
+    và highlight color được áp dụng đúng.
+    """
+    # Chuyển đổi highlight_color từ định dạng RGB sang BGR (ASS sử dụng BGR)
+    highlight_color_bgr = highlight_color
+    if len(highlight_color) == 6:
+        # Nếu highlight_color là RGB, chuyển sang BGR
+        r, g, b = highlight_color[:2], highlight_color[2:4], highlight_color[4:]
+        highlight_color_bgr = b + g + r
+        logger.info(f"Đã chuyển đổi highlight_color từ RGB {highlight_color} sang BGR {highlight_color_bgr}")
+    
+    # Sửa lại nội dung ASS để đảm bảo font size và highlight color được áp dụng đúng
+    try:
+        # Tìm và sửa style Default
+        for i, line in enumerate(ass_content):
+            if line.startswith("Style: Default,"):
+                parts = line.split(',')
+                if len(parts) > 2:
+                    # Đảm bảo font size đúng
+                    original_font_size = parts[2]
+                    parts[2] = str(font_size)
+                    logger.info(f"Đã thay đổi font size từ {original_font_size} thành {font_size} trong style Default")
+                ass_content[i] = ','.join(parts)
+    
+        # Kiểm tra và thêm highlight color vào các dòng Dialogue
+        highlight_found = False
+        for i, line in enumerate(ass_content):
+            if line.startswith("Dialogue:") and "\\1c&H" in line:
+                highlight_found = True
+                break
+    
+        if not highlight_found:
+            logger.warning(f"Không tìm thấy highlight color trong file ASS. Highlight color đã cài đặt: {highlight_color}")
+    
+            # Thêm highlight color vào các dòng Dialogue
+            modified_lines = 0
+            for i, line in enumerate(ass_content):
+                if line.startswith("Dialogue:") and "Default" in line and "{\\k" in line:
+                    # Tìm vị trí của tag karaoke đầu tiên
+                    parts = line.split(',', 9)
+                    if len(parts) >= 10:
+                        text = parts[9]
+                        # Thêm tag highlight color vào mỗi tag karaoke
+                        modified_text = text.replace("{\\k", "{\\1c&H" + highlight_color_bgr + "&\\k")
+                        # Cập nhật dòng với highlight color
+                        parts[9] = modified_text
+                        ass_content[i] = ','.join(parts)
+                        modified_lines += 1
+            logger.info(f"Đã thêm highlight color vào {modified_lines} dòng Dialogue")
+    
+        logger.info(f"Đã sửa lại file ASS để đảm bảo font size: {font_size} và highlight color: {highlight_color}")
+    except Exception as e:
+        logger.error(f"Lỗi khi sửa lại file ASS: {str(e)}")
+
+def render_ass_output(columns, output_path, font, font_size, highlight_color, border_radius,
+                      background_color, primary_color, outline_color, outline, shadow,
+                      alignment, margin_l, margin_r, margin_v, encoding):
+    """
+    Tạo file ASS hoàn chỉnh (style, highlight từng từ, bo góc) từ dạng cột của kết quả.
+    
+    Args:
+        columns (dict): Dạng cột của kết quả phiên âm (build_result_columns)
+        output_path (Path): File ASS đầu ra
+        Các tham số còn lại: tham số định dạng ASS giống /transcribe
+    """
+    # Tạo ASS subtitle với word-level timing
+    logger.info(f"Tạo file ASS với highlight_color: {highlight_color}, font_size: {font_size}")
+    ass_style_kwargs = build_ass_style_kwargs(
+        font, font_size, background_color, primary_color, outline_color,
+        outline, shadow, alignment, margin_l, margin_r, encoding
     )
+    ass_content = render_ass_from_columns(columns, ass_style_kwargs).splitlines(keepends=True)
+    fix_ass_content(ass_content, font_size, highlight_color)
+    
+    # Chỉ một phần nhỏ request ghi nội dung mẫu của file ASS, lấy thẳng từ bộ nhớ
+    sample_dump = ASS_DEBUG_SAMPLE_RATE > 0 and random.random() < ASS_DEBUG_SAMPLE_RATE
+    if sample_dump:
+        log_ass_sample("TRƯỚC KHI áp dụng bo góc", ass_content, dialogues=5)
+    
+    # Áp dụng bo góc trực tiếp trên nội dung trong bộ nhớ
+    logger.info(f"Áp dụng bo góc với bán kính {border_radius}")
+    try:
+        rounded_content = apply_rounded_borders(ass_content, output_path, border_radius)
+        if sample_dump:
+            # 10 dòng Dialogue đầu tiên (bao gồm cả background)
+            log_ass_sample("SAU KHI áp dụng bo góc", rounded_content, dialogues=10)
+    except Exception as e:
+        logger.error(f"Lỗi khi áp dụng bo góc: {str(e)}")
+        # Nếu có lỗi, sử dụng nội dung gốc
+        with open(output_path, 'w', encoding='utf-8') as f:
+            f.writelines(ass_content)
 
-def process_audio_with_attention_mask(model, audio_path, language="vi"):
+def render_ass_incremental(columns, old_columns, old_lines, segment_map, output_path, font, font_size,
+                           highlight_color, border_radius, background_color, primary_color, outline_color,
+                           outline, shadow, alignment, margin_l, margin_r, margin_v, encoding):
     """
-    Xử lý audio với transcribe mặc định và tối ưu cho phụ đề 1 dòng.
+    Tạo file ASS sau khi sửa transcript: chỉ tạo lại các event (dòng Dialogue và nền Background
+    bo góc) có segment thay đổi, các event khác lấy lại từ file ASS của phiên bản trước.
+    Kết quả giống hệt render_ass_output trên toàn bộ dạng cột mới.
     
     Args:
-        model: Mô hình stable-ts đã tải
-        audio_path: Đường dẫn đến file audio
-        language: Ngôn ngữ (mặc định là "vi")
+        columns (dict): Dạng cột sau khi sửa
+        old_columns (dict): Dạng cột của phiên bản trước
+        old_lines (list): Các dòng file ASS của phiên bản trước
+        segment_map (np.ndarray): Ánh xạ segment mới -> segment cũ từ apply_transcript_edits
+        output_path (Path): File ASS đầu ra
+        Các tham số còn lại: tham số định dạng ASS giống /transcribe
         
     Returns:
-        WhisperResult: Kết quả phiên âm đã được tối ưu cho phụ đề 1 dòng
+        tuple: (số event tạo lại, số event dùng lại), hoặc None nếu file cũ không khớp
+               với phiên bản trước (cần tạo lại toàn bộ)
     """
-    # Sử dụng transcribe với các tùy chọn tối ưu cho phụ đề
-    result = model.transcribe(
-        str(audio_path), 
-        language="vi",  # Luôn dùng tiếng Việt
-        regroup=True,
-        word_timestamps=True,
-        vad=True,
-    )
+    old_groups = ass_event_groups(old_columns)
+    first_event = next((i for i, line in enumerate(old_lines) if line.startswith("Dialogue:")), None)
+    if first_event is None:
+        return None
+    prefix, old_events = old_lines[:first_event], old_lines[first_event:]
+    if len(old_events) != 2 * len(old_groups) or not all(line.startswith("Dialogue:") for line in old_events):
+        return None
+    
+    def segment_ranges(groups, segment_offsets):
+        bounds = np.array(groups, dtype=np.int64).reshape(-1, 2)
+        return (np.searchsorted(segment_offsets, bounds[:, 0], side="right") - 1,
+                np.searchsorted(segment_offsets, bounds[:, 1]))
     
-    # Tối ưu thêm kết quả với các phương pháp chaining
-    (
-        result
-        .ignore_special_periods()
-        .clamp_max()
-        .split_by_punctuation([('.', ' '), '。', '?', '？', '!', '！'])
-        .split_by_gap(0.5)
-        .split_by_punctuation([(',', ' '), '，', ';', '；'], min_chars=20)  # Tăng lên 20 từ
-        .split_by_length(20)  # Tăng lên 20 từ
-        .clamp_max()
+    # Event cũ theo khoảng segment: (segment đầu, segment cuối + 1) -> chỉ số event
+    old_lo, old_hi = segment_ranges(old_groups, old_columns["segment_offsets"])
+    old_keys = {key: index for index, key in enumerate(zip(old_lo.tolist(), old_hi.tolist()))}
+    
+    # Event mới dùng lại được nếu mọi segment của nó không đổi, liền nhau và trùng khớp một event cũ
+    groups = ass_event_groups(columns)
+    lo, hi = segment_ranges(groups, columns["segment_offsets"])
+    changed_count = np.concatenate(([0], np.cumsum(segment_map < 0)))
+    candidates = np.flatnonzero(
+        (changed_count[hi] == changed_count[lo]) & (segment_map[hi - 1] - segment_map[lo] == hi - lo - 1)
     )
+    reused = {}
+    for index, first, last in zip(candidates.tolist(), segment_map[lo[candidates]].tolist(),
+                                  segment_map[hi[candidates] - 1].tolist()):
+        old_index = old_keys.get((first, last + 1))
+        if old_index is not None:
+            reused[index] = old_index
+    changed = [index for index in range(len(groups)) if index not in reused]
     
-    logger.info(f"Đã tối ưu kết quả phiên âm với regroup và ngắt theo dấu câu cho phụ đề 1 dòng")
+    # Tạo và bo góc riêng các event thay đổi trên một file ASS nhỏ chỉ gồm phần đầu và các event đó
+    rendered = []
+    if changed:
+        ass_style_kwargs = build_ass_style_kwargs(
+            font, font_size, background_color, primary_color, outline_color,
+            outline, shadow, alignment, margin_l, margin_r, encoding
+        )
+        ass_content = render_ass_header(ass_style_kwargs).splitlines(keepends=True)
+        ass_content += [line + "\n" for line in render_ass_events(columns, groups, changed)]
+        fix_ass_content(ass_content, font_size, highlight_color)
+        rendered = [line for line in apply_rounded_borders(ass_content, None, border_radius) if line.startswith("Dialogue:")]
     
-    return result
+    events = []
+    rendered_pairs = iter(zip(rendered[0::2], rendered[1::2]))
+    for index in range(len(groups)):
+        if index in reused:
+            old_index = reused[index]
+            background, dialogue = old_events[2 * old_index], old_events[2 * old_index + 1]
+            # Layer của dòng Dialogue là thứ tự event (tối thiểu 1)
+            dialogue = f"Dialogue: {max(1, index)}," + dialogue.split(",", 1)[1]
+        else:
+            background, dialogue = next(rendered_pairs)
+        events += [background.rstrip("\n"), dialogue.rstrip("\n")]
+    
+    with open(output_path, 'w', encoding='utf-8') as f:
+        f.writelines(prefix)
+        f.write("\n".join(events))
+    return len(changed), len(reused)
+
+def log_ass_sample(title, lines, head=15, dialogues=5):
+    """
+    Ghi nội dung mẫu của file ASS (các dòng đầu và vài dòng Dialogue) thành một record duy nhất.
+    
+    Args:
+        title (str): Tên mẫu (VD: trước/sau khi bo góc)
+        lines (list): Các dòng của file ASS trong bộ nhớ
+        head (int): Số dòng đầu được ghi
+        dialogues (int): Số dòng Dialogue được ghi
+    """
+    head_lines = [f"Dòng {i + 1}: {line.strip()}" for i, line in enumerate(lines[:head])]
+    dialogue_lines = [line.strip() for line in lines if line.startswith("Dialogue:")][:dialogues]
+    logger.info(
+        f"=== File ASS {title} ===\n" + "\n".join(head_lines + dialogue_lines),
+        extra={"ass_sample": title, "ass_lines": len(lines)}
+    )
 
-def apply_rounded_borders(input_ass: Path, output_ass: Path, border_radius: int = 10):
+def apply_rounded_borders(input_ass, output_ass: Path, border_radius: int = 10):
     """
     Áp dụng bo góc cho file ASS và đảm bảo giữ nguyên hiệu ứng highlight từng từ
     Tối ưu cho video kích thước 1080x1920 (chiều rộng x chiều cao)
     Xử lý tốt các trường hợp text 1 dòng, text ngắn và dài
     Đảm bảo layer của dialogue luôn là 1 và layer của background luôn là 0
+    
+    input_ass là đường dẫn file hoặc danh sách dòng đã có trong bộ nhớ.
+    Trả về danh sách dòng đã ghi ra output_ass.
     """
     try:
-        with open(input_ass, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+        if isinstance(input_ass, (str, Path)):
+            with open(input_ass, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        else:
+            lines = list(input_ass)
 
         # Kiểm tra highlight color trong các dòng Dialogue
         highlight_found = False
@@ -929,15 +4133,169 @@ def apply_rounded_borders(input_ass: Path, output_ass: Path, border_radius: int
                 # Giữ lại các dòng không phải Dialogue
                 new_events.append(line)
 
-        # Ghi file mới
-        with open(output_ass, 'w', encoding='utf-8') as f:
-            f.writelines(new_events)
+        # Ghi file mới (output_ass=None: chỉ trả về nội dung)
+        if output_ass is not None:
+            with open(output_ass, 'w', encoding='utf-8') as f:
+                f.writelines(new_events)
+        return new_events
 
     except Exception as e:
         logger.error(f"Lỗi khi áp dụng hiệu ứng: {str(e)}")
         raise
 
-def extract_sentence_segments(result):
+def build_result_columns(result):
+    """
+    Dựng dạng cột gọn của kết quả phiên âm: mảng NumPy cho thời gian/xác suất của từ,
+    chỉ số ranh giới segment và một chuỗi text duy nhất kèm offset của từng từ.
+    Được dựng một lần cho mỗi kết quả và dùng chung cho các bước xử lý sau phiên âm
+    thay vì duyệt lại đồ thị đối tượng WhisperResult ở mỗi bước.
+    
+    Segment không có timestamp từng từ được lưu như một "từ" duy nhất chứa toàn bộ text.
+    
+    Args:
+        result: Kết quả phiên âm (WhisperResult)
+        
+    Returns:
+        dict: {"text": chuỗi toàn bộ text (giống result.text),
+               "word_offsets": offset ký tự của từng từ trong text (n_words + 1),
+               "word_start", "word_end", "word_probability": mảng float64 (n_words),
+               "segment_offsets": chỉ số từ bắt đầu của từng segment (n_segments + 1),
+               "has_words": True nếu mọi segment đều có timestamp từng từ}
+    """
+    texts = []
+    starts = []
+    ends = []
+    probabilities = []
+    segment_sizes = []
+    
+    for segment in result.segments:
+        if segment.has_words:
+            for word in segment.words:
+                texts.append(word.word)
+                starts.append(word.start)
+                ends.append(word.end)
+                probabilities.append(np.nan if word.probability is None else word.probability)
+            segment_sizes.append(len(segment.words))
+        else:
+            texts.append(segment.text)
+            starts.append(segment.start)
+            ends.append(segment.end)
+            probabilities.append(np.nan)
+            segment_sizes.append(1)
+    
+    word_offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, texts), dtype=np.int64, count=len(texts)), out=word_offsets[1:])
+    segment_offsets = np.zeros(len(segment_sizes) + 1, dtype=np.int64)
+    np.cumsum(np.array(segment_sizes, dtype=np.int64), out=segment_offsets[1:])
+    
+    return {
+        "text": ''.join(texts),
+        "word_offsets": word_offsets,
+        "word_start": np.array(starts, dtype=np.float64),
+        "word_end": np.array(ends, dtype=np.float64),
+        "word_probability": np.array(probabilities, dtype=np.float64),
+        "segment_offsets": segment_offsets,
+        "has_words": result.has_words,
+    }
+
+def columns_segment_times(columns):
+    """
+    Trả về mảng thời điểm bắt đầu và kết thúc của từng segment từ dạng cột.
+    """
+    offsets = columns["segment_offsets"]
+    return columns["word_start"][offsets[:-1]], columns["word_end"][offsets[1:] - 1]
+
+def columns_segment_texts(columns):
+    """
+    Trả về danh sách text của từng segment, cắt trực tiếp từ chuỗi text chung.
+    """
+    text = columns["text"]
+    char_offsets = columns["word_offsets"][columns["segment_offsets"]].tolist()
+    return [text[a:b] for a, b in zip(char_offsets[:-1], char_offsets[1:])]
+
+def columns_duration(columns):
+    """
+    Thời điểm kết thúc của segment cuối cùng (0 nếu không có segment nào).
+    """
+    return float(columns["word_end"][-1]) if len(columns["word_end"]) else 0
+
+def extract_sentence_columns(columns):
+    """
+    Trích xuất segments theo câu hoàn chỉnh từ kết quả phiên âm, dưới dạng các mảng song song.
+    Một câu hoàn chỉnh được xác định bởi:
+    - Kết thúc bằng bất kỳ dấu câu nào (, . ? ! ... ; :)
+    - Hoặc khoảng cách thời gian đủ lớn giữa các segments (> 0.8s)
+    
+    Args:
+        columns (dict): Dạng cột của kết quả phiên âm (build_result_columns)
+        
+    Returns:
+        dict: {"id", "start", "end", "text", "duration"} - mỗi khóa là một mảng/danh sách
+              theo thứ tự câu, duration là thời gian hiển thị ảnh
+    """
+    # Mở rộng danh sách dấu câu để bao gồm tất cả các loại ('...' đã bao gồm trong '.')
+    punctuations = [',', '.', '?', '!', '...', '।', '。', '？', '！', ';', ':', '、', '，', '；', '：']
+    end_chars = {p[-1] for p in punctuations}
+    
+    # Lấy tổng thời lượng của audio từ segment cuối cùng
+    total_duration = columns_duration(columns)
+    
+    # Thu thập tất cả các segment có text
+    texts = [text.strip() for text in columns_segment_texts(columns)]
+    seg_starts, seg_ends = columns_segment_times(columns)
+    valid = np.fromiter((bool(text) for text in texts), dtype=bool, count=len(texts))
+    texts = [text for text in texts if text]
+    starts = seg_starts[valid]
+    ends = seg_ends[valid]
+    n = len(texts)
+    
+    if n == 0:
+        return {key: [] for key in SEGMENT_FIELDS}
+    
+    # Kết thúc câu: dấu câu ở cuối segment hoặc khoảng lặng > 0.8s với segment tiếp theo
+    is_end = np.fromiter((text[-1] in end_chars for text in texts), dtype=bool, count=n)
+    is_end[:-1] |= (starts[1:] - ends[:-1]) > 0.8
+    is_end[-1] = True
+    
+    group_ends = np.flatnonzero(is_end)
+    group_starts = np.concatenate(([0], group_ends[:-1] + 1))
+    
+    sentence_starts = starts[group_starts]
+    sentence_ends = ends[group_ends]
+    has_next = group_ends < n - 1
+    next_starts = np.where(has_next, starts[np.minimum(group_ends + 1, n - 1)], 0.0)
+    
+    # Tính duration dựa trên id:
+    # - id 0: start time của segment tiếp theo, hoặc end time + 1s nếu không có
+    # - id cuối: end - start + 1s
+    # - các id còn lại: start time của segment tiếp theo - start
+    durations = np.where(has_next, next_starts - sentence_starts, sentence_ends - sentence_starts + 1.0)
+    durations[0] = next_starts[0] if has_next[0] else sentence_ends[0] + 1.0
+    
+    sentence_texts = [" ".join(texts[a:b + 1]) for a, b in zip(group_starts.tolist(), group_ends.tolist())]
+    
+    # Chi tiết từng câu chỉ khi bật DEBUG, tránh định dạng hàng nghìn dòng log với transcript dài
+    if logger.isEnabledFor(logging.DEBUG):
+        for i, (text, start, end, duration) in enumerate(zip(
+                sentence_texts, sentence_starts.tolist(), sentence_ends.tolist(), durations.tolist())):
+            logger.debug(f"Segment {i}: '{text}' - start: {start:.2f}s, end: {end:.2f}s, duration: {duration:.2f}s")
+    
+    total_calculated_duration = float(durations.sum())
+    logger.info(
+        f"Đã gộp {n} segments thành {len(sentence_texts)} câu, "
+        f"tổng duration {total_calculated_duration:.2f}s (audio {total_duration:.2f}s)",
+        extra={"segments": n, "sentences": len(sentence_texts)}
+    )
+    
+    return {
+        "id": np.arange(len(sentence_texts)),
+        "start": sentence_starts,
+        "end": sentence_ends,
+        "text": sentence_texts,
+        "duration": durations,
+    }
+
+def extract_sentence_segments(columns):
     """
     Trích xuất segments theo câu hoàn chỉnh từ kết quả phiên âm.
     Một câu hoàn chỉnh được xác định bởi:
@@ -945,116 +4303,549 @@ def extract_sentence_segments(result):
     - Hoặc khoảng cách thời gian đủ lớn giữa các segments (> 0.8s)
     
     Args:
-        result: Kết quả phiên âm (WhisperResult)
+        columns (dict): Dạng cột của kết quả phiên âm (build_result_columns)
         
     Returns:
         list: Danh sách các segment theo câu hoàn chỉnh, duration là thời gian hiển thị ảnh
     """
-    sentence_segments = []
-    current_segment = {
-        "text": "",
-        "start": None,
-        "end": None
+    return columns_to_records(extract_sentence_columns(columns))
+
+def extract_word_columns(columns):
+    """
+    Trả về timestamp từng từ dưới dạng các mảng song song.
+    
+    Args:
+        columns (dict): Dạng cột của kết quả phiên âm (build_result_columns)
+        
+    Returns:
+        dict: {"word", "start", "end", "probability", "segment"}
+    """
+    text = columns["text"]
+    char_offsets = columns["word_offsets"].tolist()
+    return {
+        "word": [text[a:b] for a, b in zip(char_offsets[:-1], char_offsets[1:])],
+        "start": columns["word_start"],
+        "end": columns["word_end"],
+        "probability": columns["word_probability"],
+        "segment": np.repeat(
+            np.arange(len(columns["segment_offsets"]) - 1), np.diff(columns["segment_offsets"])
+        ),
     }
+
+def parse_transcript_edits(edits_json):
+    """
+    Đọc danh sách chỉnh sửa transcript dạng JSON. Mỗi chỉnh sửa là một object:
+    - {"word": k, "text", "start", "end"}: sửa từ thứ k (chỉ số trong mảng words), text rỗng để xóa từ,
+      text nhiều từ để tách thành nhiều từ
+    - {"segment": i, "text", "start", "end"}: sửa cả dòng phụ đề thứ i (trường segment của words);
+      start/end co giãn thời gian các từ trong dòng
+    Các khóa text, start, end đều tùy chọn nhưng phải có ít nhất một.
     
-    # Mở rộng danh sách dấu câu để bao gồm tất cả các loại
-    punctuations = [',', '.', '?', '!', '...', '।', '。', '？', '！', ';', ':', '、', '，', '；', '：']
+    Args:
+        edits_json (str): Chuỗi JSON (danh sách các chỉnh sửa)
+        
+    Returns:
+        list: Các chỉnh sửa đã kiểm tra
+        
+    Raises:
+        ValueError: Nếu JSON hoặc chỉnh sửa không hợp lệ
+    """
+    try:
+        edits = json.loads(edits_json)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"JSON lỗi: {str(e)}")
+    if not isinstance(edits, list) or not edits:
+        raise ValueError("phải là một danh sách chỉnh sửa không rỗng")
+    if len(edits) > MAX_TRANSCRIPT_EDITS:
+        raise ValueError(f"tối đa {MAX_TRANSCRIPT_EDITS} chỉnh sửa mỗi lần")
     
-    # Lấy tổng thời lượng của audio từ segment cuối cùng
-    total_duration = result.segments[-1].end if result.segments else 0
-    logger.info(f"Tổng thời lượng audio: {total_duration:.2f} giây")
+    for n, edit in enumerate(edits):
+        if not isinstance(edit, dict):
+            raise ValueError(f"chỉnh sửa {n} phải là một object JSON")
+        unknown = set(edit) - {"word", "segment", "text", "start", "end"}
+        if unknown:
+            raise ValueError(f"chỉnh sửa {n}: khóa không hỗ trợ: {', '.join(sorted(unknown))}")
+        if ("word" in edit) == ("segment" in edit):
+            raise ValueError(f"chỉnh sửa {n}: cần đúng một trong hai khóa word hoặc segment")
+        target = edit.get("word", edit.get("segment"))
+        if isinstance(target, bool) or not isinstance(target, int) or target < 0:
+            raise ValueError(f"chỉnh sửa {n}: chỉ số phải là số nguyên không âm")
+        if not {"text", "start", "end"} & set(edit):
+            raise ValueError(f"chỉnh sửa {n}: cần ít nhất một trong text, start, end")
+        if "text" in edit:
+            if not isinstance(edit["text"], str):
+                raise ValueError(f"chỉnh sửa {n}: text phải là chuỗi")
+            # Không cho chèn tag ASS vào phụ đề
+            if any(c in edit["text"] for c in "{}\\"):
+                raise ValueError(f"chỉnh sửa {n}: text không được chứa {{, }} hoặc \\")
+        for key in ("start", "end"):
+            value = edit.get(key)
+            if key in edit and (isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0):
+                raise ValueError(f"chỉnh sửa {n}: {key} phải là số không âm")
+        if "start" in edit and "end" in edit and edit["end"] < edit["start"]:
+            raise ValueError(f"chỉnh sửa {n}: end nhỏ hơn start")
     
-    # Thu thập tất cả các segment có text
-    valid_segments = []
-    for segment in result.segments:
-        text = segment.text.strip()
-        if text:
-            valid_segments.append(segment)
+    return edits
+
+def _retime_words(words, text):
+    """
+    Thay text của một dãy từ liên tiếp. Cùng số từ thì giữ nguyên thời gian từng từ,
+    khác số từ thì chia lại khoảng thời gian của dãy theo độ dài từng từ mới.
+    """
+    tokens = text.split()
+    if not tokens:
+        return []
+    if not words:
+        raise ValueError("không thể sửa text của dòng đã bị xóa hết từ")
+    if len(tokens) == len(words):
+        return [
+            dict(word, word=" " + token, probability=word["probability"] if word["word"].strip() == token else None)
+            for word, token in zip(words, tokens)
+        ]
+    
+    start, end = words[0]["start"], words[-1]["end"]
+    weights = np.array([len(token) + 1 for token in tokens], dtype=np.float64)
+    edges = (start + (end - start) * np.concatenate(([0.0], np.cumsum(weights))) / weights.sum()).tolist()
+    return [
+        {"word": " " + token, "start": round(edges[k], 3), "end": round(edges[k + 1], 3), "probability": None}
+        for k, token in enumerate(tokens)
+    ]
+
+def _edit_segment_words(words, segment_edits, word_edits, index):
+    """
+    Áp dụng các chỉnh sửa lên danh sách từ (dict) của một segment.
+    
+    Args:
+        words (list): Các từ của segment
+        segment_edits (list): Chỉnh sửa cả segment
+        word_edits (list): Các cặp (chỉ số từ trong segment, chỉnh sửa)
+        index (int): Chỉ số segment, dùng trong thông báo lỗi
+        
+    Returns:
+        list: Các từ sau khi sửa (có thể rỗng nếu mọi từ bị xóa)
+    """
+    for edit in segment_edits:
+        if not words:
+            raise ValueError(f"segment {index}: dòng đã bị xóa hết từ, không thể sửa tiếp")
+        if "start" in edit or "end" in edit:
+            old_start, old_end = words[0]["start"], words[-1]["end"]
+            new_start, new_end = edit.get("start", old_start), edit.get("end", old_end)
+            if new_end < new_start:
+                raise ValueError(f"segment {index}: end nhỏ hơn start")
+            scale = (new_end - new_start) / (old_end - old_start) if old_end > old_start else 0.0
+            for word in words:
+                word["start"] = round(new_start + (word["start"] - old_start) * scale, 3)
+                word["end"] = round(new_start + (word["end"] - old_start) * scale, 3)
+        if "text" in edit:
+            if word_edits:
+                raise ValueError(f"segment {index}: không thể vừa sửa text cả dòng vừa sửa từng từ")
+            words = _retime_words(words, edit["text"])
+    
+    # Sửa từ có chỉ số lớn trước để việc tách/xóa từ không làm lệch chỉ số các từ phía trước
+    for position, edit in sorted(word_edits, key=lambda item: item[0], reverse=True):
+        word = dict(words[position])
+        word["start"] = edit.get("start", word["start"])
+        word["end"] = edit.get("end", word["end"])
+        if word["end"] < word["start"]:
+            raise ValueError(f"từ {edit['word']}: end nhỏ hơn start")
+        words[position:position + 1] = _retime_words([word], edit["text"]) if "text" in edit else [word]
+    return words
+
+def apply_transcript_edits(columns, edits, spec=None):
+    """
+    Áp dụng chỉnh sửa lên dạng cột của kết quả. Chỉ vùng lân cận của các segment bị sửa
+    (thêm một segment mỗi bên) được nhóm lại bằng regroup_for_single_line, phần còn lại giữ nguyên.
+    
+    Args:
+        columns (dict): Dạng cột của phiên bản hiện tại (build_result_columns)
+        edits (list): Kết quả của parse_transcript_edits
+        spec (dict): Cấu hình nhóm từ của job
+        
+    Returns:
+        tuple: (dạng cột mới, mảng ánh xạ segment mới -> segment cũ, -1 với segment đã thay đổi)
+        
+    Raises:
+        ValueError: Nếu chỉ số trong chỉnh sửa không tồn tại, bị sửa nhiều lần hoặc thời gian không hợp lệ
+    """
+    if not columns["has_words"]:
+        raise ValueError("kết quả không có timestamp từng từ, không hỗ trợ chỉnh sửa")
+    
+    segment_offsets = columns["segment_offsets"]
+    n_segments = len(segment_offsets) - 1
+    n_words = len(columns["word_start"])
+    
+    # Gom chỉnh sửa theo segment, mỗi từ/segment chỉ được sửa một lần trong một request
+    by_segment = {}
+    targets = set()
+    for edit in edits:
+        target = ("word", edit["word"]) if "word" in edit else ("segment", edit["segment"])
+        if target in targets:
+            raise ValueError(f"{target[0]} {target[1]} bị sửa nhiều lần, hãy gộp thành một chỉnh sửa")
+        targets.add(target)
+        if "word" in edit:
+            if edit["word"] >= n_words:
+                raise ValueError(f"từ {edit['word']} không tồn tại (có {n_words} từ)")
+            index = int(np.searchsorted(segment_offsets, edit["word"], side="right")) - 1
+            by_segment.setdefault(index, ([], []))[1].append((edit["word"] - int(segment_offsets[index]), edit))
+        else:
+            if edit["segment"] >= n_segments:
+                raise ValueError(f"segment {edit['segment']} không tồn tại (có {n_segments} segments)")
+            by_segment.setdefault(edit["segment"], ([], []))[0].append(edit)
+    
+    # Vùng lân cận của các segment bị sửa, các vùng chạm nhau được gộp
+    regions = []
+    for index in sorted(by_segment):
+        lo, hi = max(index - 1, 0), min(index + 2, n_segments)
+        if regions and lo <= regions[-1][1]:
+            regions[-1][1] = max(regions[-1][1], hi)
+        else:
+            regions.append([lo, hi])
+    
+    text = columns["text"]
+    word_offsets = columns["word_offsets"]
+    starts = columns["word_start"]
+    ends = columns["word_end"]
+    probabilities = columns["word_probability"]
+    segment_map = list(range(n_segments))
+    
+    # Ghép từ cuối lên để chỉ số của các vùng phía trước không đổi
+    for lo, hi in reversed(regions):
+        wa, wb = int(segment_offsets[lo]), int(segment_offsets[hi])
+        segments = []
+        for index in range(lo, hi):
+            a, b = int(segment_offsets[index]), int(segment_offsets[index + 1])
+            words = [
+                {
+                    "word": text[word_offsets[k]:word_offsets[k + 1]],
+                    "start": float(starts[k]),
+                    "end": float(ends[k]),
+                    "probability": None if np.isnan(probabilities[k]) else float(probabilities[k]),
+                }
+                for k in range(a, b)
+            ]
+            if index in by_segment:
+                words = _edit_segment_words(words, *by_segment[index], index)
+            if words:
+                segments.append({
+                    "start": words[0]["start"],
+                    "end": words[-1]["end"],
+                    "text": "".join(word["word"] for word in words),
+                    "words": words,
+                })
+        
+        # Thời gian sau khi sửa phải tăng dần và không chồng lên các từ ngoài vùng
+        previous_end = float(ends[wa - 1]) if wa > 0 else 0.0
+        for word in (word for segment in segments for word in segment["words"]):
+            if word["start"] < previous_end:
+                raise ValueError(
+                    f"từ '{word['word'].strip()}' bắt đầu lúc {word['start']:.3f}s, "
+                    f"trước khi từ phía trước kết thúc ({previous_end:.3f}s)"
+                )
+            previous_end = word["end"]
+        if wb < len(starts) and previous_end > starts[wb]:
+            raise ValueError(f"từ cuối của vùng sửa kết thúc lúc {previous_end:.3f}s, sau khi từ tiếp theo bắt đầu ({starts[wb]:.3f}s)")
+        
+        if segments:
+            part = build_result_columns(regroup_for_single_line(WhisperResult({"segments": segments}), spec))
+        else:
+            part = build_result_columns(WhisperResult({"segments": []}))
+        
+        ca, cb = int(word_offsets[wa]), int(word_offsets[wb])
+        part_words = len(part["word_start"])
+        text = text[:ca] + part["text"] + text[cb:]
+        word_offsets = np.concatenate((
+            word_offsets[:wa], part["word_offsets"][:-1] + ca, word_offsets[wb:] + len(part["text"]) - (cb - ca)
+        ))
+        starts = np.concatenate((starts[:wa], part["word_start"], starts[wb:]))
+        ends = np.concatenate((ends[:wa], part["word_end"], ends[wb:]))
+        probabilities = np.concatenate((probabilities[:wa], part["word_probability"], probabilities[wb:]))
+        segment_offsets = np.concatenate((
+            segment_offsets[:lo], part["segment_offsets"][:-1] + wa, segment_offsets[hi:] + part_words - (wb - wa)
+        ))
+        segment_map[lo:hi] = [-1] * (len(part["segment_offsets"]) - 1)
     
-    logger.info(f"Số lượng segments hợp lệ: {len(valid_segments)}")
+    new_columns = {
+        "text": text,
+        "word_offsets": word_offsets,
+        "word_start": starts,
+        "word_end": ends,
+        "word_probability": probabilities,
+        "segment_offsets": segment_offsets,
+        "has_words": True,
+    }
+    return new_columns, np.array(segment_map, dtype=np.int64)
+
+def _json_values(values):
+    """
+    Chuyển mảng NumPy thành list Python, NaN thành None để encode được JSON.
+    """
+    if isinstance(values, np.ndarray):
+        values = values.tolist()
+    return [None if isinstance(v, float) and v != v else v for v in values]
+
+def columns_to_records(table, keys=None):
+    """
+    Chuyển các mảng song song thành danh sách object (mỗi phần tử một dict).
+    
+    Args:
+        table (dict): Các mảng song song cùng độ dài
+        keys (list): Các khóa cần giữ, mặc định là tất cả
+    """
+    keys = list(keys or table.keys())
+    return [dict(zip(keys, values)) for values in zip(*(_json_values(table[k]) for k in keys))]
+
+def parse_response_fields(fields, simple_response=False, include_words=False):
+    """
+    Xác định các trường cần trả về trong response của /transcribe.
+    
+    Args:
+        fields (str): Danh sách trường phân tách bằng dấu phẩy, hỗ trợ "segments.<trường con>"
+            và "words.<trường con>"; None để dùng mặc định theo simple_response
+        simple_response (bool): Dùng bộ trường rút gọn khi không chỉ định fields
+        include_words (bool): Thêm mảng timestamp từng từ
+        
+    Returns:
+        dict: {tên trường: None hoặc danh sách trường con} theo thứ tự yêu cầu
+        
+    Raises:
+        ValueError: Nếu có trường không hỗ trợ
+    """
+    if fields and fields.strip():
+        names = [name.strip() for name in fields.split(",") if name.strip()]
+    else:
+        names = list(SIMPLE_RESPONSE_FIELDS if simple_response else FULL_RESPONSE_FIELDS)
+    if include_words:
+        names.append("words")
     
-    for i, segment in enumerate(valid_segments):
-        text = segment.text.strip()
-        if not text:
+    selection = {}
+    for name in names:
+        top, _, sub = name.partition(".")
+        if top not in RESPONSE_FIELDS:
+            raise ValueError(f"trường không hỗ trợ: {top}. Hỗ trợ: {', '.join(RESPONSE_FIELDS)}")
+        if not sub:
+            selection[top] = None
             continue
-            
-        # Bắt đầu segment mới nếu chưa có
-        if current_segment["start"] is None:
-            current_segment["start"] = segment.start
-            logger.info(f"Bắt đầu segment mới tại thời điểm {segment.start:.2f}s: '{text}'")
-            
-        # Thêm text vào segment hiện tại
-        current_segment["text"] += " " + text if current_segment["text"] else text
-        current_segment["end"] = segment.end
-        
-        # Kiểm tra điều kiện kết thúc câu
-        is_end_of_sentence = False
-        
-        # Kiểm tra bất kỳ dấu câu nào
-        for punct in punctuations:
-            if text.endswith(punct):
-                is_end_of_sentence = True
-                logger.info(f"Segment {i} kết thúc với dấu câu: '{punct}'")
-                break
         
-        # Kiểm tra khoảng cách với segment tiếp theo
-        next_segment = None
-        if i < len(valid_segments) - 1:
-            next_segment = valid_segments[i + 1]
-            
-        # Nếu khoảng cách với segment tiếp theo > 0.8s, coi như kết thúc câu
-        gap_duration = 0
-        if next_segment:
-            gap_duration = next_segment.start - segment.end
-            if gap_duration > 0.8:
-                is_end_of_sentence = True
-                logger.info(f"Phát hiện khoảng lặng lớn ({gap_duration:.2f}s) sau segment {i}")
-        
-        # Nếu là kết thúc câu hoặc là segment cuối cùng, thêm segment vào kết quả
-        if (is_end_of_sentence or i == len(valid_segments) - 1) and current_segment["text"].strip():
-            # Tạo segment mới
-            new_segment = {
-                "id": len(sentence_segments),
-                "start": current_segment["start"],
-                "end": current_segment["end"],
-                "text": current_segment["text"].strip()
-            }
-            
-            # Tính duration dựa trên id
-            if len(sentence_segments) == 0:  # id 0
-                # Nếu có segment tiếp theo, duration = start time của segment tiếp theo
-                # Nếu không có segment tiếp theo, duration = end time + 1s
-                if next_segment:
-                    new_segment["duration"] = next_segment.start
-                else:
-                    new_segment["duration"] = current_segment["end"] + 1.0
-                logger.info(f"Segment id 0: duration = {new_segment['duration']:.2f}s")
-            else:  # id >= 1
-                if i == len(valid_segments) - 1:  # last id
-                    new_segment["duration"] = current_segment["end"] - current_segment["start"] + 1.0
-                    logger.info(f"Last segment (id {new_segment['id']}): duration = {new_segment['duration']:.2f}s")
-                else:  # id > 0 but not last
-                    new_segment["duration"] = next_segment.start - current_segment["start"]
-                    logger.info(f"Middle segment (id {new_segment['id']}): duration = {new_segment['duration']:.2f}s")
-            
-            sentence_segments.append(new_segment)
-            
-            logger.info(f"Đã thêm segment {len(sentence_segments)-1}: '{current_segment['text'].strip()}'")
-            logger.info(f"  - start: {current_segment['start']:.2f}s, end: {current_segment['end']:.2f}s, duration: {new_segment['duration']:.2f}s")
-            
-            # Reset segment hiện tại
-            current_segment = {
-                "text": "",
-                "start": None,
-                "end": None
-            }
+        allowed = {"segments": SEGMENT_FIELDS, "words": WORD_FIELDS}.get(top)
+        if allowed is None or sub not in allowed:
+            raise ValueError(f"trường con không hỗ trợ: {name}")
+        if top in selection and selection[top] is None:
+            continue  # Đã chọn toàn bộ trường
+        selection.setdefault(top, [])
+        if sub not in selection[top]:
+            selection[top].append(sub)
+    
+    return selection
+
+def build_response_content(columns, info, selection, response_format="records"):
+    """
+    Tạo nội dung response của /transcribe, chỉ tính các phần được chọn.
     
-    # Log tổng duration
-    total_calculated_duration = sum(seg["duration"] for seg in sentence_segments)
-    logger.info(f"Tính toán tổng duration: {total_calculated_duration:.2f}s")
-    logger.info(f"Total duration check: calculated={total_calculated_duration:.2f}, expected={total_duration:.2f}")
+    Args:
+        columns (dict): Dạng cột của kết quả phiên âm (build_result_columns)
+        info (dict): Các trường thông tin chung (success, message, download_url...)
+        selection (dict): Kết quả của parse_response_fields
+        response_format (str): "records" hoặc "columnar"
+        
+    Returns:
+        dict: Nội dung response
+    """
+    content = {}
+    for name, sub_fields in selection.items():
+        if name == "duration":
+            content[name] = columns_duration(columns)
+        elif name == "text":
+            content[name] = columns["text"]
+        elif name in ("segments", "words"):
+            table = extract_sentence_columns(columns) if name == "segments" else extract_word_columns(columns)
+            keys = sub_fields or list(table.keys())
+            if response_format == "columnar":
+                content[name] = {key: table[key] for key in keys}
+            else:
+                content[name] = columns_to_records(table, keys)
+        else:
+            content[name] = info.get(name)
+    return content
+
+def fast_json_response(content, status_code=200):
+    """
+    Tạo JSON response bằng orjson (hỗ trợ trực tiếp mảng NumPy) nếu có,
+    nếu không thì dùng JSONResponse mặc định.
+    """
+    if orjson is not None:
+        return Response(
+            content=orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY),
+            status_code=status_code,
+            media_type="application/json"
+        )
+    
+    def to_builtin(value):
+        if isinstance(value, dict):
+            return {k: to_builtin(v) for k, v in value.items()}
+        if isinstance(value, np.ndarray):
+            return _json_values(value)
+        return value
+    
+    return JSONResponse(status_code=status_code, content=to_builtin(content))
+
+class RequestProfiler:
+    """
+    Profiler lấy mẫu (statistical) cho một request: một thread nền định kỳ đọc stack của
+    thread event loop (chỉ khi đang chạy coroutine của request này) và các thread trong
+    threadpool đang làm việc cho request, tùy chọn kèm thời gian từng op của torch profiler.
+    """
+    
+    def __init__(self, profile_id, torch_ops=False, interval=PROFILE_INTERVAL):
+        self.profile_id = profile_id
+        self.torch_ops = torch_ops
+        self.interval = interval
+        self.samples = 0
+        self.ticks = 0
+        self.stacks = {}
+        self.torch_op_stats = None
+        self._threads = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = None
+        self._wall_time = None
+        self.coalesced = False  # Phần phiên âm dùng chung kết quả của request khác, không nằm trong profile
     
-    return sentence_segments
+    def start(self, root_frame):
+        """
+        Bắt đầu lấy mẫu. root_frame là frame của coroutine request trên event loop.
+        """
+        self._threads[threading.get_ident()] = root_frame
+        self._started = time.time()
+        self._thread = threading.Thread(target=self._run, name=f"profiler-{self.profile_id[:8]}", daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        if self._thread is None or self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join()
+        self._wall_time = time.time() - self._started
+    
+    def wrap(self, fn, torch_ops=False):
+        """
+        Bọc hàm chạy trong threadpool để thread đó được lấy mẫu trong lúc làm việc cho request.
+        """
+        def run(*args, **kwargs):
+            thread_id = threading.get_ident()
+            self._threads[thread_id] = None
+            try:
+                if torch_ops and self.torch_ops:
+                    activities = [torch.profiler.ProfilerActivity.CPU]
+                    if torch.cuda.is_available():
+                        activities.append(torch.profiler.ProfilerActivity.CUDA)
+                    with torch.profiler.profile(activities=activities) as prof:
+                        result = fn(*args, **kwargs)
+                    self.torch_op_stats = summarize_torch_ops(prof)
+                    return result
+                return fn(*args, **kwargs)
+            finally:
+                self._threads.pop(thread_id, None)
+        return run
+    
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            self.ticks += 1
+            frames = sys._current_frames()
+            for thread_id, root_frame in list(self._threads.items()):
+                frame = frames.get(thread_id)
+                if frame is None or thread_id == own_id:
+                    continue
+                stack = []
+                found_root = root_frame is None
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{code.co_firstlineno}")
+                    if frame is root_frame:
+                        found_root = True
+                        break
+                    frame = frame.f_back
+                if not found_root:
+                    continue  # Event loop đang chạy việc của request khác
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+                self.samples += 1
+    
+    def report(self):
+        """
+        Tổng hợp kết quả: thời gian tự thân/tích lũy theo hàm và các stack dạng folded.
+        """
+        self_counts = {}
+        total_counts = {}
+        for key, count in self.stacks.items():
+            names = key.split(";")
+            self_counts[names[-1]] = self_counts.get(names[-1], 0) + count
+            for name in set(names):
+                total_counts[name] = total_counts.get(name, 0) + count
+        
+        top = sorted(total_counts, key=total_counts.get, reverse=True)[:PROFILE_TOP_FUNCTIONS]
+        # Chu kỳ thực tế (thường dài hơn PROFILE_INTERVAL do thời gian đọc stack)
+        period = (self._wall_time or 0.0) / self.ticks if self.ticks else self.interval
+        stacks = sorted(self.stacks.items(), key=lambda item: item[1], reverse=True)[:PROFILE_TOP_STACKS]
+        return {
+            "id": self.profile_id,
+            "wall_time": round(self._wall_time or 0.0, 3),
+            "interval": round(period, 6),
+            "samples": self.samples,
+            "functions": [
+                {
+                    "function": name,
+                    "self": self_counts.get(name, 0),
+                    "total": total_counts[name],
+                    "self_seconds": round(self_counts.get(name, 0) * period, 3),
+                    "total_seconds": round(total_counts[name] * period, 3),
+                }
+                for name in top
+            ],
+            "stacks": dict(stacks),
+            "torch_ops": self.torch_op_stats,
+            "coalesced": self.coalesced,
+        }
+    
+    def save(self):
+        """
+        Lưu profile cạnh file kết quả trong OUTPUTS_DIR.
+        """
+        path = OUTPUTS_DIR / f"{self.profile_id}.profile.json"
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, ensure_ascii=False)
+        return path
+
+def summarize_torch_ops(prof):
+    """
+    Rút gọn kết quả torch profiler thành các op tốn thời gian nhất (đơn vị ms).
+    """
+    ops = []
+    for event in prof.key_averages():
+        device_total = getattr(event, "device_time_total", None)
+        if device_total is None:
+            device_total = getattr(event, "cuda_time_total", 0)
+        ops.append({
+            "name": event.key,
+            "count": event.count,
+            "cpu_total_ms": round(event.cpu_time_total / 1000, 3),
+            "self_cpu_ms": round(event.self_cpu_time_total / 1000, 3),
+            "device_total_ms": round(device_total / 1000, 3),
+        })
+    ops.sort(key=lambda op: op["cpu_total_ms"] + op["device_total_ms"], reverse=True)
+    return ops[:PROFILE_TOP_OPS]
+
+def create_request_profiler(x_profile):
+    """
+    Tạo profiler nếu request yêu cầu qua header X-Profile ("1"/"true"; "torch" để thêm op torch)
+    hoặc được chọn theo PROFILE_SAMPLE_RATE. Trả về None nếu không profile.
+    """
+    value = (x_profile or "").strip().lower()
+    if value in ("1", "true", "yes", "torch"):
+        return RequestProfiler(uuid.uuid4().hex, torch_ops=value == "torch" or PROFILE_TORCH_OPS)
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return RequestProfiler(uuid.uuid4().hex, torch_ops=PROFILE_TORCH_OPS)
+    return None
 
 if __name__ == "__main__":
     import uvicorn
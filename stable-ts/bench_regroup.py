@@ -0,0 +1,64 @@
+"""
+So sánh tốc độ regroup_for_single_line (một lượt) với chuỗi regroup của stable-ts (regroup_with_chain)
+trên bản phiên âm giả nhiều giờ.
+
+Chạy: python bench_regroup.py [số segment] [số lần lặp]
+"""
+import copy
+import logging
+import random
+import sys
+import time
+
+from stable_whisper import WhisperResult
+
+import api_server
+
+VOCAB = ["xin", "chào", "các", "bạn", "hôm", "nay", "chúng", "ta", "sẽ", "học",
+         "TP.", "1.", "Mr.", "U.S.", "về", "lập", "trình", "Python"]
+PUNCTUATION = ["", "", "", "", ",", ".", "?", "!", ";", "...", "，", "。"]
+
+
+def make_transcript(n_segments, seed=0):
+    """
+    Kết quả phiên âm giả có dấu câu, viết tắt, khoảng lặng và từ kéo dài bất thường (timestamp ngẫu nhiên).
+    """
+    rng = random.Random(seed)
+    t = 0.0
+    segments = []
+    for _ in range(n_segments):
+        words = []
+        for _ in range(rng.randint(1, 25)):
+            text = " " + rng.choice(VOCAB) + rng.choice(PUNCTUATION)
+            if rng.random() < 0.03:
+                text = " " + rng.choice(["?", "!", "."]) + "x"
+            if rng.random() < 0.5:
+                t += rng.uniform(0, 1.2)
+            duration = rng.uniform(0.05, 0.6) if rng.random() < 0.8 else rng.uniform(1, 5)
+            words.append({"word": text, "start": t, "end": t + duration, "probability": rng.random()})
+            t += duration
+        segments.append({"words": words})
+    return WhisperResult({"segments": segments, "language": "vi"})
+
+
+def main():
+    n_segments = int(sys.argv[1]) if len(sys.argv) > 1 else 6000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    logging.disable(logging.CRITICAL)
+    
+    transcript = make_transcript(n_segments, seed=1)
+    hours = transcript.segments[-1].end / 3600
+    print(f"{len(transcript.all_words())} từ, {hours:.1f} giờ audio")
+    
+    for name, regroup in [("chain", api_server.regroup_with_chain), ("fused", api_server.regroup_for_single_line)]:
+        timings = []
+        for _ in range(repeat):
+            result = copy.deepcopy(transcript)
+            start = time.perf_counter()
+            regroup(result)
+            timings.append(time.perf_counter() - start)
+        print(f"{name}: tốt nhất {min(timings):.3f}s, {len(result.segments)} segments")
+
+
+if __name__ == "__main__":
+    main()
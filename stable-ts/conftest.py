@@ -0,0 +1,133 @@
+import inspect
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+
+import pytest
+
+# api_server tạo các thư mục temp/, outputs/, data/ theo thư mục hiện tại khi import
+os.chdir(tempfile.mkdtemp())
+os.environ.setdefault("MEMORY_BUDGET_MB", "20000")
+
+import api_server  # noqa: E402
+from fastapi import UploadFile  # noqa: E402
+from stable_whisper import WhisperResult  # noqa: E402
+
+
+def make_result(n_segments=12, seed=0, start=0.0):
+    """
+    Kết quả phiên âm giả: n_segments segment, mỗi segment 2-6 từ có timestamp tăng dần.
+    """
+    rng = random.Random(seed)
+    t = start
+    segments = []
+    for _ in range(n_segments):
+        words = []
+        for _ in range(rng.randint(2, 6)):
+            duration = rng.uniform(0.1, 0.5)
+            words.append({"word": " " + rng.choice(["xin", "chào", "các", "bạn"]), "start": round(t, 3),
+                          "end": round(t + duration, 3), "probability": 0.9})
+            t += duration + 0.05
+        segments.append({"start": words[0]["start"], "end": words[-1]["end"],
+                         "text": "".join(word["word"] for word in words), "words": words})
+    return {"segments": segments, "language": "vi"}
+
+
+class FakeModel:
+    """
+    Mô hình giả thay cho stable_whisper.load_model: trả kết quả cố định và ghi lại các lần gọi.
+    """
+
+    def __init__(self, name, result=None, delay=0.0):
+        self.name = name
+        self.result = result or make_result()
+        self.delay = delay
+        self.calls = []
+
+    def transcribe(self, audio, **kwargs):
+        self.calls.append(("transcribe", audio))
+        if self.delay:
+            threading.Event().wait(self.delay)
+        return WhisperResult(self.result)
+
+    def align(self, audio, text, **kwargs):
+        self.calls.append(("align", audio))
+        return WhisperResult(self.result)
+
+
+def form_defaults(endpoint):
+    """
+    Giá trị mặc định của các tham số Form/Header của endpoint, để gọi thẳng hàm xử lý.
+    """
+    return {
+        name: getattr(parameter.default, "default", parameter.default)
+        for name, parameter in inspect.signature(endpoint).parameters.items()
+    }
+
+
+def default_ass_options():
+    defaults = form_defaults(api_server.transcribe_audio)
+    return {name: defaults[name] for name in list(inspect.signature(api_server.render_ass_output).parameters)[2:]}
+
+
+async def post_transcribe(content=b"\0" * 1000, filename="voice.mp3", **params):
+    """
+    Gọi /transcribe với tham số mặc định, trả về (mã HTTP, nội dung JSON).
+    """
+    args = form_defaults(api_server.transcribe_audio)
+    args.update(params)
+    args["file"] = UploadFile(file=io.BytesIO(content), filename=filename)
+    response = await api_server.transcribe_audio(**args)
+    return response.status_code, json.loads(response.body)
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(tmp_path, monkeypatch):
+    """
+    Mỗi test dùng kho trạng thái, thư mục và bộ lập lịch riêng.
+    """
+    for name in ("TEMP_DIR", "OUTPUTS_DIR", "JOB_AUDIO_DIR"):
+        path = tmp_path / name.lower()
+        path.mkdir()
+        monkeypatch.setattr(api_server, name, path)
+    monkeypatch.setattr(api_server, "STATE_DB_PATH", tmp_path / "state.db")
+    monkeypatch.setattr(api_server, "_db_local", threading.local())
+    monkeypatch.setattr(api_server, "_admission", None)
+    monkeypatch.setattr(api_server, "_stages", {})
+    monkeypatch.setattr(api_server, "_single_flight", None)
+    monkeypatch.setattr(api_server, "_job_subscribers", {})
+    monkeypatch.setattr(api_server, "REPLICA_ID", "test-replica")
+    api_server.init_store()
+    yield
+    for stage in api_server._stages.values():
+        stage.executor.shutdown(wait=True)
+
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    """
+    Thay mô hình chính bằng FakeModel (không tải trọng số, không warm-up).
+    """
+    models = {}
+
+    def load_model(name, device=None):
+        return models.setdefault(name, FakeModel(name))
+
+    monkeypatch.setattr(api_server.stable_whisper, "load_model", load_model)
+    monkeypatch.setattr(api_server, "_extra_models", {})
+    monkeypatch.setattr(api_server, "_model_locks", {})
+    monkeypatch.setattr(api_server, "_model_users", {})
+    model = load_model(api_server.PRIMARY_MODEL_NAME)
+    monkeypatch.setattr(api_server, "_model", model)
+    monkeypatch.setattr(api_server, "_model_name", api_server.PRIMARY_MODEL_NAME)
+    monkeypatch.setattr(api_server, "_device", "cpu")
+    api_server.get_admission().set_resident("primary", api_server.model_weights_mb(api_server.PRIMARY_MODEL_NAME))
+    return model
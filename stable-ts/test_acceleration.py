@@ -0,0 +1,71 @@
+import copy
+
+import pytest
+import torch
+
+import api_server
+from conftest import FakeModel
+
+
+class EncoderModel(FakeModel):
+    """
+    Mô hình giả có module encoder thật để compile.
+    """
+    
+    def __init__(self, name, fail_compiled=False):
+        super().__init__(name)
+        self.encoder = torch.nn.Linear(4, 4)
+        self.fail_compiled = fail_compiled
+    
+    def transcribe(self, audio, **kwargs):
+        if self.fail_compiled and not isinstance(self.encoder, torch.nn.Linear):
+            raise RuntimeError("inductor: không có trình biên dịch C++")
+        return super().transcribe(audio, **kwargs)
+
+
+@pytest.fixture
+def accel(monkeypatch, tmp_path):
+    monkeypatch.setattr(api_server, "_accel_stats", copy.deepcopy(api_server._accel_stats))
+    monkeypatch.setattr(api_server, "COMPILE_CACHE_DIR", tmp_path / "compile_cache")
+    for name in ("TORCHINDUCTOR_CACHE_DIR", "TRITON_CACHE_DIR", "TORCHINDUCTOR_FX_GRAPH_CACHE"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr(api_server, "TORCH_COMPILE", True)
+    monkeypatch.setattr(api_server, "WARMUP_DURATIONS", (1.0, 2.0))
+    return api_server._accel_stats
+
+
+def test_compile_wraps_targets_and_uses_persistent_cache(accel, tmp_path):
+    model = EncoderModel("large-v3")
+    encoder = model.encoder
+    
+    assert api_server.compile_model(model) == {"encoder": encoder}
+    assert model.encoder is not encoder
+    assert api_server.os.environ["TORCHINDUCTOR_CACHE_DIR"] == str(tmp_path / "compile_cache" / "inductor")
+
+
+def test_warm_up_records_first_and_steady_runs(accel, monkeypatch):
+    monkeypatch.setattr(api_server, "MODEL_WARMUP", True)
+    model = api_server.prepare_model(EncoderModel("large-v3"), "large-v3")
+    
+    assert accel["compile"]["targets"] == ["encoder"]
+    assert [entry["seconds"] for entry in accel["warmup"]] == [1.0, 2.0]
+    assert all(entry["compile_overhead"] is not None for entry in accel["warmup"])
+    assert len(model.calls) == 4
+
+
+def test_failed_compile_falls_back_to_eager(accel, monkeypatch):
+    monkeypatch.setattr(api_server, "MODEL_WARMUP", False)
+    model = EncoderModel("large-v3", fail_compiled=True)
+    encoder = model.encoder
+    
+    api_server.prepare_model(model, "large-v3")
+    
+    assert model.encoder is encoder
+    assert accel["compile"]["targets"] == [] and "C++" in accel["compile"]["error"]
+
+
+def test_inference_runs_under_inference_mode(monkeypatch):
+    monkeypatch.setattr(api_server, "TORCH_INFERENCE_MODE", True)
+    assert api_server.run_with_model_lock(object(), torch.is_inference_mode_enabled)
+    monkeypatch.setattr(api_server, "TORCH_INFERENCE_MODE", False)
+    assert not api_server.run_with_model_lock(object(), torch.is_inference_mode_enabled)
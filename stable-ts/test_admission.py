@@ -0,0 +1,129 @@
+import asyncio
+import time
+
+import pytest
+
+import api_server
+from conftest import post_transcribe
+
+TEN_HOURS = 10 * 3600
+PCM_MB = TEN_HOURS * api_server.SAMPLE_RATE * 4 / 2**20
+
+
+def use_budget(monkeypatch, free_mb, device="cuda"):
+    admission = api_server.MemoryAdmission(api_server.model_weights_mb(api_server.PRIMARY_MODEL_NAME) + free_mb)
+    admission.set_resident("primary", api_server.model_weights_mb(api_server.PRIMARY_MODEL_NAME))
+    monkeypatch.setattr(api_server, "_admission", admission)
+    monkeypatch.setattr(api_server, "_device", device)
+    return admission
+
+
+def test_chunked_plan_reserves_full_file_pcm(monkeypatch):
+    use_budget(monkeypatch, 5000)
+    plan = api_server.plan_transcription(TEN_HOURS)
+    assert plan["chunked"] and plan["model"] == api_server.PRIMARY_MODEL_NAME
+    assert plan["memory_mb"] > PCM_MB + api_server.AUDIO_MB_PER_SECOND * api_server.CHUNK_SECONDS
+
+
+def test_chunked_plan_is_refused_when_pcm_does_not_fit(monkeypatch):
+    use_budget(monkeypatch, 3000)
+    assert api_server.plan_transcription(TEN_HOURS) is None
+
+
+async def start_order(admission, requests):
+    """
+    Xếp hàng các request (duration_s, priority) sau một việc đang chạy, trả về thứ tự được cấp lượt.
+    """
+    order = []
+    
+    async def acquire(index, duration_s, priority):
+        job = await admission.acquire(100, duration_s=duration_s, priority=priority)
+        order.append(index)
+        admission.release(job)
+    
+    blocker = await admission.acquire(100)
+    tasks = [asyncio.create_task(acquire(i, *request)) for i, request in enumerate(requests)]
+    await asyncio.sleep(0)
+    admission.release(blocker)
+    await asyncio.gather(*tasks)
+    return order
+
+
+@pytest.mark.anyio
+async def test_shortest_job_runs_first():
+    admission = api_server.MemoryAdmission(1000, max_in_flight=1)
+    assert await start_order(admission, [(600, 0), (30, 0), (120, 0)]) == [1, 2, 0]
+
+
+@pytest.mark.anyio
+async def test_priority_outweighs_a_shorter_job():
+    admission = api_server.MemoryAdmission(1000, max_in_flight=1)
+    # 100s - 2 * SCHEDULER_PRIORITY_SECONDS < 30s
+    assert await start_order(admission, [(30, 0), (100, 2)]) == [1, 0]
+
+
+def test_waiting_time_ages_long_jobs():
+    admission = api_server.MemoryAdmission(1000)
+    now = time.time()
+    long_job = {"service_s": 600.0, "priority": 0, "enqueued_at": now - 700}
+    short_job = {"service_s": 30.0, "priority": 0, "enqueued_at": now}
+    assert admission._score(long_job, now) < admission._score(short_job, now)
+
+
+@pytest.mark.anyio
+async def test_job_that_does_not_fit_is_not_overtaken():
+    admission = api_server.MemoryAdmission(1000, max_in_flight=4)
+    running = await admission.acquire(600, duration_s=10)
+    big = asyncio.create_task(admission.acquire(800, duration_s=10))
+    await asyncio.sleep(0)
+    small = asyncio.create_task(admission.acquire(100, duration_s=600))
+    await asyncio.sleep(0)
+    assert not big.done() and not small.done()
+    assert admission.queue_depth == 2
+    
+    admission.release(running)
+    admission.release(await big)
+    admission.release(await small)
+    assert admission.available_mb == 1000
+
+
+@pytest.mark.anyio
+async def test_raise_priority_reorders_the_queue():
+    admission = api_server.MemoryAdmission(1000, max_in_flight=1)
+    blocker = await admission.acquire(100)
+    ticket = {}
+    low = asyncio.create_task(admission.acquire(100, duration_s=100, ticket=ticket))
+    short = asyncio.create_task(admission.acquire(100, duration_s=30))
+    await asyncio.sleep(0)
+    assert [job["duration"] for job in admission.snapshot()["queued"]] == [30, 100]
+    
+    admission.raise_priority(ticket, 2)
+    assert [job["duration"] for job in admission.snapshot()["queued"]] == [100, 30]
+    admission.release(blocker)
+    admission.release(await low)
+    admission.release(await short)
+
+
+@pytest.mark.anyio
+async def test_capacity_reports_queue_and_estimated_wait():
+    admission = api_server.MemoryAdmission(1000, max_in_flight=1)
+    api_server._admission = admission
+    blocker = await admission.acquire(100, duration_s=60)
+    queued = asyncio.create_task(admission.acquire(100, duration_s=30, priority=1))
+    await asyncio.sleep(0)
+    
+    snapshot = await api_server.capacity()
+    
+    assert (snapshot["in_flight"], snapshot["queue_depth"]) == (1, 1)
+    assert snapshot["queued"][0]["priority"] == 1
+    assert snapshot["queued"][0]["estimated_start"] == pytest.approx(60, abs=1)
+    assert snapshot["estimated_wait"] == pytest.approx(90, abs=1)
+    admission.release(blocker)
+    admission.release(await queued)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("priority", [api_server.MIN_PRIORITY - 1, api_server.MAX_PRIORITY + 1])
+async def test_out_of_range_priority_is_rejected(fake_model, priority):
+    status, body = await post_transcribe(priority=priority)
+    assert status == 400 and "error" in body
@@ -0,0 +1,28 @@
+import api_server
+from conftest import FakeModel, make_result
+
+
+def script_of(result):
+    return " ".join(word["word"].strip() for segment in result["segments"] for word in segment["words"])
+
+
+def test_full_alignment_is_kept():
+    result = make_result()
+    model = FakeModel("align", result)
+    aligned = api_server.align_audio_input(model, "voice.wav", script_of(result))
+    assert [call[0] for call in model.calls] == ["align"]
+    assert len(aligned.all_words()) == len(script_of(result).split())
+
+
+def test_aborted_alignment_falls_back_to_transcription():
+    full = make_result(n_segments=12)
+    # stable-ts dừng ở 1/3 kịch bản và chỉ trả các từ đã căn được
+    model = FakeModel("align", {"segments": full["segments"][:4], "language": "vi"})
+    api_server.align_audio_input(model, "voice.wav", script_of(full))
+    assert [call[0] for call in model.calls] == ["align", "transcribe"]
+
+
+def test_empty_alignment_falls_back_to_transcription():
+    model = FakeModel("align", {"segments": [], "language": "vi"})
+    api_server.align_audio_input(model, "voice.wav", "xin chào các bạn")
+    assert [call[0] for call in model.calls] == ["align", "transcribe"]
@@ -0,0 +1,36 @@
+import copy
+
+import pytest
+
+import api_server
+from bench_regroup import make_transcript
+
+STYLE = api_server.build_ass_style_kwargs("Arial", 60, "80000000", "ffffff", "000000", 2, 0, 2, 10, 10, 0)
+
+
+def test_columns_match_result():
+    result = make_transcript(15, seed=3)
+    columns = api_server.build_result_columns(result)
+    words = result.all_words()
+    
+    assert columns["text"] == result.text
+    assert columns["has_words"]
+    assert columns["word_start"].tolist() == [word.start for word in words]
+    assert columns["word_end"].tolist() == [word.end for word in words]
+    assert columns["segment_offsets"].tolist()[-1] == len(words)
+    offsets = columns["word_offsets"]
+    assert [columns["text"][offsets[i]:offsets[i + 1]] for i in range(len(words))] == [word.word for word in words]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_columnar_ass_matches_to_ass(seed, tmp_path):
+    result = make_transcript(15, seed)
+    # Từ ngắn hơn ASS_MIN_DUR được gộp với từ kề bên như trong stable-ts
+    for word in result.all_words()[::5]:
+        word.end = word.start + api_server.ASS_MIN_DUR / 2
+    expected_path = tmp_path / "expected.ass"
+    copy.deepcopy(result).to_ass(str(expected_path), font_size=STYLE["Fontsize"], **STYLE)
+    
+    content = api_server.render_ass_from_columns(api_server.build_result_columns(result), STYLE)
+    
+    assert content == expected_path.read_text(encoding="utf-8")
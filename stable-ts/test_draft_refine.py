@@ -0,0 +1,30 @@
+import asyncio
+
+import pytest
+
+import api_server
+from conftest import post_transcribe
+
+
+@pytest.mark.anyio
+async def test_draft_is_refined_by_the_primary_model(fake_model):
+    status, body = await post_transcribe(draft=True, trim_silence=False)
+    
+    assert status == 200
+    assert (body["model"], body["version"], body["job_status"]) == (api_server.DRAFT_MODEL_NAME, 1, "refining")
+    await asyncio.gather(*api_server._resume_tasks)
+    
+    job = api_server.load_job(body["job_id"])
+    assert (job["status"], job["version"]) == ("final", 2)
+    assert [version["model"] for version in job["versions"]] == [api_server.DRAFT_MODEL_NAME, fake_model.name]
+    assert fake_model.calls and not list(api_server.JOB_AUDIO_DIR.iterdir())
+
+
+@pytest.mark.anyio
+async def test_draft_with_the_primary_model_is_final(fake_model, monkeypatch):
+    monkeypatch.setattr(api_server, "DRAFT_MODEL_NAME", fake_model.name)
+    
+    status, body = await post_transcribe(draft=True, trim_silence=False)
+    
+    assert (status, body["version"], body["job_status"]) == (200, 1, "final")
+    assert not api_server._resume_tasks
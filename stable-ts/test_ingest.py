@@ -0,0 +1,108 @@
+import hashlib
+import io
+import tempfile
+
+import pytest
+from fastapi import UploadFile
+
+import api_server
+
+CONTENT = b"\1\2\3" * 1000
+
+
+def upload(filename, content=CONTENT, spooled=False):
+    if spooled:
+        # Như Starlette sau khi spool ra đĩa: file thật có fileno
+        file = tempfile.TemporaryFile()
+        file.write(content)
+        file.seek(0)
+    else:
+        file = io.BytesIO(content)
+    return UploadFile(file=file, filename=filename)
+
+
+def media(duration=12.0, has_video=False, audio=True):
+    return {
+        "duration": duration,
+        "audio": [{"index": 1, "codec_name": "aac"}] if audio else [],
+        "has_video": has_video,
+    }
+
+
+@pytest.fixture
+def extracted(monkeypatch):
+    """
+    Thay extract_audio_track (cần ffmpeg) bằng bản ghi lại tham số và tạo file âm thanh giả.
+    """
+    calls = []
+    
+    def extract_audio_track(source_path, info, max_duration=None):
+        calls.append(max_duration)
+        path = api_server.TEMP_DIR / "track.m4a"
+        path.write_bytes(b"audio track")
+        return path, max_duration or info["duration"]
+    
+    monkeypatch.setattr(api_server, "extract_audio_track", extract_audio_track)
+    return calls
+
+
+def test_audio_upload_is_stored_as_is(monkeypatch, extracted):
+    monkeypatch.setattr(api_server, "probe_media", lambda path: media())
+    
+    path, duration, sha256 = api_server.ingest_upload(upload("voice.mp3"), "mp3", "job-1")
+    
+    assert path == api_server.JOB_AUDIO_DIR / "job-1.mp3"
+    assert path.read_bytes() == CONTENT and sha256 == hashlib.sha256(CONTENT).hexdigest()
+    assert duration == 12.0 and extracted == []
+    assert list(api_server.TEMP_DIR.iterdir()) == []
+
+
+def test_unreadable_audio_falls_back_to_duration_probe(monkeypatch, extracted):
+    def probe_media(path):
+        raise RuntimeError("ffprobe lỗi")
+    
+    monkeypatch.setattr(api_server, "probe_media", probe_media)
+    monkeypatch.setattr(api_server, "probe_audio_duration", lambda path: 30.0)
+    
+    path, duration, _ = api_server.ingest_upload(upload("voice.wav"), "wav", "job-1")
+    
+    assert (path.read_bytes(), duration, extracted) == (CONTENT, 30.0, [])
+
+
+@pytest.mark.parametrize("spooled", [False, True])
+def test_audio_only_video_is_copied_without_extraction(monkeypatch, extracted, spooled):
+    monkeypatch.setattr(api_server, "probe_media", lambda path: media())
+    
+    path, _, sha256 = api_server.ingest_upload(upload("tts.mp4", spooled=spooled), "mp4", "job-1")
+    
+    assert path.read_bytes() == CONTENT and sha256 == hashlib.sha256(CONTENT).hexdigest()
+    assert extracted == []
+
+
+def test_video_keeps_only_the_audio_track(monkeypatch, extracted):
+    monkeypatch.setattr(api_server, "probe_media", lambda path: media(has_video=True))
+    
+    path, duration, sha256 = api_server.ingest_upload(upload("clip.mp4", spooled=True), "mp4", "job-1")
+    
+    assert path == api_server.JOB_AUDIO_DIR / "job-1.m4a"
+    assert path.read_bytes() == b"audio track" and sha256 == hashlib.sha256(b"audio track").hexdigest()
+    assert (duration, extracted) == (12.0, [None])
+
+
+def test_max_duration_trims_long_uploads(monkeypatch, extracted):
+    monkeypatch.setattr(api_server, "probe_media", lambda path: media(duration=api_server.MAX_AUDIO_SECONDS + 60))
+    
+    with pytest.raises(api_server.IngestError) as error:
+        api_server.ingest_upload(upload("long.mp3"), "mp3", "job-1")
+    assert error.value.status_code == 413
+    
+    _, duration, _ = api_server.ingest_upload(upload("long.mp3"), "mp3", "job-2", max_duration=60)
+    assert (duration, extracted) == (60, [60])
+
+
+def test_upload_without_audio_is_rejected(monkeypatch, extracted):
+    monkeypatch.setattr(api_server, "probe_media", lambda path: media(has_video=True, audio=False))
+    
+    with pytest.raises(api_server.IngestError):
+        api_server.ingest_upload(upload("clip.mp4"), "mp4", "job-1")
+    assert list(api_server.TEMP_DIR.iterdir()) == []
@@ -0,0 +1,103 @@
+import os
+import time
+
+import pytest
+
+import api_server
+from conftest import default_ass_options, post_transcribe
+
+
+def job_request(**overrides):
+    request = {
+        "mode": "transcribe",
+        "script_text": None,
+        "regroup_spec": None,
+        "trim_silence": False,
+        "priority": 0,
+        "draft": False,
+        "audio_duration": 30.0,
+        "ass_options": default_ass_options(),
+    }
+    request.update(overrides)
+    return request
+
+
+def test_create_job_claims_id_once():
+    assert api_server.create_job("job-1", "a.mp3")
+    assert not api_server.create_job("job-1", "b.mp3")
+    assert api_server.load_job("job-1")["filename"] == "a.mp3"
+
+
+@pytest.mark.anyio
+async def test_resume_fails_job_interrupted_before_audio_was_stored():
+    api_server.create_job("job-1", "a.mp3")
+    assert api_server.claim_interrupted_jobs() == ["job-1"]
+    
+    await api_server.resume_job("job-1")
+    
+    job = api_server.load_job("job-1")
+    assert job["status"] == "failed"
+    assert api_server.claim_interrupted_jobs() == []
+
+
+@pytest.mark.anyio
+async def test_resume_publishes_final_version(fake_model):
+    audio_path = api_server.JOB_AUDIO_DIR / "job-1.wav"
+    audio_path.write_bytes(b"\0" * 100)
+    api_server.create_job("job-1", "a.wav")
+    api_server.set_job_input("job-1", job_request(), audio_path, "sha")
+    
+    await api_server.resume_job("job-1")
+    
+    job = api_server.load_job("job-1")
+    assert (job["status"], job["version"]) == ("final", 1)
+    assert not audio_path.exists()
+    assert (api_server.OUTPUTS_DIR / job["versions"][0]["download_url"].split("/")[-1]).exists()
+
+
+def test_interrupted_jobs_of_other_live_replicas_are_not_claimed():
+    api_server.create_job("job-1", "a.mp3")
+    api_server.get_db().execute("UPDATE jobs SET owner = 'other' WHERE id = 'job-1'")
+    assert api_server.claim_interrupted_jobs() == []
+    
+    api_server.get_db().execute("UPDATE jobs SET heartbeat_at = 0 WHERE id = 'job-1'")
+    assert api_server.claim_interrupted_jobs() == ["job-1"]
+
+
+@pytest.mark.anyio
+async def test_same_job_id_returns_existing_result(fake_model):
+    status, first = await post_transcribe(job_id="client-1", trim_silence=False)
+    assert status == 200
+    
+    status, again = await post_transcribe(job_id="client-1", trim_silence=False)
+    assert status == 200
+    assert again["download_url"] == first["download_url"]
+    assert len(fake_model.calls) == 1
+
+
+def test_replica_id_is_persisted_and_shared_data_dir_falls_back_per_process(tmp_path, monkeypatch):
+    monkeypatch.setattr(api_server, "DATA_DIR", tmp_path)
+    replica_id, id_file = api_server.load_replica_id()
+    assert (tmp_path / "replica_id").read_text() == replica_id
+    
+    # Tiến trình khác dùng chung DATA_DIR khi file id đang bị khóa
+    other_id, other_file = api_server.load_replica_id()
+    assert other_file is None
+    assert other_id != replica_id and other_id.endswith(f"-{api_server.os.getpid()}")
+    
+    id_file.close()
+    restarted_id, id_file = api_server.load_replica_id()
+    assert restarted_id == replica_id
+    id_file.close()
+
+
+def test_prune_removes_expired_profiles():
+    expired = api_server.OUTPUTS_DIR / "old.profile.json"
+    recent = api_server.OUTPUTS_DIR / "new.profile.json"
+    for path in (expired, recent):
+        path.write_text("{}")
+    old = time.time() - api_server.JOB_MAX_AGE - 60
+    os.utime(expired, (old, old))
+    
+    assert api_server.prune_store()["profiles"] == 1
+    assert not expired.exists() and recent.exists()
@@ -0,0 +1,39 @@
+import json
+import logging
+
+import api_server
+
+
+def test_import_keeps_root_handlers():
+    assert api_server._log_handler is None
+    assert not any(isinstance(h, api_server.DroppingQueueHandler) for h in logging.getLogger().handlers)
+
+
+def test_setup_logging_adds_one_handler():
+    root = logging.getLogger()
+    existing = list(root.handlers)
+    level = root.level
+    try:
+        handler, listener = api_server.setup_logging()
+        assert api_server.setup_logging() == (handler, listener)
+        assert root.handlers == existing + [handler]
+    finally:
+        api_server.stop_logging()
+        root.setLevel(level)
+    assert root.handlers == existing
+    api_server.stop_logging()
+
+
+def test_full_queue_drops_records_instead_of_blocking():
+    handler = api_server.DroppingQueueHandler(api_server.queue.Queue(1))
+    record = logging.LogRecord("autoreel-api", logging.INFO, __file__, 1, "xin chào", None, None)
+    handler.handle(record)
+    handler.handle(record)
+    assert (handler.queue.qsize(), handler.dropped) == (1, 1)
+
+
+def test_structured_formatter_keeps_extra_fields():
+    record = logging.LogRecord("autoreel-api", logging.INFO, __file__, 1, "xong %s", ("job",), None)
+    record.job_id = "job-1"
+    entry = json.loads(api_server.StructuredFormatter().format(record))
+    assert (entry["message"], entry["level"], entry["job_id"]) == ("xong job", "INFO", "job-1")
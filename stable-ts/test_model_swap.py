@@ -0,0 +1,66 @@
+import asyncio
+from collections import deque
+
+import pytest
+from fastapi import HTTPException
+
+import api_server
+
+
+@pytest.fixture
+def swap_state(fake_model, monkeypatch):
+    monkeypatch.setattr(api_server, "_swap_task", None)
+    monkeypatch.setattr(api_server, "_swap_events", deque(maxlen=20))
+    monkeypatch.setattr(api_server, "prepare_model", lambda model, model_name, warmup=True: model)
+    return fake_model
+
+
+async def wait_for_status(event, *statuses):
+    while event["status"] not in statuses:
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.anyio
+async def test_swap_serves_new_requests_while_old_requests_drain(swap_state):
+    old_model = api_server.hold_model(swap_state)
+    
+    response = await api_server.admin_swap_model(model_name="turbo", x_admin_token=None)
+    assert response.status_code == 202
+    event = api_server._swap_events[-1]
+    await wait_for_status(event, "draining")
+    
+    # Request mới dùng ngay mô hình mới, mô hình cũ vẫn được giữ cho request đang chạy
+    assert api_server.get_model_by_name(api_server._model_name).name == "turbo"
+    assert (await api_server.admin_swap_model(model_name="large-v3", x_admin_token=None)).status_code == 409
+    assert api_server.get_admission().resident["swap"] == api_server.model_weights_mb("turbo")
+    
+    api_server.release_model(old_model)
+    await api_server._swap_task
+    
+    assert event["status"] == "done"
+    assert api_server.get_admission().resident == {"primary": api_server.model_weights_mb("turbo")}
+    assert (await api_server.admin_model_status(x_admin_token=None))["model"] == "turbo"
+
+
+@pytest.mark.anyio
+async def test_failed_load_keeps_the_current_model(swap_state, monkeypatch):
+    def load_model(name, device=None):
+        raise RuntimeError("không tải được checkpoint")
+    
+    monkeypatch.setattr(api_server.stable_whisper, "load_model", load_model)
+    await api_server.admin_swap_model(model_name="turbo", x_admin_token=None)
+    await api_server._swap_task
+    
+    event = api_server._swap_events[-1]
+    assert event["status"] == "failed" and "checkpoint" in event["error"]
+    assert api_server._model is swap_state
+    assert "swap" not in api_server.get_admission().resident
+
+
+@pytest.mark.anyio
+async def test_admin_token_is_required_when_configured(swap_state, monkeypatch):
+    monkeypatch.setattr(api_server, "ADMIN_TOKEN", "bí mật")
+    with pytest.raises(HTTPException) as error:
+        await api_server.admin_swap_model(model_name="turbo", x_admin_token="sai")
+    assert error.value.status_code == 403
+    assert (await api_server.admin_model_status(x_admin_token="bí mật"))["model"] == api_server.PRIMARY_MODEL_NAME
@@ -0,0 +1,53 @@
+import asyncio
+import threading
+
+import pytest
+
+import api_server
+
+
+@pytest.mark.anyio
+async def test_full_stage_applies_backpressure():
+    stage = api_server.PipelineStage("test", workers=1, max_queue=1)
+    gate = threading.Event()
+    try:
+        tasks = [asyncio.create_task(stage.run(gate.wait, 5)) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        assert (stage.running, stage.queued, stage.blocked) == (1, 1, 1)
+        
+        gate.set()
+        assert await asyncio.gather(*tasks) == [True, True, True]
+        assert stage.snapshot()["completed"] == 3
+    finally:
+        gate.set()
+        stage.executor.shutdown(wait=True)
+
+
+@pytest.mark.anyio
+async def test_stage_errors_reach_the_caller():
+    stage = api_server.PipelineStage("test", workers=1, max_queue=1)
+    try:
+        with pytest.raises(ZeroDivisionError):
+            await stage.run(lambda: 1 / 0)
+        assert stage.snapshot()["failed"] == 1 and stage.running == 0
+    finally:
+        stage.executor.shutdown(wait=True)
+
+
+@pytest.mark.anyio
+async def test_audio_is_decoded_after_admission_and_slot_freed_before_render(fake_model, monkeypatch):
+    admission = api_server.get_admission()
+    decoded_in_flight = []
+    
+    def prepare_audio_input(audio_path, trim_silence=True):
+        decoded_in_flight.append(admission.in_flight)
+        return str(audio_path), None
+    
+    monkeypatch.setattr(api_server, "prepare_audio_input", prepare_audio_input)
+    plan = api_server.plan_transcription(30.0)
+    
+    result, timeline, _, mode = await api_server.run_planned_transcription(plan, "voice.wav", 30.0, "transcribe")
+    
+    assert decoded_in_flight == [1]
+    assert admission.in_flight == 0 and admission.reserved_mb == 0
+    assert (timeline, mode) == (None, "transcribe") and result.segments
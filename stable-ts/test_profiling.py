@@ -0,0 +1,33 @@
+import json
+
+import pytest
+from fastapi import HTTPException
+
+import api_server
+from conftest import post_transcribe
+
+
+@pytest.mark.anyio
+async def test_profile_is_captured_only_on_request(fake_model):
+    fake_model.delay = 0.2
+    status, body = await post_transcribe(trim_silence=False)
+    assert status == 200 and "profile_url" not in body
+    
+    status, body = await post_transcribe(content=b"\1" * 1000, trim_silence=False, x_profile="1")
+    assert status == 200
+    profile_id = body["profile_url"].rsplit("/", 1)[-1]
+    
+    response = await api_server.get_profile(profile_id)
+    with open(response.path, encoding="utf-8") as f:
+        profile = json.load(f)
+    assert profile["id"] == profile_id and profile["samples"] > 0
+    # Thread suy luận làm việc cho request cũng được lấy mẫu
+    assert any(":transcribe_audio_input:" in item["function"] for item in profile["functions"])
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("profile_id, status_code", [("../state", 400), ("0" * 32, 404)])
+async def test_unknown_profiles_are_rejected(profile_id, status_code):
+    with pytest.raises(HTTPException) as error:
+        await api_server.get_profile(profile_id)
+    assert error.value.status_code == status_code
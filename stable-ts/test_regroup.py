@@ -0,0 +1,31 @@
+import copy
+
+import pytest
+
+import api_server
+from bench_regroup import make_transcript
+
+SPECS = [
+    "",
+    '{"max_gap": null, "clause_min_chars": 0, "max_chars": 35, "ignore_special_periods": false}',
+    '{"clamp_medium_factor": 0, "sentence_punctuation": [".", ["?", " "]]}',
+]
+
+
+def timings(result):
+    return [[(word.word, word.start, word.end, type(word.start), type(word.end)) for word in segment.words]
+            for segment in result.segments]
+
+
+@pytest.mark.parametrize("spec_json", SPECS)
+def test_fused_regroup_matches_chain(spec_json):
+    spec = api_server.parse_regroup_spec(spec_json)
+    for seed in range(60):
+        transcript = make_transcript(20, seed)
+        if seed % 7 == 0:
+            for word in transcript.all_words()[::11]:
+                word.lock_right()
+        expected = api_server.regroup_with_chain(copy.deepcopy(transcript), spec)
+        actual = api_server.regroup_for_single_line(copy.deepcopy(transcript), spec)
+        assert timings(actual) == timings(expected)
+        assert [segment.id for segment in actual.segments] == list(range(len(actual.segments)))
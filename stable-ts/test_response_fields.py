@@ -0,0 +1,43 @@
+import pytest
+
+import api_server
+from conftest import post_transcribe
+
+
+def test_default_and_simple_field_sets():
+    assert list(api_server.parse_response_fields(None)) == api_server.FULL_RESPONSE_FIELDS
+    assert list(api_server.parse_response_fields("", simple_response=True)) == api_server.SIMPLE_RESPONSE_FIELDS
+    assert "words" in api_server.parse_response_fields(None, include_words=True)
+
+
+def test_sub_fields_are_merged():
+    selection = api_server.parse_response_fields("text, segments.start,segments.end,segments.start,words")
+    assert selection == {"text": None, "segments": ["start", "end"], "words": None}
+    assert api_server.parse_response_fields("segments,segments.start") == {"segments": None}
+
+
+@pytest.mark.parametrize("fields", ["transcript", "segments.speaker", "text.start"])
+def test_unknown_fields_are_rejected(fields):
+    with pytest.raises(ValueError):
+        api_server.parse_response_fields(fields)
+
+
+@pytest.mark.anyio
+async def test_columnar_response_holds_the_same_values_as_records(fake_model):
+    fields = "text,segments.start,segments.text,words.word,words.end"
+    status, records = await post_transcribe(fields=fields, trim_silence=False)
+    assert status == 200
+    assert list(records) == ["text", "segments", "words"]
+    assert set(records["segments"][0]) == {"start", "text"}
+    
+    status, columnar = await post_transcribe(fields=fields, response_format="columnar", trim_silence=False)
+    assert status == 200
+    for name in ("segments", "words"):
+        table = columnar[name]
+        assert [dict(zip(table, row)) for row in zip(*table.values())] == records[name]
+
+
+@pytest.mark.anyio
+async def test_invalid_response_options_return_400(fake_model):
+    assert (await post_transcribe(fields="transcript"))[0] == 400
+    assert (await post_transcribe(response_format="csv"))[0] == 400
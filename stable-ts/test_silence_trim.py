@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+import api_server
+from stable_whisper import WhisperResult
+
+SR = api_server.SAMPLE_RATE
+
+
+def tone(seconds):
+    t = np.arange(int(seconds * SR)) / SR
+    return (0.3 * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+
+
+def silence(seconds):
+    return np.zeros(int(seconds * SR), dtype=np.float32)
+
+
+def test_long_silence_is_cut_with_padding():
+    audio = np.concatenate([tone(1), silence(3), tone(1)])
+    timeline = api_server.find_silence_trim_timeline(audio)
+    
+    assert timeline["removed"] == pytest.approx(3 - 2 * api_server.SILENCE_PAD)
+    assert timeline["keep"].tolist() == [[0, int(1.2 * SR)], [int(3.8 * SR), len(audio)]]
+    assert timeline["original_starts"].tolist() == [0.0, 3.8]
+    assert timeline["compact_starts"].tolist() == [0.0, 1.2]
+
+
+def test_short_pauses_are_kept():
+    audio = np.concatenate([tone(1), silence(api_server.SILENCE_MIN_DURATION / 2), tone(1)])
+    assert api_server.find_silence_trim_timeline(audio) is None
+
+
+def test_prepare_audio_input_returns_compact_pcm(monkeypatch):
+    audio = np.concatenate([silence(2), tone(1), silence(2), tone(1), silence(2)])
+    monkeypatch.setattr(api_server, "decode_audio_pcm", lambda path: audio)
+    
+    compact, timeline = api_server.prepare_audio_input("voice.wav", trim_silence=True)
+    
+    assert len(compact) == len(audio) - round(timeline["removed"] * SR)
+    assert api_server.prepare_audio_input("voice.wav", trim_silence=False) == ("voice.wav", None)
+
+
+def test_timestamps_are_mapped_back_to_original_audio():
+    audio = np.concatenate([tone(1), silence(3), tone(1)])
+    timeline = api_server.find_silence_trim_timeline(audio)
+    result = WhisperResult({"segments": [{
+        "start": 0.5, "end": 1.7, "text": " xin chào bạn",
+        "words": [
+            {"word": " xin", "start": 0.5, "end": 0.9, "probability": 0.9},
+            # Kết thúc đúng tại ranh giới vẫn thuộc đoạn trước, bắt đầu tại ranh giới thuộc đoạn sau
+            {"word": " chào", "start": 1.0, "end": 1.2, "probability": 0.9},
+            {"word": " bạn", "start": 1.2, "end": 1.7, "probability": 0.9},
+        ],
+    }], "language": "vi"})
+    
+    api_server.remap_result_timestamps(result, timeline)
+    
+    assert [(word.start, word.end) for word in result.all_words()] == [(0.5, 0.9), (1.0, 1.2), (3.8, 4.3)]
@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+
+import api_server
+from conftest import post_transcribe
+
+
+@pytest.mark.anyio
+async def test_identical_uploads_are_transcribed_once(fake_model):
+    fake_model.delay = 0.5
+    leader = asyncio.create_task(post_transcribe(filename="a.mp3"))
+    await asyncio.sleep(0.2)
+    follower = asyncio.create_task(post_transcribe(filename="b.mp3"))
+    (leader_status, leader_body), (follower_status, follower_body) = await asyncio.gather(leader, follower)
+    
+    assert (leader_status, follower_status) == (200, 200)
+    assert [call[0] for call in fake_model.calls] == ["transcribe"]
+    assert "coalesced" not in leader_body
+    assert follower_body["coalesced"] is True
+    # Request đến sau báo thời gian chờ của chính nó, ngắn hơn thời gian phiên âm của request đầu
+    assert follower_body["leader_processing_time"] == leader_body["processing_time"]
+    assert float(follower_body["processing_time"].split()[0]) < float(leader_body["processing_time"].split()[0])
+
+
+@pytest.mark.anyio
+async def test_failure_is_shared_with_waiting_requests():
+    single_flight = api_server.SingleFlight()
+    calls = []
+    
+    async def fail(state):
+        calls.append(state)
+        await asyncio.sleep(0.05)
+        raise RuntimeError("lỗi")
+    
+    results = await asyncio.gather(
+        single_flight.run("key", fail), single_flight.run("key", fail), return_exceptions=True
+    )
+    
+    assert len(calls) == 1
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert "key" not in single_flight
+    assert single_flight.snapshot()["failed"] == 1
@@ -0,0 +1,47 @@
+import json
+import random
+
+import pytest
+
+import api_server
+from conftest import make_result
+from stable_whisper import WhisperResult
+
+
+def make_columns(n_segments=12, seed=0):
+    return api_server.build_result_columns(WhisperResult(make_result(n_segments, seed)))
+
+
+@pytest.mark.parametrize("edits", [
+    [{"segment": 8, "text": ""}, {"segment": 8, "text": "xin chào"}],
+    [{"segment": 8, "text": ""}, {"segment": 8, "start": 1.0}],
+    [{"word": 3, "text": ""}, {"word": 3, "text": "bạn"}],
+])
+def test_duplicate_targets_are_rejected(edits):
+    with pytest.raises(ValueError):
+        api_server.apply_transcript_edits(make_columns(), api_server.parse_transcript_edits(json.dumps(edits)))
+
+
+def test_deleted_segment_is_not_edited_again():
+    with pytest.raises(ValueError):
+        api_server._edit_segment_words([], [{"segment": 0, "end": 2.0}], [], 0)
+    with pytest.raises(ValueError):
+        api_server._retime_words([], "xin chào")
+
+
+def test_random_edit_lists_only_raise_value_error():
+    columns = make_columns()
+    n_words = len(columns["word_start"])
+    n_segments = len(columns["segment_offsets"]) - 1
+    rng = random.Random(1)
+    for _ in range(600):
+        edits = []
+        for _ in range(rng.randint(1, 4)):
+            edit = {"word": rng.randrange(n_words)} if rng.random() < 0.5 else {"segment": rng.randrange(n_segments)}
+            key = rng.choice(["text", "start", "end"])
+            edit[key] = rng.choice(["", "xin", "xin chào bạn"]) if key == "text" else round(rng.uniform(0, 20), 3)
+            edits.append(edit)
+        try:
+            api_server.apply_transcript_edits(columns, api_server.parse_transcript_edits(json.dumps(edits)))
+        except ValueError:
+            pass